@@ -0,0 +1,203 @@
+import time
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import MetaData, Table, Column, Integer, Float, DateTime, Text
+from metrics import run_metrics
+
+# -------------------------------------------------------------------------------------------
+# Arrow records: api json to typed arrow tables, bulk inserts and parquet without pandas copies
+# -------------------------------------------------------------------------------------------
+
+# arrow types of config column types, categories are dictionary encoded strings
+arrow_types = {
+    'INT': pa.int64(),
+    'VARCHAR': pa.string(),
+    'NUMERIC': pa.float64(),
+    'DATETIME': pa.timestamp('us'),
+    'UNIXTIME_MS': pa.timestamp('ms'),
+    'UNIXTIME_S': pa.timestamp('s'),
+    'TEXT': pa.string(),
+    'CATEGORY': pa.dictionary(pa.int32(), pa.string())
+}
+
+
+def to_strings(values):
+    """
+    Strings of values for string columns, same as astype(str) of pandas except that nulls stay null:
+    missing VARCHAR/TEXT values are NULL in arrow mode, pandas mode (Scetl.apply_data_types) writes 'None' or 'nan'
+    :param values: list of python values
+    :return: list of str or None
+    """
+    return [x if x is None or isinstance(x, str) else str(x) for x in values]
+
+
+def is_low_cardinality(array, threshold, min_rows):
+    """
+    Same rule as Scetl.is_low_cardinality
+    :param array: pa.Array of strings
+    :param threshold: max share of unique values, 0 turns detection off
+    :param min_rows: min rows to check
+    :return: Bool
+    """
+    if not threshold or len(array) < min_rows:
+        return False
+    return len(array.dictionary_encode().dictionary) <= len(array) * threshold
+
+
+def make_array(values, column_type, category_threshold=0, category_min_rows=50):
+    """
+    Builds arrow array of config column type straight from values of decoded json
+    :param values: list of python values, None for nulls
+    :param column_type: config type, e.g. 'INT' or 'UNIXTIME_MS'
+    :param category_threshold: VARCHAR columns with share of unique values below it are dictionary encoded
+    :param category_min_rows: min rows for category detection
+    :return: pa.Array
+    """
+    if column_type == 'DATETIME':
+        # api dates come as strings of different formats, parsed same way as in Scetl.apply_data_types
+        parsed = pd.to_datetime(pd.Series(values, dtype=object), yearfirst=True)
+        if parsed.dt.tz is not None:
+            parsed = parsed.dt.tz_localize(None)
+        return pa.array(parsed, from_pandas=True).cast(arrow_types['DATETIME'], safe=False)
+    if column_type in ('UNIXTIME_MS', 'UNIXTIME_S'):
+        return make_array(values, 'INT').cast(arrow_types[column_type])
+    if column_type == 'CATEGORY':
+        return make_array(values, 'VARCHAR').dictionary_encode()
+    arrow_type = arrow_types[column_type]
+    try:
+        array = pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if arrow_type == pa.string():
+            # numbers or nested objects in string columns
+            array = pa.array(to_strings(values), type=pa.string())
+        else:
+            # numbers sent as strings, floats in int columns
+            array = pa.array(pd.to_numeric(pd.Series(values, dtype=object)), from_pandas=True).cast(arrow_type)
+    if column_type == 'VARCHAR' and is_low_cardinality(array, category_threshold, category_min_rows):
+        array = array.dictionary_encode()
+    return array
+
+
+def records_to_table(records, table_dict, constants=None, category_threshold=0, category_min_rows=50):
+    """
+    Makes arrow table from api records (list of dicts) column by column with types from config.
+    Keys of records not in config are dropped, missing ones are null
+    :param records: list of dicts
+    :param table_dict: table dict from config dict
+    :param constants: dict of column name and value set for every row, e.g. last_update or tenant
+    :param category_threshold: see make_array
+    :param category_min_rows: see make_array
+    :return: pa.Table
+    """
+    started_at = time.monotonic()
+    constants = constants or {}
+    names = []
+    arrays = []
+    for column in table_dict['columns']:
+        name = column['name']
+        if name in constants:
+            values = [constants[name]] * len(records)
+        else:
+            values = [x.get(name) for x in records]
+        names.append(name)
+        arrays.append(make_array(values, column['type'], category_threshold, category_min_rows))
+    for name, value in constants.items():
+        if name not in names:
+            names.append(name)
+            arrays.append(pa.array([value] * len(records), type=pa.string()))
+    table = pa.Table.from_arrays(arrays, names=names)
+    run_metrics.add('arrow_records', 'tables')
+    run_metrics.add('arrow_records', 'rows', len(records))
+    run_metrics.add('arrow_records', 'build_seconds', round(time.monotonic() - started_at, 4))
+    return table
+
+
+def rows_to_table(rows, names, table_dict):
+    """
+    Makes arrow table from database rows, e.g. when exporting local tables
+    :param rows: list of tuples
+    :param names: column names of rows
+    :param table_dict: table dict from config dict, columns not in config are read as strings
+    :return: pa.Table
+    """
+    # unix timestamps are already stored as datetimes
+    column_types = {x['name']: 'DATETIME' if x['type'].startswith('UNIXTIME') else x['type']
+                    for x in table_dict['columns']}
+    columns = list(zip(*rows)) if rows else [() for _ in names]
+    arrays = [make_array(list(values), column_types.get(name, 'VARCHAR')) for name, values in zip(names, columns)]
+    return pa.Table.from_arrays(arrays, names=list(names))
+
+
+def column_values(column, dialect_name):
+    """
+    Python values of arrow column for DBAPI executemany, dictionary columns are decoded.
+    Timestamps go to sqlite in the same text format as to_sql writes them
+    :param column: pa.ChunkedArray
+    :param dialect_name: engine.dialect.name
+    :return: list
+    """
+    values = []
+    for chunk in column.chunks:
+        if pa.types.is_dictionary(chunk.type):
+            chunk = chunk.dictionary.take(chunk.indices)
+        chunk_values = chunk.to_pylist()
+        if pa.types.is_timestamp(chunk.type) and dialect_name == 'sqlite':
+            chunk_values = [None if x is None else x.strftime('%Y-%m-%d %H:%M:%S.%f') for x in chunk_values]
+        values += chunk_values
+    return values
+
+
+def get_sql_type(arrow_type):
+    """
+    Sqlalchemy type of arrow column, for tables created from arrow schema
+    :param arrow_type: pa.DataType
+    :return: sqlalchemy type
+    """
+    if pa.types.is_integer(arrow_type):
+        return Integer
+    if pa.types.is_floating(arrow_type):
+        return Float
+    if pa.types.is_timestamp(arrow_type):
+        return DateTime
+    return Text
+
+
+def create_table(connection, table_name, table, schema=None):
+    """
+    Creates table with columns of arrow table if it does not exist
+    :param connection: sqlalchemy connection
+    :param table_name: table name
+    :param table: pa.Table
+    :param schema: database schema of table, None for default one
+    :return: None
+    """
+    columns = [Column(x.name, get_sql_type(x.type)) for x in table.schema]
+    Table(table_name, MetaData(), *columns, schema=schema).create(connection, checkfirst=True)
+
+
+def insert_table(connection, table_name, table, batch_rows=10000, schema=None):
+    """
+    Inserts arrow table with DBAPI executemany, rows are made straight from arrow columns one batch at a time,
+    so only batch_rows python tuples exist at once
+    :param connection: sqlalchemy connection
+    :param table_name: existing table name
+    :param table: pa.Table
+    :param batch_rows: rows per executemany call
+    :param schema: database schema of table, None for default one
+    :return: number of inserted rows
+    """
+    started_at = time.monotonic()
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    placeholder = '?' if dialect.paramstyle == 'qmark' else '%s'
+    names = table.schema.names
+    target = quote(table_name) if schema is None else f'{quote(schema)}.{quote(table_name)}'
+    query = f'INSERT INTO {target} ({", ".join([quote(x) for x in names])}) ' \
+            f'VALUES ({", ".join([placeholder] * len(names))})'
+    for start in range(0, table.num_rows, batch_rows):
+        batch = table.slice(start, batch_rows)
+        rows = list(zip(*[column_values(batch.column(i), dialect.name) for i in range(batch.num_columns)]))
+        connection.execute(query, rows)
+    run_metrics.add('arrow_records', f'{dialect.name}_rows', table.num_rows)
+    run_metrics.add('arrow_records', f'{dialect.name}_insert_seconds', round(time.monotonic() - started_at, 4))
+    return table.num_rows
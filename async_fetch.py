@@ -0,0 +1,130 @@
+import time
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import urlparse
+from throttle import rate_limiter
+from metrics import run_metrics
+from json_decode import loads
+
+# ---------------------------------------------------------------------------------------
+# Asyncio fetch core: many api calls on one event loop, limited by per host controllers
+# ---------------------------------------------------------------------------------------
+
+
+class AsyncFetcher:
+
+    def __init__(self, settings=None, credential='default'):
+        """
+        Makes api calls concurrently on one event loop. Every call goes through the same host controller
+        as Scetl.http_request (see throttle.py), so Retry-After, token buckets and AIMD limit are shared.
+        Requests are dicts with method, url and optional credential, headers, params and data - same as
+        arguments of Scetl.http_request
+        :param settings: "rate_limits" dict from system config
+        :param credential: credential of requests without one, e.g. tenant
+        """
+        self.settings = settings or {}
+        self.credential = credential
+        self.max_retries = int(self.settings.get('max_retries', 5))
+        self.semaphores = {}
+
+    def get_semaphore(self, controller):
+        """
+        Semaphore for host, caps number of tasks waiting on host controller at once.
+        Semaphores belong to event loop, so they are recreated on each run
+        :param controller: HostController of host
+        :return: asyncio.Semaphore
+        """
+        if controller.host not in self.semaphores:
+            self.semaphores[controller.host] = asyncio.Semaphore(controller.max_concurrency)
+        return self.semaphores[controller.host]
+
+    @staticmethod
+    async def acquire(controller, credential):
+        """
+        Waits without blocking event loop until host controller allows request
+        :param controller: HostController of host
+        :param credential: token owner
+        :return: None
+        """
+        wait_time = controller.try_acquire(credential)
+        if wait_time == 0:
+            return
+        controller.add_waiting(credential, 1)
+        try:
+            while wait_time > 0:
+                await asyncio.sleep(wait_time)
+                wait_time = controller.try_acquire(credential)
+        finally:
+            controller.add_waiting(credential, -1)
+
+    async def request(self, session, request):
+        """
+        Makes one api call, retries throttled requests like RateLimiter.request
+        :param session: aiohttp.ClientSession
+        :param request: dict with method, url, credential, headers, params, data
+        :return: python object decoded from response json
+        """
+        request = dict(request)
+        method = request.pop('method', 'get')
+        url = request.pop('url')
+        credential = request.pop('credential', self.credential)
+        controller = rate_limiter.get_controller(urlparse(url).netloc, self.settings)
+        attempt = 0
+        async with self.get_semaphore(controller):
+            while True:
+                attempt += 1
+                await self.acquire(controller, credential)
+                started_at = time.monotonic()
+                status_code = None
+                retry_after = None
+                try:
+                    async with session.request(method, url, **request) as response:
+                        status_code = response.status
+                        retry_after = rate_limiter.parse_retry_after(response.headers.get('Retry-After'))
+                        body = await response.read()
+                finally:
+                    # slot is given back on errors, timeouts and cancellation too, otherwise host stalls
+                    controller.release(time.monotonic() - started_at, status_code, retry_after, credential)
+                if status_code not in controller.throttle_status_codes or attempt > self.max_retries:
+                    run_metrics.add('async_fetch', 'requests')
+                    return loads(body)
+                logging.info(f'{controller.host} throttled request (status {status_code}), '
+                             f'retry {attempt} of {self.max_retries}')
+
+    async def gather(self, session, requests):
+        """
+        Makes api calls concurrently
+        :param session: aiohttp.ClientSession
+        :param requests: list of request dicts
+        :return: list of decoded responses in order of requests
+        """
+        return await asyncio.gather(*[self.request(session, x) for x in requests])
+
+    def run(self, coroutine_function, *args):
+        """
+        Sync facade: runs coroutine function on new event loop with new session and waits for result
+        :param coroutine_function: async function taking session as first argument
+        :param args: other arguments of coroutine_function
+        :return: result of coroutine_function
+        """
+        async def main():
+            async with aiohttp.ClientSession() as session:
+                return await coroutine_function(session, *args)
+
+        self.semaphores = {}
+        started_at = time.monotonic()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
+            run_metrics.add('async_fetch', 'seconds', round(time.monotonic() - started_at, 3))
+
+    def fetch_all(self, requests):
+        """
+        Sync facade for gather
+        :param requests: list of request dicts
+        :return: list of decoded responses in order of requests
+        """
+        return self.run(self.gather, requests)
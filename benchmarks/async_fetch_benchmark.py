@@ -0,0 +1,66 @@
+"""
+Sequential fetch (RateLimiter.request in a loop, as Scetl.http_request) against AsyncFetcher.fetch_all
+on local fake api that answers after fixed latency.
+Run from repository root: python benchmarks/async_fetch_benchmark.py --requests 200 --latency 0.05
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from throttle import rate_limiter
+from async_fetch import AsyncFetcher
+
+
+def make_handler(latency):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            body = json.dumps({'courses': [{'id': i, 'progress': i / 10} for i in range(20)]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(args.latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/users'
+    settings = {'requests_per_second': 1000, 'min_concurrency': args.concurrency,
+                'max_concurrency': args.concurrency}
+
+    started_at = time.monotonic()
+    for i in range(args.requests):
+        rate_limiter.request('get', f'{url}/{i}', settings=settings).json()
+    sequential = time.monotonic() - started_at
+
+    fetcher = AsyncFetcher(settings)
+    started_at = time.monotonic()
+    fetcher.fetch_all([{'method': 'get', 'url': f'{url}/{i}'} for i in range(args.requests)])
+    concurrent = time.monotonic() - started_at
+
+    server.shutdown()
+    print(f'{args.requests} requests, {args.latency * 1000:.0f} ms latency, concurrency {args.concurrency}')
+    print(f'sequential: {sequential:.2f} s, {args.requests / sequential:.1f} req/s')
+    print(f'async:      {concurrent:.2f} s, {args.requests / concurrent:.1f} req/s ({sequential / concurrent:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Blocked fuzzy matching (EmployeeMapper.get_fuzzy_candidates) against exhaustive matching that computes
+edit distance to every HR name, on synthetic names with one typo each.
+Accuracy: share of users whose true HR row is among best candidates, and share of users where blocked
+matching returns the same candidates as exhaustive one.
+Run from repository root: python benchmarks/fuzzy_matching_benchmark.py --hr-rows 20000 --users 200
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mapper import EmployeeMapper
+
+letters = 'абвгдеежзиклмнопрстуфхцчшщыэюя'
+syllables = ['ва', 'но', 'ков', 'ров', 'ли', 'ан', 'ма', 'ев', 'ин', 'ска', 'те', 'ло', 'гу', 'ми', 'ша', 'ре']
+first_names = ['иван', 'петр', 'анна', 'ольга', 'сергей', 'мария', 'алексей', 'елена', 'дмитрий', 'наталья']
+
+
+def make_name(random_state):
+    return ''.join(random_state.choice(syllables) for _ in range(random_state.randint(2, 4)))
+
+
+def add_typo(name, random_state):
+    """
+    One substitution, insertion, deletion or swap of neighbour letters
+    """
+    position = random_state.randrange(1, len(name) - 1)
+    kind = random_state.randrange(4)
+    if kind == 0:
+        return name[:position] + random_state.choice(letters) + name[position + 1:]
+    if kind == 1:
+        return name[:position] + random_state.choice(letters) + name[position:]
+    if kind == 2:
+        return name[:position] + name[position + 1:]
+    return name[:position - 1] + name[position] + name[position - 1] + name[position + 1:]
+
+
+def exhaustive_candidates(mapper, last_first_name, hr_names):
+    """
+    Previous approach without blocking index: bounded edit distance to every HR name
+    :return: list of positions with best similarity above fuzzy_threshold
+    """
+    best_score = 0
+    best_positions = []
+    for position, hr_name in enumerate(hr_names):
+        name_length = max(len(last_first_name), len(hr_name))
+        max_distance = int(name_length * (1 - mapper.fuzzy_threshold))
+        distance = mapper.edit_distance(last_first_name, hr_name, max_distance)
+        if distance > max_distance:
+            continue
+        score = 1 - distance / name_length
+        if score > best_score:
+            best_score = score
+            best_positions = [position]
+        elif score == best_score:
+            best_positions.append(position)
+    return best_positions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hr-rows', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random_state = random.Random(args.seed)
+    df_hr = pd.DataFrame({
+        'last_name': [make_name(random_state) for _ in range(args.hr_rows)],
+        'first_name': [random_state.choice(first_names) for _ in range(args.hr_rows)]
+    })
+    df_hr['last_first_name'] = df_hr['last_name'] + ' ' + df_hr['first_name']
+    hr_names = list(df_hr['last_first_name'])
+    truth = random_state.sample(range(args.hr_rows), args.users)
+    users = [add_typo(df_hr['last_name'][x], random_state) + ' ' + df_hr['first_name'][x] for x in truth]
+
+    mapper = EmployeeMapper(None)
+    started_at = time.monotonic()
+    fuzzy_index = mapper.build_fuzzy_index(df_hr)
+    index_seconds = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    blocked = [list(mapper.get_fuzzy_candidates(x, df_hr, fuzzy_index).index) for x in users]
+    blocked_seconds = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    exhaustive = [exhaustive_candidates(mapper, x, hr_names) for x in users]
+    exhaustive_seconds = time.monotonic() - started_at
+
+    blocked_found = sum(position in found for position, found in zip(truth, blocked))
+    exhaustive_found = sum(position in found for position, found in zip(truth, exhaustive))
+    same = sum(sorted(x) == sorted(y) for x, y in zip(blocked, exhaustive))
+    print(f'{args.users} users with one typo against {args.hr_rows} HR rows')
+    print(f'exhaustive: {exhaustive_seconds:.2f} s, true row found for {exhaustive_found / args.users:.1%}')
+    print(f'blocked:    {blocked_seconds:.2f} s (+{index_seconds:.2f} s index), '
+          f'true row found for {blocked_found / args.users:.1%} ({exhaustive_seconds / blocked_seconds:.1f}x)')
+    print(f'same candidates as exhaustive: {same / args.users:.1%}')
+
+
+if __name__ == '__main__':
+    main()
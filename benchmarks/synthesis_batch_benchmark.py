@@ -0,0 +1,147 @@
+"""
+Assess First synthesises written per candidate (previous parse_synthesis_json + DataFrame + to_sql for every
+candidate) against AssessFirstScetl.write_synthesis_batch on synthetic synthesis payloads, local sqlite file.
+Run from repository root: python benchmarks/synthesis_batch_benchmark.py --candidates 3000 --batch-size 200
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scetl import AssessFirstScetl
+
+config = {
+    'urls': {},
+    'tables': {
+        'synthesises': {
+            'table_name': 'assess_first_synthesises',
+            'columns': [
+                {'name': 'uuid', 'type': 'VARCHAR'},
+                {'name': 'block', 'type': 'VARCHAR'},
+                {'name': 'item', 'type': 'VARCHAR'},
+                {'name': 'value', 'type': 'TEXT'},
+                {'name': 'additional_value', 'type': 'VARCHAR'},
+                {'name': 'last_update', 'type': 'DATETIME'}
+            ]
+        }
+    }
+}
+
+
+def make_synthesis_json(random_state):
+    """
+    Payload with every kind of synthesis param: lists, strings, squares, value/description dicts and others
+    """
+    words = ['leader', 'creative', 'methodical', 'curious', 'patient', 'direct', 'calm', 'ambitious']
+    return {
+        'personality': {
+            'traits': random_state.sample(words, 4),
+            'summary': ' '.join(random_state.sample(words, 6)),
+            'good_squares': {f'sq{i}': {'label': random_state.choice(words)} for i in range(4)},
+            'bad_squares': {f'sq{i}': {'label': random_state.choice(words)} for i in range(4, 7)},
+            'score': random_state.random()
+        },
+        'motivations': {
+            'drivers': random_state.sample(words, 3),
+            'decision': {'value': random_state.choice(words), 'description': 'decision making style'},
+            'learning': {'value': random_state.choice(words), 'description': 'learning style'}
+        },
+        'aptitudes': {
+            'privileged': {'value': random_state.choice(words), 'description': 'privileged aptitude'},
+            'level': random_state.choice(words)
+        },
+        'empty_block': None
+    }
+
+
+def parse_synthesis_json(synthesis_json):
+    """
+    Single candidate parser as it was before batching
+    """
+    results_list = []
+    for block in synthesis_json:
+        if synthesis_json[block] is not None:
+            for param in synthesis_json[block]:
+                if type(synthesis_json[block][param]) is list:
+                    for list_item in synthesis_json[block][param]:
+                        results_list.append({'block': block, 'item': param, 'value': list_item,
+                                             'additional_value': None})
+                elif type(synthesis_json[block][param]) is str:
+                    results_list.append({'block': block, 'item': param, 'value': synthesis_json[block][param],
+                                         'additional_value': None})
+                elif param in ['bad_squares', 'good_squares']:
+                    for square in synthesis_json[block][param].keys():
+                        results_list.append({'block': block, 'item': param,
+                                             'value': synthesis_json[block][param][square]['label'],
+                                             'additional_value': square})
+                elif param in ['privileged', 'decision', 'learning']:
+                    results_list.append({'block': block, 'item': param,
+                                         'value': synthesis_json[block][param]['value'],
+                                         'additional_value': synthesis_json[block][param]['description']})
+                else:
+                    results_list.append({'block': block, 'item': param, 'value': None, 'additional_value': None})
+    return results_list
+
+
+def write_per_candidate(scetl, synthesis_jsons):
+    """
+    Previous update_candidate_synthesis write path: delete, DataFrame and to_sql for every candidate
+    """
+    table_name, table_cols = scetl.get_table_params('synthesises')
+    for uuid, synthesis_json in synthesis_jsons.items():
+        with scetl.engine.connect() as connection:
+            connection.execute(f"DELETE FROM {table_name} WHERE uuid = '{uuid}'")
+        df = pd.DataFrame(parse_synthesis_json(synthesis_json))
+        df['last_update'] = datetime.utcnow()
+        df['uuid'] = uuid
+        df = scetl.apply_data_types('synthesises', df[table_cols])
+        df.to_sql(table_name, con=scetl.engine, if_exists='append', index=False)
+
+
+def write_batched(scetl, synthesis_jsons, batch_size):
+    uuids = list(synthesis_jsons.keys())
+    for i in range(0, len(uuids), batch_size):
+        scetl.write_synthesis_batch({x: synthesis_jsons[x] for x in uuids[i:i + batch_size]})
+
+
+def read_rows(engine):
+    query = 'SELECT uuid, block, item, value, additional_value FROM assess_first_synthesises'
+    return pd.read_sql(query, con=engine).sort_values(['uuid', 'block', 'item', 'value']).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--candidates', type=int, default=3000)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random_state = random.Random(args.seed)
+    synthesis_jsons = {f'uuid{i}': make_synthesis_json(random_state) for i in range(args.candidates)}
+    rows = len(AssessFirstScetl.flatten_synthesis_jsons(synthesis_jsons)['uuid'])
+
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        for name, write in [('per candidate', write_per_candidate),
+                            ('batched', lambda x, y: write_batched(x, y, args.batch_size))]:
+            engine = create_engine(f'sqlite:///{os.path.join(path, name.replace(" ", "_"))}.sqlite')
+            scetl = AssessFirstScetl(config, engine)
+            scetl.check_tables()
+            started_at = time.monotonic()
+            write(scetl, synthesis_jsons)
+            seconds = time.monotonic() - started_at
+            results[name] = read_rows(engine)
+            print(f'{name:14} {seconds:.2f} s, {rows / seconds:.0f} rows/s')
+            engine.dispose()
+    print(f'{args.candidates} candidates, {rows} rows, batch size {args.batch_size}, '
+          f'same rows written: {results["per candidate"].equals(results["batched"])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import logging
+import pyarrow as pa
+from datetime import datetime
+from sqlalchemy import text, MetaData, Table, Column, Index
+from arrow_records import create_table, insert_table
+
+# ----------------------------------------------------------------------------------------
+# Bulk loader: batched multi-row inserts into staging table, then atomic swap with target
+# ----------------------------------------------------------------------------------------
+
+
+class BulkLoader:
+
+    # max bound parameters per statement: sql server allows 2100, old sqlite builds 999
+    param_limits = {'mssql': 2000, 'sqlite': 900}
+
+    # sql server does not allow more than 1000 rows in one VALUES clause
+    max_batch_rows = 1000
+
+    def __init__(self, engine, target_name, indexes=None, schema=None):
+        """
+        Loads table to database so that readers never see it empty or partially loaded
+        Works with sql server (sp_rename) and any database supporting ALTER TABLE RENAME (sqlite as stand-in)
+        :param engine: sqlalchemy engine of target database
+        :param target_name: target table name without schema, e.g. eduson_users
+        :param indexes: list of column lists to build indexes on before swap
+        :param schema: schema of target table, e.g. hr, None for default schema
+        """
+        self.engine = engine
+        self.schema = schema
+        self.target_name = target_name
+        self.staging_name = target_name + '_staging'
+        self.old_name = target_name + '_old'
+        self.indexes = indexes or []
+        self.dialect = engine.dialect.name
+        self.quote = engine.dialect.identifier_preparer.quote
+        self.connection = None
+        self.transaction = None
+        self.append = False
+        self.staging_created = False
+        self.rows = 0
+
+    def batch_rows(self, df):
+        """
+        Rows per insert statement so that bound parameters limit is not exceeded
+        :param df: DataFrame to insert
+        :return: int
+        """
+        param_limit = self.param_limits.get(self.dialect, 2000)
+        return max(1, min(self.max_batch_rows, param_limit // max(1, df.shape[1])))
+
+    def qualified(self, table_name):
+        """
+        Quoted table name with schema for sql statements
+        :param table_name: table name without schema
+        :return: string, e.g. [hr].[eduson_users] on sql server
+        """
+        if self.schema is None:
+            return self.quote(table_name)
+        return f'{self.quote(self.schema)}.{self.quote(table_name)}'
+
+    def drop_table(self, connection, table_name):
+        """
+        Drops table if it exists
+        :param connection: sqlalchemy connection
+        :param table_name: table name
+        :return: None
+        """
+        if self.engine.dialect.has_table(connection, table_name, schema=self.schema):
+            connection.execute(f'DROP TABLE {self.qualified(table_name)}')
+
+    def begin(self, append=False):
+        """
+        Starts load. In append mode rows go straight to target in one transaction, otherwise to staging table
+        :param append: True to add rows to target
+        :return: None
+        """
+        self.connection = self.engine.connect()
+        self.append = append and self.engine.dialect.has_table(self.connection, self.target_name, schema=self.schema)
+        self.rows = 0
+        self.staging_created = False
+        if self.append:
+            self.transaction = self.connection.begin()
+        else:
+            self.drop_table(self.connection, self.staging_name)
+
+    def write(self, df):
+        """
+        Inserts chunk with multi-row parameterised insert statements, arrow tables go to executemany
+        :param df: DataFrame chunk or pa.Table
+        :return: None
+        """
+        table_name = self.target_name if self.append else self.staging_name
+        if isinstance(df, pa.Table):
+            if not self.append and not self.staging_created:
+                create_table(self.connection, table_name, df, self.schema)
+                self.staging_created = True
+            self.rows += insert_table(self.connection, table_name, df, self.max_batch_rows, self.schema)
+            return
+        if not self.append and not self.staging_created:
+            df.head(0).to_sql(table_name, con=self.connection, schema=self.schema, index=False, if_exists='replace')
+            self.staging_created = True
+        df.to_sql(table_name, con=self.connection, schema=self.schema, index=False, if_exists='append',
+                  method='multi', chunksize=self.batch_rows(df))
+        self.rows += df.shape[0]
+
+    def create_indexes(self):
+        """
+        Builds indexes on staging table before it becomes visible
+        :return: None
+        """
+        # index names are unique per database in sqlite, target keeps indexes of previous load until swap
+        suffix = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+        for columns in self.indexes:
+            index_name = f'ix_{self.target_name}_{"_".join(columns)}_{suffix}'.replace('.', '_')
+            # sqlalchemy puts schema where dialect expects it (table name on sql server, index name on sqlite)
+            table = Table(self.staging_name, MetaData(), *[Column(x) for x in columns], schema=self.schema)
+            Index(index_name, *[table.c[x] for x in columns]).create(self.connection)
+
+    def swap(self):
+        """
+        Replaces target with staging in one transaction
+        :return: None
+        """
+        with self.connection.begin():
+            target_exists = self.engine.dialect.has_table(self.connection, self.target_name, schema=self.schema)
+            self.drop_table(self.connection, self.old_name)
+            if self.dialect == 'mssql':
+                # sp_rename takes quoted name with schema and new name as is - without schema and brackets
+                query = text('EXEC sp_rename :old_name, :new_name')
+                if target_exists:
+                    self.connection.execute(query, old_name=self.qualified(self.target_name), new_name=self.old_name)
+                self.connection.execute(query, old_name=self.qualified(self.staging_name), new_name=self.target_name)
+            else:
+                if target_exists:
+                    self.connection.execute(
+                        f'ALTER TABLE {self.qualified(self.target_name)} RENAME TO {self.quote(self.old_name)}')
+                self.connection.execute(
+                    f'ALTER TABLE {self.qualified(self.staging_name)} RENAME TO {self.quote(self.target_name)}')
+            if target_exists:
+                self.connection.execute(f'DROP TABLE {self.qualified(self.old_name)}')
+
+    def finish(self):
+        """
+        Commits appended rows or builds indexes and swaps staging with target
+        :return: None
+        """
+        try:
+            if self.append:
+                self.transaction.commit()
+            elif self.staging_created:
+                self.create_indexes()
+                self.swap()
+            logging.info(f'Loaded {self.rows} rows to {self.qualified(self.target_name)}')
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def abort(self):
+        """
+        Rolls back appended rows or drops staging table, target stays untouched
+        :return: None
+        """
+        if self.connection is None:
+            return
+        try:
+            if self.append:
+                self.transaction.rollback()
+            else:
+                self.drop_table(self.connection, self.staging_name)
+        finally:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,194 @@
+import logging
+import pandas as pd
+import pyarrow.parquet as pq
+from sqlalchemy import inspect
+from datetime import datetime
+from storage import get_history_store
+from fingerprints import FingerprintStore
+
+# ------------------------------------------------------------------------
+# Collapses repeated snapshots in history tables into validity intervals
+# ------------------------------------------------------------------------
+
+
+class HistoryCompactor:
+
+    state_table = 'scetl_compaction_state'
+
+    # same "still valid" date as for active employees in HR views
+    open_interval_end = '2100-12-31 00:00:00.000000'
+
+    def __init__(self, table_dict, engine):
+        """
+        Compactor for one history table. Table config needs "compaction": {"entity_columns": [...]}
+        Optional "compared_columns" - columns to compare snapshots by, all except entity and last_update by default
+        :param table_dict: table dict from config dict
+        :param engine: sqlalchemy engine made from create_engine
+        """
+        self.table_dict = table_dict
+        self.engine = engine
+        self.table_name = table_dict['table_name']
+        self.intervals_table = self.table_name + '_intervals'
+        self.view_name = 'v_' + self.table_name + '_history'
+        self.store = get_history_store(table_dict)
+        self.entity_columns = list(table_dict['compaction']['entity_columns'])
+        if 'tenant' not in self.entity_columns and 'tenant' in self.get_table_columns():
+            # tenants share table, same id of two tenants is two entities
+            self.entity_columns = ['tenant'] + self.entity_columns
+        table_cols = [x['name'] for x in table_dict['columns']]
+        self.column_types = {x['name']: x['type'] for x in table_dict['columns']}
+        self.compared_columns = table_dict['compaction'].get(
+            'compared_columns',
+            [x for x in table_cols if x not in self.entity_columns and x != 'last_update']
+        )
+
+    def get_table_columns(self):
+        """
+        Gets columns actually stored in history table, e.g. tenant column that is not in table config
+        :return: list of column names, empty if table does not exist yet
+        """
+        if self.store is not None:
+            files = self.store.select_files()
+            return pq.read_schema(files[0]).names if files else []
+        if not inspect(self.engine).has_table(self.table_name):
+            return []
+        return [x['name'] for x in inspect(self.engine).get_columns(self.table_name)]
+
+    def get_watermark(self):
+        """
+        Gets last_update of the newest snapshot already compacted
+        :return: datetime or None if table was never compacted
+        """
+        if not inspect(self.engine).has_table(self.state_table):
+            return None
+        with self.engine.connect() as connection:
+            query = f"SELECT MAX(last_compacted) FROM {self.state_table} WHERE table_name = '{self.table_name}'"
+            watermark = connection.execute(query).fetchone()[0]
+        return pd.to_datetime(watermark, yearfirst=True)
+
+    @staticmethod
+    def sql_ts(ts):
+        """
+        Formats datetime the same way pandas writes it to sqlite, so that text comparison works
+        :param ts: datetime
+        :return: string
+        """
+        return pd.to_datetime(ts).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    def get_new_snapshots(self, watermark):
+        """
+        Reads only snapshots newer than watermark. For parquet tables older partitions are not touched at all
+        :param watermark: result of get_watermark
+        :return: DataFrame of new snapshots
+        """
+        columns = self.entity_columns + self.compared_columns + ['last_update']
+        if self.store is not None:
+            return self.store.read(columns=columns, last_update_from=watermark)
+        query = f'SELECT {", ".join(columns)} FROM {self.table_name}'
+        if watermark is None:
+            return pd.read_sql(query, con=self.engine, parse_dates=['last_update'])
+        query += ' WHERE last_update > ?'
+        return pd.read_sql(query, con=self.engine, params=(self.sql_ts(watermark),), parse_dates=['last_update'])
+
+    def get_open_intervals(self):
+        """
+        Reads intervals that are still valid (valid_to is null) - one per entity at most
+        :return: DataFrame of open intervals
+        """
+        if not inspect(self.engine).has_table(self.intervals_table):
+            return pd.DataFrame(columns=self.entity_columns + self.compared_columns + ['row_hash', 'valid_from'])
+        query = f'SELECT * FROM {self.intervals_table} WHERE valid_to IS NULL'
+        return pd.read_sql(query, con=self.engine, parse_dates=['valid_from', 'valid_to'])
+
+    def hash_rows(self, df):
+        """
+        Hashes compared columns cast to their config types, identical snapshots get identical hashes
+        even if they were read with different dtypes (e.g. int in one run and float with NaN in another)
+        :param df: DataFrame of snapshots
+        :return: pd.Series of hashes as strings
+        """
+        return FingerprintStore.hash_frame(df, self.compared_columns, self.column_types)
+
+    def compact(self):
+        """
+        Collapses new snapshots into intervals table. Consecutive identical snapshots of an entity become one
+        interval [valid_from, valid_to). Open intervals from previous runs are extended or closed.
+        :return: None, writes results to db
+        """
+        watermark = self.get_watermark()
+        df_new = self.get_new_snapshots(watermark)
+        if df_new.shape[0] == 0:
+            logging.info(f'Nothing to compact in {self.table_name}')
+            return
+        new_watermark = df_new['last_update'].max()
+        df_new['row_hash'] = self.hash_rows(df_new)
+        df_new = df_new.rename(columns={'last_update': 'valid_from'})
+
+        df_open = self.get_open_intervals()
+        interval_cols = self.entity_columns + self.compared_columns + ['row_hash', 'valid_from']
+        df_open = df_open[interval_cols]
+        entity_index = pd.MultiIndex.from_frame(df_new[self.entity_columns].astype(str)).unique()
+        open_affected = pd.MultiIndex.from_frame(df_open[self.entity_columns].astype(str)).isin(entity_index)
+
+        df = pd.concat([df_open[open_affected], df_new[interval_cols]], ignore_index=True)
+        df['order'] = range(df.shape[0])
+        df = df.sort_values(self.entity_columns + ['valid_from', 'order'])
+        previous_hash = df.groupby(self.entity_columns, sort=False)['row_hash'].shift()
+        df = df[previous_hash.isnull() | (df['row_hash'] != previous_hash)].copy()
+        df['valid_to'] = df.groupby(self.entity_columns, sort=False)['valid_from'].shift(-1)
+        df = df.drop(columns=['order'])
+
+        df_unaffected = df_open[~open_affected].copy()
+        df_unaffected['valid_to'] = pd.NaT
+        logging.info(f'Compacted {df_new.shape[0]} snapshots of {self.table_name} into {df.shape[0]} intervals')
+        with self.engine.begin() as connection:
+            if self.engine.dialect.has_table(connection, self.intervals_table):
+                connection.execute(f'DELETE FROM {self.intervals_table} WHERE valid_to IS NULL')
+            pd.concat([df_unaffected, df], ignore_index=True).to_sql(
+                self.intervals_table, con=connection, if_exists='append', index=False)
+            pd.DataFrame([{
+                'table_name': self.table_name,
+                'last_compacted': new_watermark,
+                'last_update': datetime.utcnow()
+            }]).to_sql(self.state_table, con=connection, if_exists='append', index=False)
+        self.create_view()
+
+    def create_view(self):
+        """
+        View keeps point-in-time semantics of history table:
+        state as of ts is WHERE valid_from <= ts AND valid_to > ts, last_update is time the state was first seen
+        :return: None, creates view in db
+        """
+        columns = ', '.join(self.entity_columns + self.compared_columns)
+        with self.engine.connect() as connection:
+            connection.execute(f'DROP VIEW IF EXISTS {self.view_name}')
+            connection.execute(f'''
+                CREATE VIEW {self.view_name} AS
+                SELECT {columns}, valid_from AS last_update, valid_from,
+                    COALESCE(valid_to, '{self.open_interval_end}') AS valid_to
+                FROM {self.intervals_table}
+            ''')
+
+    def as_of(self, ts):
+        """
+        Gets state of all entities as it was on ts
+        :param ts: datetime
+        :return: DataFrame, one row per entity
+        """
+        query = f'SELECT * FROM {self.view_name} WHERE valid_from <= ? AND valid_to > ?'
+        return pd.read_sql(query, con=self.engine, params=(self.sql_ts(ts), self.sql_ts(ts)),
+                           parse_dates=['last_update', 'valid_from', 'valid_to'])
+
+
+def compact_tables(configs, engine):
+    """
+    Runs compaction for all tables with "compaction" in their configs
+    :param configs: full configs dict
+    :param engine: sqlalchemy engine
+    :return: None, writes results to db
+    """
+    for hr_system in configs:
+        for table in configs[hr_system].get('tables', {}):
+            table_dict = configs[hr_system]['tables'][table]
+            if 'compaction' in table_dict:
+                HistoryCompactor(table_dict, engine).compact()
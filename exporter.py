@@ -0,0 +1,604 @@
+import os
+import csv
+import queue
+import logging
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime
+from sqlalchemy import create_engine, text, inspect
+from storage import get_history_store
+from bulk_loader import BulkLoader
+from arrow_records import rows_to_table, arrow_types
+
+# -------------------------------------------------------------------------------------
+# Export: every table is read once as stream of chunks and fanned out to several sinks
+# -------------------------------------------------------------------------------------
+
+
+class Sink:
+
+    def __init__(self, name):
+        """
+        Base class for export targets
+        :param name: unique sink name, watermarks are kept per sink name
+        """
+        self.name = name
+
+    def has_table(self, table_name):
+        """
+        Checks if table was already exported to this sink
+        :param table_name: table name
+        :return: Bool
+        """
+        raise NotImplementedError
+
+    def begin(self, table_name, append, table_dict=None):
+        """
+        Starts writing table
+        :param table_name: table name
+        :param append: True to add rows to existing data, False to replace it
+        :param table_dict: table dict from config dict
+        :return: None
+        """
+        raise NotImplementedError
+
+    def write(self, df):
+        """
+        Writes chunk of table
+        :param df: DataFrame chunk or pa.Table if export "record_format" is "arrow"
+        :return: None
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        Finishes writing table, data should become visible only here
+        :return: None
+        """
+        raise NotImplementedError
+
+    def abort(self):
+        """
+        Cleans up after failed export of table
+        :return: None
+        """
+        pass
+
+    @staticmethod
+    def decategorize(df):
+        """
+        Category columns can have different categories in each chunk - write them as strings
+        :param df: DataFrame chunk or pa.Table, dictionary columns of arrow tables are decoded the same way
+        :return: DataFrame without category columns
+        """
+        if isinstance(df, pa.Table):
+            columns = [
+                pa.chunked_array([x.dictionary.take(x.indices) for x in column.chunks], type=column.type.value_type)
+                if pa.types.is_dictionary(column.type) else column
+                for column in df.columns
+            ]
+            return pa.Table.from_arrays(columns, names=df.schema.names)
+        category_cols = [x for x in df.columns if df[x].dtype.name == 'category']
+        if category_cols:
+            df = df.astype({x: str for x in category_cols})
+        return df
+
+
+class CsvSink(Sink):
+
+    # rows of chunks read back from old file when it is rewritten with new columns
+    rewrite_chunk_rows = 50000
+
+    def __init__(self, path='csv_files'):
+        """
+        Writes tables to csv files in path folder
+        :param path: folder for csv files
+        """
+        super().__init__(f'csv:{path}')
+        self.path = path
+        self.file = None
+        self.write_path = None
+        self.offset = None
+
+    def has_table(self, table_name):
+        return os.path.isfile(os.path.join(self.path, table_name + '.csv'))
+
+    def begin(self, table_name, append, table_dict=None):
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        self.file_path = os.path.join(self.path, table_name + '.csv')
+        self.offset_path = self.file_path + '.offset'
+        self.recover()
+        self.file = None
+        self.write_path = None
+        self.offset = None
+        self.config_columns = [x['name'] for x in (table_dict or {}).get('columns', [])]
+        # columns of file being written, chunks are reindexed to them
+        self.header = self.read_header() if append and os.path.isfile(self.file_path) else None
+        self.append = self.header is not None
+        if not self.append:
+            # replaced table is written to temp file renamed in finish, so that readers never see partial file
+            # and failed export leaves old file as it was
+            self.write_path = self.file_path + '.tmp'
+            self.file = open(self.write_path, 'w', newline='', encoding='utf-8')
+
+    def read_header(self):
+        """
+        Columns of existing csv file
+        :return: list of column names, None if file is empty
+        """
+        with open(self.file_path, newline='', encoding='utf-8') as file:
+            header = next(csv.reader(file), None)
+        return header or None
+
+    def recover(self):
+        """
+        Cuts rows appended by export that crashed before finish or abort, their watermark was never saved
+        :return: None
+        """
+        if not os.path.isfile(self.offset_path):
+            return
+        with open(self.offset_path) as offset_file:
+            offset = int(offset_file.read())
+        if os.path.isfile(self.file_path):
+            logging.warning(f'Removing rows of unfinished export from {self.file_path}')
+            with open(self.file_path, 'r+b') as file:
+                file.truncate(offset)
+        os.remove(self.offset_path)
+
+    def open_append(self):
+        """
+        Appends to existing file in place, its size is recorded so that abort (or next export after crash)
+        cuts partial rows. Export costs only new rows, old file is not copied
+        :return: None
+        """
+        self.offset = os.path.getsize(self.file_path)
+        with open(self.offset_path, 'w') as offset_file:
+            offset_file.write(str(self.offset))
+        self.file = open(self.file_path, 'a', newline='', encoding='utf-8')
+
+    def rewrite(self, columns):
+        """
+        Starts new file with new columns (e.g. tenant added to table): old rows are copied to temp file
+        in chunks under new header, empty in new columns. Happens once per schema change
+        :param columns: list of columns of new file
+        :return: None
+        """
+        logging.info(f'Columns of {self.file_path} changed, rewriting it')
+        self.write_path = self.file_path + '.tmp'
+        self.file = open(self.write_path, 'w', newline='', encoding='utf-8')
+        pd.DataFrame(columns=columns).to_csv(self.file, index=False)
+        for df in pd.read_csv(self.file_path, dtype=str, keep_default_na=False, chunksize=self.rewrite_chunk_rows):
+            df.reindex(columns=columns).to_csv(self.file, header=False, index=False)
+        self.header = columns
+
+    def write(self, df):
+        if isinstance(df, pa.Table):
+            df = df.to_pandas()
+        if self.header is None:
+            self.header = list(df.columns)
+            pd.DataFrame(columns=self.header).to_csv(self.file, index=False)
+        elif self.file is None:
+            new_columns = [x for x in df.columns if x not in self.header]
+            if new_columns:
+                self.rewrite(self.header + new_columns)
+            else:
+                self.open_append()
+        df.reindex(columns=self.header).to_csv(self.file, header=False, index=False)
+
+    def finish(self):
+        if self.header is None:
+            # no rows - header of empty table still replaces old file
+            pd.DataFrame(columns=self.config_columns).to_csv(self.file, index=False)
+        if self.file is None:
+            # nothing appended
+            return
+        self.file.close()
+        if self.write_path is not None:
+            os.replace(self.write_path, self.file_path)
+        if self.offset is not None:
+            os.remove(self.offset_path)
+
+    def abort(self):
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+        if self.write_path is not None and os.path.isfile(self.write_path):
+            os.remove(self.write_path)
+        if self.offset is not None:
+            with open(self.file_path, 'r+b') as file:
+                file.truncate(self.offset)
+            os.remove(self.offset_path)
+
+
+class ParquetSink(Sink):
+
+    def __init__(self, path='parquet_export', compression='snappy'):
+        """
+        Writes each table to parquet folder, one file per export run
+        :param path: root folder
+        :param compression: parquet compression codec
+        """
+        super().__init__(f'parquet:{path}')
+        self.path = path
+        self.compression = compression
+        self.writer = None
+
+    def has_table(self, table_name):
+        table_path = os.path.join(self.path, table_name)
+        return os.path.isdir(table_path) and any(x.endswith('.parquet') for x in os.listdir(table_path))
+
+    def begin(self, table_name, append, table_dict=None):
+        self.table_path = os.path.join(self.path, table_name)
+        if not os.path.exists(self.table_path):
+            os.makedirs(self.table_path)
+        self.append = append
+        self.file_path = os.path.join(self.table_path, f'part-{datetime.utcnow().strftime("%Y%m%d%H%M%S%f")}.parquet')
+        self.column_types = {x['name']: x['type'] for x in (table_dict or {}).get('columns', [])}
+        self.writer = None
+
+    def get_schema(self, table=None):
+        """
+        File schema: types of config columns come from config so that they don't depend on first chunk
+        (all null column of first chunk would be written as null type), other columns keep chunk types
+        :param table: first pa.Table chunk, None if table has no rows
+        :return: pa.Schema
+        """
+        fields = [pa.field(x.name, x.type) for x in table.schema] if table is not None else \
+            [pa.field(x, pa.null()) for x in self.column_types]
+        schema = []
+        for field in fields:
+            column_type = self.column_types.get(field.name)
+            if column_type == 'CATEGORY':
+                # chunks are decategorized
+                arrow_type = pa.string()
+            elif column_type is not None and (column_type == 'DATETIME' or column_type.startswith('UNIXTIME')):
+                # unix timestamps are stored as datetimes
+                arrow_type = arrow_types['DATETIME']
+            elif column_type is not None:
+                arrow_type = arrow_types[column_type]
+            else:
+                arrow_type = pa.string() if pa.types.is_null(field.type) else field.type
+            schema.append(pa.field(field.name, arrow_type))
+        return pa.schema(schema)
+
+    def write(self, df):
+        if isinstance(df, pa.Table):
+            table = self.decategorize(df)
+        else:
+            table = pa.Table.from_pandas(self.decategorize(df), preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.file_path + '.tmp', self.get_schema(table),
+                                           compression=self.compression)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def finish(self):
+        if self.writer is None and self.append:
+            return
+        if self.writer is None:
+            # no rows - file with schema only still replaces old files
+            self.writer = pq.ParquetWriter(self.file_path + '.tmp', self.get_schema(), compression=self.compression)
+        self.writer.close()
+        if not self.append:
+            for file_name in os.listdir(self.table_path):
+                if file_name.endswith('.parquet'):
+                    os.remove(os.path.join(self.table_path, file_name))
+        os.replace(self.file_path + '.tmp', self.file_path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            if os.path.isfile(self.file_path + '.tmp'):
+                os.remove(self.file_path + '.tmp')
+
+
+class SqlSink(Sink):
+
+    def __init__(self, engine, prefix='hr.'):
+        """
+        Writes tables to another database (sql server) with BulkLoader: replaced tables are loaded to staging
+        table and swapped with target, indexes from table's "indexes" config are built before swap
+        :param engine: sqlalchemy engine of target database
+        :param prefix: prefix added to table names, part before last dot is schema: 'hr.' loads to schema hr,
+        'hr_' to tables hr_<table> of default schema
+        """
+        super().__init__(f'sql:{engine.url.host or engine.url.database}/{prefix}')
+        self.engine = engine
+        schema, _, self.prefix = prefix.rpartition('.')
+        self.schema = schema or None
+        self.loader = None
+
+    def has_table(self, table_name):
+        return inspect(self.engine).has_table(self.prefix + table_name, schema=self.schema)
+
+    def begin(self, table_name, append, table_dict=None):
+        indexes = (table_dict or {}).get('indexes', [])
+        self.loader = BulkLoader(self.engine, self.prefix + table_name, indexes, self.schema)
+        self.loader.begin(append)
+
+    def write(self, df):
+        self.loader.write(self.decategorize(df))
+
+    def finish(self):
+        self.loader.finish()
+
+    def abort(self):
+        if self.loader is not None:
+            self.loader.abort()
+
+
+def make_sinks(export_config, default_sql_engine=None):
+    """
+    Makes sinks from "sinks" list of export config, e.g.
+    [{"type": "csv", "path": "csv_files"}, {"type": "parquet"}, {"type": "sql", "url": "...", "prefix": "hr."}]
+    :param export_config: "export" dict from configs
+    :param default_sql_engine: engine for sql sink without url
+    :return: list of sinks
+    """
+    sinks = []
+    for sink_config in export_config.get('sinks', [{'type': 'csv'}, {'type': 'sql'}]):
+        if sink_config['type'] == 'csv':
+            sinks.append(CsvSink(sink_config.get('path', 'csv_files')))
+        elif sink_config['type'] == 'parquet':
+            sinks.append(ParquetSink(sink_config.get('path', 'parquet_export'),
+                                     sink_config.get('compression', 'snappy')))
+        elif sink_config['type'] == 'sql':
+            engine = create_engine(sink_config['url']) if 'url' in sink_config else default_sql_engine
+            sinks.append(SqlSink(engine, sink_config.get('prefix', 'hr.')))
+        else:
+            logging.warning(f'Unknown sink type {sink_config["type"]}')
+    return sinks
+
+
+class SinkWorker(threading.Thread):
+
+    def __init__(self, sink, queue_size, table_name, append, table_dict):
+        """
+        Thread feeding one sink from bounded queue. Full queue blocks reader - that's backpressure
+        Sink is started in the thread itself since db connections can't be shared between threads in sqlite
+        :param sink: Sink
+        :param queue_size: max chunks waiting for sink
+        :param table_name: table name
+        :param append: passed to sink.begin
+        :param table_dict: table dict from config dict
+        """
+        super().__init__(daemon=True)
+        self.sink = sink
+        self.begin_args = (table_name, append, table_dict)
+        self.chunks = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.rows = 0
+        self.max_last_update = None
+
+    def run(self):
+        try:
+            self.sink.begin(*self.begin_args)
+        except Exception as e:
+            logging.exception(f'Sink {self.sink.name} failed')
+            self.error = e
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                # keep consuming so that reader is never blocked by failed sink
+                continue
+            try:
+                self.sink.write(chunk)
+                rows, chunk_max = self.get_chunk_stats(chunk)
+                self.rows += rows
+                if chunk_max is not None:
+                    if self.max_last_update is None or chunk_max > self.max_last_update:
+                        self.max_last_update = chunk_max
+            except Exception as e:
+                logging.exception(f'Sink {self.sink.name} failed')
+                self.error = e
+        if self.error is None:
+            try:
+                self.sink.finish()
+            except Exception as e:
+                logging.exception(f'Sink {self.sink.name} failed')
+                self.error = e
+        if self.error is not None:
+            self.sink.abort()
+
+    @staticmethod
+    def get_chunk_stats(chunk):
+        """
+        Rows and max last_update of chunk
+        :param chunk: DataFrame or pa.Table
+        :return: tuple of number of rows and pd.Timestamp or None
+        """
+        if isinstance(chunk, pa.Table):
+            if 'last_update' not in chunk.schema.names:
+                return chunk.num_rows, None
+            values = [x for x in chunk.column('last_update').to_pylist() if x is not None]
+            return chunk.num_rows, pd.Timestamp(max(values)) if values else None
+        if 'last_update' not in chunk.columns or chunk.shape[0] == 0:
+            return chunk.shape[0], None
+        return chunk.shape[0], chunk['last_update'].max()
+
+
+class TableExporter:
+
+    watermarks_table = 'scetl_export_watermarks'
+
+    def __init__(self, engine, sinks, chunk_size=50000, queue_size=4, record_format='pandas'):
+        """
+        Reads tables from local database (or parquet stores) once and writes them to all sinks concurrently
+        :param engine: sqlalchemy engine of local database
+        :param sinks: list of Sink
+        :param chunk_size: rows per chunk
+        :param queue_size: max chunks buffered per sink
+        :param record_format: 'arrow' reads database tables to arrow tables, see arrow_records.py
+        """
+        self.engine = engine
+        self.sinks = sinks
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.record_format = record_format
+
+    def get_watermarks(self, table_name):
+        """
+        Max last_update exported to each sink for table
+        :param table_name: table name
+        :return: dict where key is sink name and value is datetime
+        """
+        if not inspect(self.engine).has_table(self.watermarks_table):
+            return {}
+        with self.engine.connect() as connection:
+            query = text(f'SELECT sink, MAX(watermark) FROM {self.watermarks_table} '
+                         f'WHERE table_name = :table_name GROUP BY sink')
+            rows = connection.execute(query, table_name=table_name).fetchall()
+        return {x[0]: pd.to_datetime(x[1], yearfirst=True) for x in rows}
+
+    def save_watermark(self, sink, table_name, watermark, rows):
+        """
+        Saves sink's watermark for table
+        :return: None, writes to db
+        """
+        pd.DataFrame([{
+            'sink': sink.name, 'table_name': table_name, 'watermark': watermark, 'rows': rows,
+            'last_update': datetime.utcnow()
+        }]).to_sql(self.watermarks_table, con=self.engine, index=False, if_exists='append')
+
+    def get_max_last_update(self, table_dict):
+        """
+        Max last_update of table without reading it
+        :param table_dict: table dict from config dict
+        :return: datetime or None
+        """
+        store = get_history_store(table_dict)
+        if store is not None:
+            return store.get_last_update_ts()
+        with self.engine.connect() as connection:
+            query = f'SELECT MAX(last_update) FROM {table_dict["table_name"]}'
+            return pd.to_datetime(connection.execute(query).fetchone()[0], yearfirst=True)
+
+    def iter_chunks(self, table_dict, last_update_from):
+        """
+        Reads table as chunks
+        :param table_dict: table dict from config dict
+        :param last_update_from: read only rows with last_update above it, None for all
+        :return: generator of DataFrames
+        """
+        store = get_history_store(table_dict)
+        if store is not None:
+            for df in store.iter_chunks(last_update_from=last_update_from):
+                yield df
+            return
+        query = f'SELECT * FROM {table_dict["table_name"]}'
+        params = None
+        if last_update_from is not None:
+            query += ' WHERE last_update > ?'
+            params = (last_update_from.strftime('%Y-%m-%d %H:%M:%S.%f'),)
+        if self.record_format == 'arrow':
+            # rows go from cursor straight to typed arrow columns
+            with self.engine.connect() as connection:
+                result = connection.execute(query, params or ())
+                names = list(result.keys())
+                while True:
+                    rows = result.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+                    yield rows_to_table([tuple(x) for x in rows], names, table_dict)
+            return
+        for df in pd.read_sql(query, con=self.engine, params=params, chunksize=self.chunk_size,
+                              parse_dates=self.get_datetime_columns(table_dict)):
+            yield df
+
+    @staticmethod
+    def filter_chunk(chunk, watermark):
+        """
+        Rows of chunk newer than sink's watermark
+        :param chunk: DataFrame or pa.Table
+        :param watermark: datetime or None
+        :return: chunk itself if watermark is None, else DataFrame
+        """
+        if watermark is None:
+            return chunk
+        if isinstance(chunk, pa.Table):
+            chunk = chunk.to_pandas()
+        return chunk[chunk['last_update'] > watermark]
+
+    @staticmethod
+    def has_last_update(table_dict):
+        return 'last_update' in [x['name'] for x in table_dict['columns']]
+
+    @staticmethod
+    def get_datetime_columns(table_dict):
+        """
+        Columns stored as datetimes (DATETIME and UNIXTIME_* types), read_sql returns them as strings from sqlite
+        :param table_dict: table dict from config dict
+        :return: list of column names
+        """
+        return [x['name'] for x in table_dict['columns'] if x['type'] == 'DATETIME' or x['type'].startswith('UNIXTIME')]
+
+    def export_table(self, table_dict):
+        """
+        Exports one table to all sinks. Append-only tables ("append_only": true or parquet storage) are exported
+        incrementally from each sink's watermark, other tables are rewritten if they changed since last export
+        :param table_dict: table dict from config dict
+        :return: None, writes to sinks
+        """
+        table_name = table_dict['table_name']
+        if get_history_store(table_dict) is None and not inspect(self.engine).has_table(table_name):
+            logging.info(f'No table {table_name}, skipping export')
+            return
+        append_only = table_dict.get('append_only', table_dict.get('storage') == 'parquet')
+        watermarks = self.get_watermarks(table_name) if self.has_last_update(table_dict) else {}
+        max_last_update = self.get_max_last_update(table_dict) if self.has_last_update(table_dict) else None
+
+        sink_watermarks = {}
+        for sink in self.sinks:
+            watermark = watermarks.get(sink.name) if sink.has_table(table_name) else None
+            if watermark is not None and max_last_update is not None and watermark >= max_last_update:
+                logging.info(f'{table_name} has no changes for {sink.name}')
+                continue
+            sink_watermarks[sink] = watermark if append_only else None
+        if not sink_watermarks:
+            return
+
+        read_from = None
+        if append_only and all(x is not None for x in sink_watermarks.values()):
+            read_from = min(sink_watermarks.values())
+        logging.info(f'Exporting {table_name} to {", ".join([x.name for x in sink_watermarks])}')
+
+        workers = {}
+        for sink, watermark in sink_watermarks.items():
+            workers[sink] = SinkWorker(sink, self.queue_size, table_name, watermark is not None, table_dict)
+            workers[sink].start()
+        try:
+            for df in self.iter_chunks(table_dict, read_from):
+                for sink, worker in workers.items():
+                    watermark = sink_watermarks[sink]
+                    worker.chunks.put(self.filter_chunk(df, watermark))
+        except Exception as e:
+            # sinks should not publish partially read table
+            for worker in workers.values():
+                worker.error = worker.error or e
+            raise
+        finally:
+            for worker in workers.values():
+                worker.chunks.put(None)
+            for worker in workers.values():
+                worker.join()
+
+        for sink, worker in workers.items():
+            if worker.error is not None:
+                logging.warning(f'Export of {table_name} to {sink.name} failed: {worker.error}')
+            elif self.has_last_update(table_dict):
+                watermark = worker.max_last_update or sink_watermarks[sink] or max_last_update
+                self.save_watermark(sink, table_name, watermark, worker.rows)
+            logging.info(f'Exported {worker.rows} rows of {table_name} to {sink.name}')
+
+    def export(self, configs):
+        """
+        Exports all tables from configs
+        :param configs: full configs dict
+        :return: None, writes to sinks
+        """
+        for hr_system in configs:
+            for table in configs[hr_system].get('tables', {}):
+                self.export_table(configs[hr_system]['tables'][table])
@@ -0,0 +1,102 @@
+import json
+import hashlib
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import text, bindparam, inspect
+
+# ---------------------------------------------------------------
+# Content hashes of entities to find out what really has changed
+# ---------------------------------------------------------------
+
+
+class FingerprintStore:
+
+    def __init__(self, engine, table_name, key_column, extra_columns=None):
+        """
+        Keeps one fingerprint (and optionally some extra values) per entity in database table
+        :param engine: sqlalchemy engine made from create_engine
+        :param table_name: table to keep fingerprints in
+        :param key_column: name of entity key column (user_id, uuid)
+        :param extra_columns: list of additional columns stored along with fingerprint
+        """
+        self.engine = engine
+        self.table_name = table_name
+        self.key_column = key_column
+        self.extra_columns = extra_columns or []
+
+    @staticmethod
+    def hash_payload(payload):
+        """
+        Hashes any json serializable object regardless of keys order
+        :param payload: python dict or list
+        :return: md5 hex digest
+        """
+        return hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cast_column(column, column_type):
+        """
+        Casts column to its config type, so that same value gets same string however it was loaded:
+        int or float with NaN (1 and 1.0), datetime or text from sqlite, string or None
+        :param column: pd.Series
+        :param column_type: type from table config (INT, NUMERIC, DATETIME, VARCHAR, ...), None keeps column
+        :return: pd.Series
+        """
+        if column_type in ['INT', 'NUMERIC']:
+            return pd.to_numeric(column, errors='coerce').astype(float)
+        if column_type in ['DATETIME', 'UNIXTIME_MS', 'UNIXTIME_S']:
+            if column_type != 'DATETIME' and pd.api.types.is_numeric_dtype(column):
+                return pd.to_datetime(column, unit='ms' if column_type == 'UNIXTIME_MS' else 's')
+            column = pd.to_datetime(column, yearfirst=True)
+            return column.dt.tz_localize(None) if column.dt.tz is not None else column
+        if column_type in ['VARCHAR', 'TEXT', 'CATEGORY']:
+            return column.astype(object).where(column.notnull(), None).map(lambda x: x if x is None else str(x))
+        return column
+
+    @staticmethod
+    def hash_frame(df, columns, column_types=None):
+        """
+        Hashes each row of df by selected columns
+        :param df: DataFrame
+        :param columns: list of columns to hash
+        :param column_types: dict of column name and type from table config, columns are cast to them first
+        :return: pd.Series of hashes as strings, same index as df
+        """
+        df = df[columns]
+        if column_types:
+            df = pd.DataFrame({x: FingerprintStore.cast_column(df[x], column_types.get(x)) for x in columns},
+                              index=df.index)
+        return pd.util.hash_pandas_object(df.astype(str), index=False).astype(str)
+
+    def load(self):
+        """
+        Loads stored fingerprints
+        :return: dict where key is entity key and value is dict with fingerprint and extra columns
+        """
+        if not inspect(self.engine).has_table(self.table_name):
+            return {}
+        columns = [self.key_column, 'fingerprint'] + self.extra_columns
+        with self.engine.connect() as connection:
+            query = f'SELECT {", ".join(columns)} FROM {self.table_name}'
+            rows = connection.execute(query).fetchall()
+        return {row[0]: dict(zip(columns[1:], row[1:])) for row in rows}
+
+    def save(self, fingerprints):
+        """
+        Upserts fingerprints by key
+        :param fingerprints: dict in the same format as result of load
+        :return: None, writes results to db
+        """
+        if not fingerprints:
+            return
+        df = pd.DataFrame([{self.key_column: key, **values} for key, values in fingerprints.items()])
+        df['last_update'] = datetime.utcnow()
+        with self.engine.begin() as connection:
+            if self.engine.dialect.has_table(connection, self.table_name):
+                keys = [x.item() if hasattr(x, 'item') else x for x in fingerprints.keys()]
+                query = text(f'DELETE FROM {self.table_name} WHERE {self.key_column} IN :keys')
+                query = query.bindparams(bindparam('keys', expanding=True))
+                # sqlite has limit on number of variables in one statement
+                for i in range(0, len(keys), 500):
+                    connection.execute(query, keys=keys[i:i + 500])
+            df.to_sql(self.table_name, con=connection, if_exists='append', index=False)
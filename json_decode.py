@@ -0,0 +1,149 @@
+import json
+import time
+from metrics import run_metrics
+
+# ------------------------------------------------------------------------------------------
+# JSON decode layer: bytes straight to objects with fastest installed backend, item streaming
+# ------------------------------------------------------------------------------------------
+
+# optional faster backends, standard json is used if none is installed
+try:
+    import orjson as json_backend
+except ImportError:
+    try:
+        import ujson as json_backend
+    except ImportError:
+        json_backend = json
+
+# optional streaming parser (ijson>=3.1), without it iter_items decodes whole response
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# peak memory is taken from max resident set size, not available on windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+backend_name = json_backend.__name__
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of the process
+    :return: megabytes or None if platform does not report it
+    """
+    if resource is None:
+        return None
+    # linux reports kilobytes
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def record_decode(mode, started_at, peak_before, size=None):
+    """
+    Adds decode time, size and peak memory to run metrics, section "json_decode"
+    :param mode: 'full' or 'stream'
+    :param started_at: time.monotonic() before decode
+    :param peak_before: get_peak_rss_mb() before decode
+    :param size: bytes decoded if known
+    :return: None
+    """
+    run_metrics.add('json_decode', f'{mode}_responses')
+    run_metrics.add('json_decode', f'{mode}_seconds', round(time.monotonic() - started_at, 4))
+    if size is not None:
+        run_metrics.add('json_decode', f'{mode}_bytes', size)
+    run_metrics.record('json_decode', 'backend', backend_name)
+    run_metrics.record('json_decode', 'streaming', ijson is not None)
+    peak_after = get_peak_rss_mb()
+    if peak_after is not None:
+        run_metrics.record('json_decode', 'peak_rss_mb', peak_after)
+        run_metrics.add('json_decode', 'peak_rss_growth_mb', round(peak_after - peak_before, 1))
+
+
+def loads(data):
+    """
+    Decodes json bytes or string with fastest installed backend
+    :param data: bytes or str
+    :return: python object
+    """
+    started_at = time.monotonic()
+    peak_before = get_peak_rss_mb()
+    result = json_backend.loads(data)
+    record_decode('full', started_at, peak_before, len(data))
+    return result
+
+
+def decode_response(response):
+    """
+    Replacement for response.json(): decodes raw bytes without making text copy of the body first
+    :param response: requests.Response
+    :return: python object
+    """
+    return loads(response.content)
+
+
+def flatten_scalars(obj, prefix, skip_key, meta):
+    """
+    Puts scalar values of nested dicts to meta under dotted keys, e.g. 'paging.total'
+    :param obj: python object
+    :param prefix: dotted path of obj
+    :param skip_key: top level key of items array that is not copied
+    :param meta: dict to fill
+    :return: None
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if not prefix and key == skip_key:
+                continue
+            flatten_scalars(value, f'{prefix}.{key}' if prefix else key, skip_key, meta)
+    elif not isinstance(obj, list):
+        meta[prefix] = obj
+
+
+def iter_items(response, path, meta=None):
+    """
+    Yields elements of top level array (e.g. 'Items', 'elements', 'data', 'courses') one at a time.
+    With ijson items are parsed straight from raw stream so whole body and object tree never sit in memory,
+    response should be made with stream=True. Without ijson whole response is decoded first
+    :param response: requests.Response
+    :param path: top level key of array
+    :param meta: dict to fill with scalar values outside of array under dotted keys, e.g. 'paging.total'.
+    Filled when generator is exhausted
+    :return: generator of python objects
+    """
+    meta = {} if meta is None else meta
+    started_at = time.monotonic()
+    peak_before = get_peak_rss_mb()
+    if ijson is None:
+        result = decode_response(response)
+        flatten_scalars(result, '', path, meta)
+        yield from result.get(path) or []
+        return
+
+    response.raw.decode_content = True
+    item_prefix = f'{path}.item'
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(response.raw, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                if depth == 0:
+                    yield builder.value
+                    builder = None
+        elif prefix == item_prefix and event in ('start_map', 'start_array'):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+        elif prefix == item_prefix:
+            yield value
+        elif event in ('string', 'number', 'boolean', 'null') and prefix.split('.')[0] != path \
+                and 'item' not in prefix.split('.'):
+            meta[prefix] = value
+    response.close()
+    record_decode('stream', started_at, peak_before)
@@ -1,14 +1,65 @@
 import pandas as pd
 from datetime import datetime
 import os
+import json
+import hashlib
 import logging
+import multiprocessing
+from collections import Counter
+from sqlalchemy import text, bindparam, inspect
+from openpyxl import Workbook, load_workbook
 from transliterate import translit
+from profiler import profiler
+from memory_budget import memory_budget
+
+# (mapper, df_hr, lookup) set before process pool is forked in EmployeeMapper.identify_users
+shared_hr_index = None
+
+
+def identify_users_chunk(df_chunk):
+    """
+    Process pool task - maps chunk of cloud users using HR index inherited from parent process
+    :param df_chunk: part of cloud users df
+    :return: list of identify_user results
+    """
+    mapper, df_hr, lookup = shared_hr_index
+    return [mapper.identify_user(row, df_hr, lookup) for row in df_chunk.itertuples()]
 
 
 class EmployeeMapper:
 
-    def __init__(self, engine):
+    # mapping results columns with few distinct values
+    category_columns = ['hr_system', 'mapping_method', 'mapping_source']
+
+    # latin -> russian transliterations from previous runs
+    translit_cache_path = 'support/translit_cache.json'
+
+    # preprocessed v_hr_mapping with lookup dicts, rebuilt when view's fingerprint changes
+    hr_index_path = 'support/hr_index.pkl'
+
+    # bumped when index structure changes so that old cache is rebuilt
+    hr_index_version = 2
+
+    # fuzzy matching: minimal similarity of last and first names (1 - edit distance / length)
+    fuzzy_threshold = 0.85
+
+    # columns of HR table users are looked up by
+    lookup_columns = ['email', 'employee_name', 'last_first_name', 'login']
+
+    # rows per chunk when manual mapping excel files are written and read
+    excel_chunk_size = 10000
+
+    def __init__(self, engine, hr_change_column=None):
+        """
+        Mapper needs sqlalchemy engine with v_hr_mapping and v_hr_cloud_users views
+        :param engine: sqlalchemy engine made from create_engine
+        :param hr_change_column: column of v_hr_mapping with change timestamp, if None view is hashed to detect changes
+        """
         self.engine = engine
+        self.hr_change_column = hr_change_column
+        self.translit_cache = None
+        profiler.instrument(self, 'map_users')
+        memory_budget.track(self, 'map_users')
 
     @staticmethod
     def is_english(string):
@@ -31,10 +82,61 @@ class EmployeeMapper:
         :return: string transliterated to russian
         """
         if self.is_english(string):
-            return translit(string, 'ru')
+            return self.transliterate_series(pd.Series([string])).iloc[0]
         else:
             return string
 
+    def load_translit_cache(self):
+        """
+        Loads transliterations saved on previous runs
+        :return: dict where key is latin string and value is its transliteration
+        """
+        if self.translit_cache is None:
+            self.translit_cache = {}
+            if os.path.isfile(self.translit_cache_path):
+                with open(self.translit_cache_path) as cache_file:
+                    self.translit_cache = json.load(cache_file)
+        return self.translit_cache
+
+    def save_translit_cache(self):
+        """
+        Saves transliterations for next runs
+        :return: None, writes file
+        """
+        if not os.path.exists('support'):
+            os.mkdir('support')
+        with open(self.translit_cache_path, 'w') as cache_file:
+            cache_file.write(json.dumps(self.translit_cache, ensure_ascii=False))
+
+    def transliterate_series(self, series):
+        """
+        Vectorised transliterate_latin - only unique latin values are transliterated, others are taken from cache
+        :param series: pd.Series of strings without nulls
+        :return: pd.Series with latin strings transliterated to russian
+        """
+        is_latin = ~series.str.contains(r'[^\x00-\x7f]', regex=True)
+        cache = self.load_translit_cache()
+        new_values = [x for x in series[is_latin].unique() if x not in cache]
+        for value in new_values:
+            cache[value] = translit(value, 'ru')
+        if new_values:
+            logging.info(f'Transliterated {len(new_values)} new values')
+            self.save_translit_cache()
+        result = series.copy()
+        result[is_latin] = series[is_latin].map(cache)
+        return result
+
+    def apply_category_types(self, df):
+        """
+        Columns with few repeated values (hr_system, mapping_method, mapping_source) are kept as categories
+        :param df: DataFrame with mapping results
+        :return: same df with category columns
+        """
+        for col in self.category_columns:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        return df
+
     def get_hr_df(self):
         """
         get table from v_hr_mapping view (relevant columns from HR table)
@@ -44,10 +146,11 @@ class EmployeeMapper:
         df = pd.read_sql('SELECT * FROM v_hr_mapping', con=self.engine)
         for col in ['email', 'employee_name']:
             df[col] = df[col].str.lower().str.replace('  ', ' ').str.split('(').str[0].str.strip()
-        df['last_name'] = df['employee_name'].str.split(' ').str[0]
-        df['first_name'] = df['employee_name'].str.split(' ').str[1]
+        name_parts = df['employee_name'].str.split(' ')
+        df['last_name'] = name_parts.str[0]
+        df['first_name'] = name_parts.str[1]
         # 6 cases of ogly or kyzy patronyms - neglected them
-        df['middle_name'] = df['employee_name'].str.split(' ').str[2]
+        df['middle_name'] = name_parts.str[2]
         df['last_first_name'] = df['last_name'] + ' ' + df['first_name']
         for col in ['last_name', 'first_name', 'middle_name']:
             df[col] = df[col].fillna('')
@@ -62,13 +165,11 @@ class EmployeeMapper:
         :return: preprocessed df
         """
         df = pd.read_sql('SELECT * FROM v_hr_cloud_users', con=self.engine)
+        df['hr_system'] = df['hr_system'].astype('category')
         df['email_clean'] = df['email'].str.lower().str.strip()
         df['login'] = df['email_clean'].str.split('@').str[0]
         for col in ['last_name', 'first_name', 'middle_name']:
-            df[col] = df[col].fillna('')
-            df[col] = df[col].str.lower().str.strip()
-            df[col] = df[col].str.replace('none', '')
-            df[col] = df[col].str.split(' ').str[0]
+            df[col] = df[col].fillna('').str.lower().str.strip().str.replace('none', '').str.split(' ', n=1).str[0]
         df.loc[
             (df['last_name'] != '') & (df['first_name'] != ''),
             'last_first_name'
@@ -80,6 +181,7 @@ class EmployeeMapper:
             'full_name'
         ] = (df['last_name'] + ' ' + df['first_name'] + ' ' + df['middle_name']).str.strip()
         df['full_name'] = df['full_name'].fillna('')
+        df['last_first_name_ru'] = self.transliterate_series(df['last_first_name'])
 
         return df
 
@@ -117,25 +219,37 @@ class EmployeeMapper:
                     possible_options = list(df['employee_uid'])
                     return [possible_options, 'needs_manual', mapping_type]
 
-    def identify_user(self, row, df_hr):
+    def identify_user(self, row, df_hr, lookup=None):
         """
         Trys to identify user by columns specified in attempts dict
         Applys get_employee_id function to dataframes filtered by row params
         :param row: row of dataframe in map_users call
         :param df_hr: result of get_hr_df call (HR table from DWH)
+        :param lookup: lookup dict from get_hr_index, if None df_hr is filtered by comparison
         :return: list of dicts with mapping results
         """
         result_dict = {'hr_system': row.hr_system, 'system_email': row.email}
         attempts_dict = {
             'email': row.email_clean,
             'employee_name': row.full_name,
-            'last_first_name': self.transliterate_latin(row.last_first_name),
+            'last_first_name': row.last_first_name_ru,
             'login': row.login,
         }
         for param in attempts_dict.keys():
-            mapping_result = self.get_employee_uid(
-                df_hr[df_hr[param] == attempts_dict[param]],
-                param)
+            if lookup is None:
+                df_candidates = df_hr[df_hr[param] == attempts_dict[param]]
+            else:
+                df_candidates = df_hr.take(lookup[param].get(attempts_dict[param], []))
+            mapping_result = self.get_employee_uid(df_candidates, param)
+            if mapping_result[0] != 'not_mapped':
+                result_dict['employee_id'] = mapping_result[0]
+                result_dict['mapping_method'] = mapping_result[1]
+                result_dict['mapping_source'] = mapping_result[2]
+                return result_dict
+        if lookup is not None and row.last_first_name_ru:
+            # no exact matches - try similar names among HR rows sharing name trigrams
+            df_candidates = self.get_fuzzy_candidates(row.last_first_name_ru, df_hr, lookup['fuzzy'])
+            mapping_result = self.get_employee_uid(df_candidates, 'fuzzy_last_first_name')
             if mapping_result[0] != 'not_mapped':
                 result_dict['employee_id'] = mapping_result[0]
                 result_dict['mapping_method'] = mapping_result[1]
@@ -144,63 +258,388 @@ class EmployeeMapper:
         return {'hr_system': row.hr_system, 'system_email': row.email, 'employee_id': ['no_options'],
                 'mapping_method': 'not_mapped', 'mapping_source': 'not_mapped'}
 
-    def map_users(self):
+    @staticmethod
+    def get_block_keys(last_name, first_name):
+        """
+        Blocking keys for fuzzy matching - trigrams of last name combined with first name initial
+        :param last_name: last name
+        :param first_name: first name
+        :return: set of keys
+        """
+        padded = f' {last_name} '
+        return set([padded[i:i + 3] + first_name[:1] for i in range(len(padded) - 2)])
+
+    def build_fuzzy_index(self, df_hr):
+        """
+        Blocking index of HR table for fuzzy matching
+        :param df_hr: result of get_hr_df
+        :return: dict where key is block key and value is list of df_hr row positions
+        """
+        fuzzy_index = {}
+        for position, (last_name, first_name) in enumerate(zip(df_hr['last_name'], df_hr['first_name'])):
+            if last_name and first_name:
+                for key in self.get_block_keys(last_name, first_name):
+                    fuzzy_index.setdefault(key, []).append(position)
+        return fuzzy_index
+
+    @staticmethod
+    def edit_distance(string_a, string_b, max_distance):
+        """
+        Levenshtein distance that stops as soon as it exceeds max_distance
+        :param string_a: string
+        :param string_b: string
+        :param max_distance: distance above which exact value doesn't matter
+        :return: edit distance or max_distance + 1
+        """
+        if abs(len(string_a) - len(string_b)) > max_distance:
+            return max_distance + 1
+        previous = list(range(len(string_b) + 1))
+        for i, char_a in enumerate(string_a, 1):
+            current = [i]
+            for j, char_b in enumerate(string_b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+            if min(current) > max_distance:
+                return max_distance + 1
+            previous = current
+        return previous[-1]
+
+    def get_fuzzy_candidates(self, last_first_name, df_hr, fuzzy_index):
+        """
+        Finds HR rows with most similar last and first name among rows sharing at least third of blocking keys
+        :param last_first_name: transliterated 'last_name first_name' of cloud user
+        :param df_hr: result of get_hr_df
+        :param fuzzy_index: result of build_fuzzy_index
+        :return: df_hr rows with best similarity above fuzzy_threshold (empty if none)
+        """
+        name_parts = last_first_name.split(' ')
+        if len(name_parts) < 2 or not name_parts[0] or not name_parts[1]:
+            return df_hr.take([])
+        keys = self.get_block_keys(name_parts[0], name_parts[1])
+        shared_keys = Counter(position for key in keys for position in fuzzy_index.get(key, []))
+        min_shared_keys = max(1, len(keys) // 3)
+        hr_names = df_hr['last_first_name'].values
+        best_score = 0
+        best_positions = []
+        for position, shared in shared_keys.items():
+            if shared < min_shared_keys:
+                continue
+            name_length = max(len(last_first_name), len(hr_names[position]))
+            max_distance = int(name_length * (1 - self.fuzzy_threshold))
+            distance = self.edit_distance(last_first_name, hr_names[position], max_distance)
+            if distance > max_distance:
+                continue
+            score = 1 - distance / name_length
+            if score > best_score:
+                best_score = score
+                best_positions = [position]
+            elif score == best_score:
+                best_positions.append(position)
+        return df_hr.take(best_positions)
+
+    def has_changed_block_keys(self, last_first_name, changed_keys):
+        """
+        Checks if HR rows that could be fuzzy matched to cloud user have changed
+        :param last_first_name: transliterated 'last_name first_name' of cloud user
+        :param changed_keys: blocking keys of changed HR rows
+        :return: Bool
+        """
+        name_parts = last_first_name.split(' ')
+        if not changed_keys or len(name_parts) < 2:
+            return False
+        return not changed_keys.isdisjoint(self.get_block_keys(name_parts[0], name_parts[1]))
+
+    def get_hr_fingerprint(self):
+        """
+        Fingerprint of v_hr_mapping view. If hr_change_column is set it is row count plus max of this column,
+        else hash of all rows
+        :return: string
+        """
+        if self.hr_change_column is not None:
+            with self.engine.connect() as connection:
+                query = f'SELECT COUNT(*), MAX({self.hr_change_column}) FROM v_hr_mapping'
+                rows_count, max_change = connection.execute(query).fetchone()
+            return f'{rows_count}|{max_change}'
+        df = pd.read_sql('SELECT * FROM v_hr_mapping', con=self.engine)
+        row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False).values
+        return f'{df.shape[0]}|{hashlib.md5(row_hashes.tobytes()).hexdigest()}'
+
+    def get_hr_index(self):
+        """
+        Preprocessed HR table with lookup dicts, cached on disk and rebuilt only if v_hr_mapping fingerprint changed
+        :return: tuple (df_hr, lookup, changed values) where lookup is dict param: {value: row positions}
+        and changed values is dict param: set of values of HR rows changed since cached index (None if no cache)
+        """
+        fingerprint = self.get_hr_fingerprint()
+        cached_index = None
+        if os.path.isfile(self.hr_index_path):
+            cached_index = pd.read_pickle(self.hr_index_path)
+            if cached_index['fingerprint'] == fingerprint and cached_index.get('version') == self.hr_index_version:
+                logging.info('HR table did not change, using cached index')
+                return cached_index['df'], cached_index['lookup'], {x: set() for x in self.lookup_columns + ['fuzzy']}
+
+        logging.info('Building HR index')
+        df_hr = self.get_hr_df()
+        lookup = {x: df_hr.groupby(x).indices for x in self.lookup_columns}
+        lookup['fuzzy'] = self.build_fuzzy_index(df_hr)
+        changed_values = None
+        if cached_index is not None and cached_index.get('version') == self.hr_index_version:
+            compared_columns = self.lookup_columns + ['employee_uid', 'exit_date', 'main_workplace']
+            old_hashes = pd.util.hash_pandas_object(cached_index['df'][compared_columns].astype(str), index=False)
+            new_hashes = pd.util.hash_pandas_object(df_hr[compared_columns].astype(str), index=False)
+            df_changed = pd.concat([
+                cached_index['df'][~old_hashes.isin(new_hashes).values],
+                df_hr[~new_hashes.isin(old_hashes).values]
+            ])
+            changed_values = {x: set(df_changed[x].dropna()) for x in self.lookup_columns}
+            changed_values['fuzzy'] = set([
+                key for last_name, first_name in zip(df_changed['last_name'], df_changed['first_name'])
+                for key in self.get_block_keys(last_name, first_name)
+            ])
+            logging.info(f'{df_changed.shape[0]} HR rows changed since last index')
+        if not os.path.exists('support'):
+            os.mkdir('support')
+        pd.to_pickle({'fingerprint': fingerprint, 'version': self.hr_index_version, 'df': df_hr, 'lookup': lookup},
+                     self.hr_index_path)
+        return df_hr, lookup, changed_values
+
+    def replace_by_key(self, table_name, df, key_column, keys):
+        """
+        Deletes rows with keys from table and appends df, in one transaction
+        :param table_name: table to update
+        :param df: new rows
+        :param key_column: key column name
+        :param keys: keys to delete (usually keys of df plus keys that should be removed)
+        :return: None, writes to db
+        """
+        keys = [x for x in set(keys) if not pd.isnull(x)]
+        query = text(f'DELETE FROM {table_name} WHERE {key_column} IN :keys').bindparams(
+            bindparam('keys', expanding=True))
+        with self.engine.begin() as connection:
+            if self.engine.dialect.has_table(connection, table_name):
+                # sqlite has limit on number of variables in one statement
+                for i in range(0, len(keys), 500):
+                    connection.execute(query, keys=keys[i:i + 500])
+            if df.shape[0] > 0:
+                df.to_sql(table_name, con=connection, index=False, if_exists='append')
+
+    def identify_users(self, df, df_hr, lookup, processes=1):
+        """
+        Calls identify_user for every cloud user. With processes > 1 users are split to chunks mapped in process pool.
+        HR index is shared with workers via fork (copy-on-write), only chunks of cloud users are pickled.
+        Results are in the same order as in serial mode
+        :param df: result of get_cloud_users_df (filtered to users that need mapping)
+        :param df_hr: HR table from get_hr_index
+        :param lookup: lookup dict from get_hr_index
+        :param processes: number of worker processes
+        :return: list of identify_user results
+        """
+        global shared_hr_index
+        if processes > 1 and df.shape[0] > processes and 'fork' not in multiprocessing.get_all_start_methods():
+            logging.info('Process fork is not available, mapping users in single process')
+            processes = 1
+        if processes <= 1 or df.shape[0] <= processes:
+            # God of python please forgive me for iterating over data frame :(
+            return [self.identify_user(row, df_hr, lookup) for row in df.itertuples()]
+
+        chunk_size = -(-df.shape[0] // (processes * 4))
+        chunks = [df.iloc[i:i + chunk_size] for i in range(0, df.shape[0], chunk_size)]
+        logging.info(f'Mapping {df.shape[0]} users in {processes} processes, {len(chunks)} chunks')
+        shared_hr_index = (self, df_hr, lookup)
+        try:
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                results = pool.map(identify_users_chunk, chunks)
+        finally:
+            shared_hr_index = None
+        return [identity for chunk_results in results for identity in chunk_results]
+
+    def map_users(self, processes=1):
         """
         Compares all known users from cloud system and hr table (+ manual mapped table)
-        If new cases - maps them and writes resulting employee id to hr_cloud_mapped_auto table
-        all not mapped users writes to hr_cloud_mapping_needed table
+        Maps new cloud users and users from hr_cloud_mapping_needed whose HR candidates changed,
+        writes resulting employee id to hr_cloud_mapped_auto table
+        all not mapped users are updated in hr_cloud_mapping_needed table
+        :param processes: number of processes to map users in, see identify_users
         :return: None, writes to db
         """
         df = self.get_cloud_users_df()
         cases_total = df.shape[0]
-        if self.engine.dialect.has_table(self.engine, 'v_hr_cloud_mapping'):
-            df_known = pd.read_sql('SELECT * FROM v_hr_cloud_mapping', self.engine)
+        mapped_emails = []
+        if inspect(self.engine).has_table('v_hr_cloud_mapping'):
+            df_known = pd.read_sql('SELECT system_email FROM v_hr_cloud_mapping', self.engine)
             mapped_emails = df_known['system_email'].unique()
             df = df[~df['email'].isin(mapped_emails)]
-        df_hr = self.get_hr_df()
+        df_hr, lookup, changed_values = self.get_hr_index()
+
+        known_not_mapped_emails = None
+        if inspect(self.engine).has_table('hr_cloud_mapping_needed'):
+            df_known_not_mapped = pd.read_sql('SELECT system_email FROM hr_cloud_mapping_needed', con=self.engine)
+            known_not_mapped_emails = df_known_not_mapped['system_email'].unique()
+        if known_not_mapped_emails is not None and changed_values is not None:
+            is_new = ~df['email'].isin(known_not_mapped_emails)
+            is_affected = df['email_clean'].isin(changed_values['email']) | \
+                df['full_name'].isin(changed_values['employee_name']) | \
+                df['last_first_name_ru'].isin(changed_values['last_first_name']) | \
+                df['login'].isin(changed_values['login']) | \
+                df['last_first_name_ru'].apply(lambda x: self.has_changed_block_keys(x, changed_values['fuzzy']))
+            df = df[is_new | is_affected]
+            logging.info(f'Mapping {is_new.sum()} new users and {(is_affected & ~is_new).sum()} users '
+                         f'with changed HR candidates')
 
-        # God of python please forgive me for iterating over data frame :(
         mapped_records = []
         manual_mapping_needed = []
-        for row in df.itertuples():
-            identity = self.identify_user(row, df_hr)
+        for identity in self.identify_users(df, df_hr, lookup, processes):
             if identity['mapping_method'] == 'needs_manual' or identity['mapping_method'] == 'not_mapped':
                 manual_mapping_needed.append(identity)
             else:
-                mapped_records.append(self.identify_user(row, df_hr))
+                mapped_records.append(identity)
         logging.info(f'{len(manual_mapping_needed)} / {cases_total} users not mapped.')
         df_map = pd.DataFrame(mapped_records)
-        df_map['last_update'] = datetime.utcnow()
-        df_map.to_sql('hr_cloud_mapped_auto', con=self.engine, index=False, if_exists='append')
-        df_map_needed = pd.DataFrame(manual_mapping_needed)
-        df_map_needed = df_map_needed.explode('employee_id')
-        df_map_needed.rename(columns={'employee_id': 'possible_options'}, inplace=True)
-        if self.engine.dialect.has_table(self.engine, 'hr_cloud_mapping_needed'):
-            df_known_not_mapped = pd.read_sql('SELECT * FROM hr_cloud_mapping_needed', con=self.engine)
-            known_not_mapped_emails = df_known_not_mapped['system_email'].unique()
+        if df_map.shape[0] > 0:
+            df_map = self.apply_category_types(df_map)
+            df_map['last_update'] = datetime.utcnow()
+            self.replace_by_key('hr_cloud_mapped_auto', df_map, 'system_email', df_map['system_email'])
+        df_map_needed = self.apply_category_types(pd.DataFrame(manual_mapping_needed))
+        if df_map_needed.shape[0] > 0:
+            df_map_needed = df_map_needed.explode('employee_id')
+            df_map_needed.rename(columns={'employee_id': 'possible_options'}, inplace=True)
+            df_map_needed['already_mapped'] = 0
+        if known_not_mapped_emails is not None and df_map_needed.shape[0] > 0:
             logging.info(f'{len(known_not_mapped_emails)} / {df_map_needed.system_email.nunique()} already checked')
             df_map_needed.loc[df_map_needed['system_email'].isin(known_not_mapped_emails), 'already_mapped'] = 1
-            df_map_needed['already_mapped'] = df_map_needed['already_mapped'].fillna(0)
             logging.info(f'{df_map_needed[df_map_needed.already_mapped == 0].shape[0]} are still needed to check')
-        df_map_needed.to_sql('hr_cloud_mapping_needed', con=self.engine, index=False, if_exists='replace')
-        if df_map_needed.shape[0] > 0:
-            if not os.path.exists('support'):
-                os.mkdir('support')
-            excel_path = 'support/for_manual_mapping.xlsx'
-            logging.info(f'Saved users that need mapping to {excel_path}')
-            df_map_needed.to_excel('support/for_manual_mapping.xlsx', index=False)
+        self.replace_by_key('hr_cloud_mapping_needed', df_map_needed, 'system_email',
+                            list(df['email']) + list(mapped_emails))
+        if not inspect(self.engine).has_table('hr_cloud_mapping_needed'):
+            return
+        if not os.path.exists('support'):
+            os.mkdir('support')
+        excel_path = 'support/for_manual_mapping.xlsx'
+        rows = self.write_excel_chunks('SELECT * FROM hr_cloud_mapping_needed', excel_path)
+        if rows > 0:
+            logging.info(f'Saved {rows} rows of users that need mapping to {excel_path}')
+
+    @staticmethod
+    def excel_value(value):
+        """
+        Converts value of DataFrame cell to one openpyxl can write, missing values become empty cells
+        :param value: cell value
+        :return: value
+        """
+        if value is None or (not isinstance(value, str) and pd.isnull(value)):
+            return None
+        return value
+
+    def write_excel_chunks(self, query, excel_path, sheet_name='Sheet1'):
+        """
+        Writes query results to excel with write-only workbook, rows are read from db and written in chunks
+        so that neither whole table nor whole workbook is kept in memory. File is replaced only when complete
+        :param query: sql query
+        :param excel_path: path to xlsx file
+        :param sheet_name: sheet name
+        :return: number of rows written, file is not written if there are none
+        """
+        tmp_path = excel_path.replace('.xlsx', '.tmp.xlsx')
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(sheet_name)
+        rows = 0
+        for df_chunk in pd.read_sql(query, con=self.engine, chunksize=self.excel_chunk_size):
+            if rows == 0:
+                sheet.append(list(df_chunk.columns))
+            for row in df_chunk.itertuples(index=False, name=None):
+                sheet.append([self.excel_value(x) for x in row])
+            rows += df_chunk.shape[0]
+        if rows == 0:
+            return 0
+        workbook.save(tmp_path)
+        os.replace(tmp_path, excel_path)
+        return rows
+
+    def iter_excel_chunks(self, excel_path, sheet_name, skiprows=0):
+        """
+        Reads excel sheet with read-only workbook in chunks of rows
+        :param excel_path: path to xlsx file
+        :param sheet_name: sheet name
+        :param skiprows: rows before header
+        :return: generator of DataFrames
+        """
+        workbook = load_workbook(excel_path, read_only=True, data_only=True)
+        try:
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            for i in range(skiprows):
+                next(rows, None)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = [x if x is not None else f'Unnamed: {i}' for i, x in enumerate(header)]
+            chunk = []
+            for row in rows:
+                if all(x is None for x in row):
+                    continue
+                chunk.append(row[:len(columns)])
+                if len(chunk) >= self.excel_chunk_size:
+                    yield pd.DataFrame(chunk, columns=columns)
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=columns)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def get_mapping_signatures(df, columns):
+        """
+        Signature of manual mapping of each email - all its rows as sorted tuple of strings,
+        so that values read from excel and from db compare equal (1 and 1.0, None and NaN)
+        :param df: manual mapping rows
+        :param columns: columns to compare
+        :return: python dict where key is system_email and value is signature
+        """
+        def normalize(value):
+            if value is None or (not isinstance(value, str) and pd.isnull(value)):
+                return ''
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            return str(value)
+
+        rows = {}
+        for email, row in zip(df['system_email'], df[columns].itertuples(index=False, name=None)):
+            rows.setdefault(email, []).append(tuple(normalize(x) for x in row))
+        return {email: tuple(sorted(email_rows)) for email, email_rows in rows.items()}
 
     def update_manual_from_excel(self):
         """
-        updates manual_mapping table provided in excel...
+        Merges rows of 'final' sheet of manual mapping excel with load_to_manual = 1 into hr_cloud_mapped_manual.
+        Only emails whose rows are new or changed are rewritten, other rows of table stay as they are.
+        If columns of sheet differ from table, table is replaced
         :return: None, writes to db
         """
         excel_path = 'support/manual_mapping.xlsx'
         if not os.path.isfile(excel_path):
             logging.info(f'could not load file since {excel_path} does not exist')
+            return
+        chunks = [x[x['load_to_manual'] == 1] for x in self.iter_excel_chunks(excel_path, 'final', skiprows=1)]
+        if not chunks:
+            logging.info(f'No rows in {excel_path}')
+            return
+        df_map_man = pd.concat(chunks, ignore_index=True)
+        columns = list(df_map_man.columns)
+
+        known_signatures = {}
+        replace_table = False
+        if inspect(self.engine).has_table('hr_cloud_mapped_manual'):
+            df_known = pd.read_sql('SELECT * FROM hr_cloud_mapped_manual', con=self.engine)
+            if set(df_known.columns) - {'last_update'} == set(columns):
+                known_signatures = self.get_mapping_signatures(df_known, columns)
+            else:
+                logging.info('Columns of manual mapping excel changed, replacing hr_cloud_mapped_manual')
+                replace_table = True
+
+        signatures = self.get_mapping_signatures(df_map_man, columns)
+        changed_emails = [x for x in signatures if known_signatures.get(x) != signatures[x]]
+        df_changed = df_map_man[df_map_man['system_email'].isin(changed_emails)].copy()
+        df_changed['last_update'] = datetime.utcnow()
+        if replace_table:
+            df_changed.to_sql('hr_cloud_mapped_manual', con=self.engine, if_exists='replace', index=False)
         else:
-            df_map_man = pd.read_excel(excel_path, sheet_name='final', skiprows=1)
-            df_map_man = df_map_man[df_map_man['load_to_manual'] == 1]
-            df_map_man['last_update'] = datetime.utcnow()
-            df_map_man.to_sql('hr_cloud_mapped_manual', con=self.engine, if_exists='replace', index=False)
-            logging.info(f'Uploaded {df_map_man.shape[0]} rows to manual mapping')
+            self.replace_by_key('hr_cloud_mapped_manual', df_changed, 'system_email', changed_emails)
+        logging.info(f'Uploaded {df_changed.shape[0]} new or changed rows out of {df_map_man.shape[0]} '
+                     f'to manual mapping')
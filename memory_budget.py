@@ -0,0 +1,294 @@
+import os
+import time
+import uuid
+import pickle
+import logging
+import threading
+import functools
+from metrics import run_metrics
+
+# peak memory fallback for systems without /proc, not available on windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# -------------------------------------------------------------------------------------
+# Memory budget: bounded chunks, spilling record batches to disk, peak RSS of each stage
+# -------------------------------------------------------------------------------------
+
+
+def read_proc_status(field):
+    """
+    Reads memory field of /proc/self/status (linux only)
+    :param field: e.g. 'VmRSS' or 'VmHWM'
+    :return: megabytes or None if not available
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith(field + ':'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def get_rss_mb():
+    """
+    Current resident set size of the process
+    :return: megabytes or None if platform does not report it
+    """
+    return read_proc_status('VmRSS')
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size since process start, used when current RSS is not reported
+    :return: megabytes or None if platform does not report it
+    """
+    peak = read_proc_status('VmHWM')
+    if peak is None and resource is not None:
+        peak = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return peak
+
+
+class MemoryBudget:
+
+    def __init__(self):
+        """
+        Global memory budget, configured from "memory" in configs:
+        {"budget_mb": 1024, "chunk_rows": 20000, "spill_path": "spill", "sample_seconds": 0.1}
+        Without budget_mb data is processed as a whole like before, only peak RSS is measured
+        """
+        self.budget_mb = None
+        self.chunk_rows = 20000
+        self.spill_path = 'spill'
+        self.sample_seconds = 0.1
+        self.local = threading.local()
+        # peak RSS of running stages, updated by sampler thread while any stage runs
+        self.stage_peaks = {}
+        self.stage_lock = threading.Lock()
+        self.sampler = None
+
+    def configure(self, settings=None):
+        """
+        Applies "memory" settings from configs
+        :param settings: python dict
+        :return: None
+        """
+        settings = settings or {}
+        self.budget_mb = float(settings['budget_mb']) if settings.get('budget_mb') else None
+        self.chunk_rows = int(settings.get('chunk_rows', 20000))
+        self.spill_path = settings.get('spill_path', 'spill')
+        self.sample_seconds = float(settings.get('sample_seconds', 0.1))
+        if self.enabled:
+            logging.info(f'Memory budget: {self.budget_mb} MB, chunks of {self.chunk_rows} rows')
+
+    @property
+    def enabled(self):
+        return self.budget_mb is not None
+
+    def is_exceeded(self):
+        """
+        Checks current RSS against budget
+        :return: True if budget is set and exceeded
+        """
+        if not self.enabled:
+            return False
+        rss = get_rss_mb()
+        return rss is not None and rss > self.budget_mb
+
+    def iter_chunks(self, records):
+        """
+        Splits records to lists of chunk_rows. Without budget yields all records as one list
+        :param records: iterable of records, e.g. list or SpillBuffer
+        :return: generator of lists
+        """
+        if not self.enabled:
+            yield list(records)
+            return
+        chunk = []
+        chunks = 0
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_rows:
+                yield chunk
+                chunks += 1
+                chunk = []
+        if chunk or chunks == 0:
+            yield chunk
+
+    def iter_frame_chunks(self, df):
+        """
+        Splits DataFrame to row chunks, so that writes convert only part of it at once
+        :param df: DataFrame
+        :return: generator of DataFrames
+        """
+        if not self.enabled or df.shape[0] <= self.chunk_rows:
+            yield df
+            return
+        for start in range(0, df.shape[0], self.chunk_rows):
+            yield df.iloc[start:start + self.chunk_rows]
+
+    def make_buffer(self, name):
+        """
+        Container for records collected from many calls (e.g. pages)
+        :param name: name used in spill file names
+        :return: SpillBuffer if budget is set, else plain list
+        """
+        return SpillBuffer(name, self) if self.enabled else []
+
+    def track(self, obj, prefix):
+        """
+        Wraps methods of object whose names start with prefix so that peak RSS of each call
+        goes to "peak_rss_mb" section of run metrics. Only outermost tracked call of a thread is measured
+        :param obj: object to track, e.g. scetl instance
+        :param prefix: method name prefix, e.g. 'update_'
+        :return: None
+        """
+        for name in dir(obj):
+            method = getattr(obj, name)
+            if name.startswith(prefix) and callable(method):
+                setattr(obj, name, self.wrap(method, f'{type(obj).__name__}.{name}'))
+
+    def wrap(self, method, stage_name):
+        """
+        Makes function measuring peak RSS of method
+        :param method: bound method
+        :param stage_name: key in run metrics
+        :return: function
+        """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if getattr(self.local, 'active', False):
+                return method(*args, **kwargs)
+            self.local.active = True
+            stage = self.start_stage()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.local.active = False
+                peak = self.finish_stage(stage)
+                if peak is not None:
+                    run_metrics.record('peak_rss_mb', stage_name, peak)
+        return wrapper
+
+    def start_stage(self):
+        """
+        Starts tracking peak RSS of stage, starts sampler thread if it is not running.
+        Peak counter of the process is never reset, so concurrent stages (e.g. tenants) do not affect each other,
+        each one gets highest RSS of the process sampled while it was running
+        :return: stage key for finish_stage
+        """
+        stage = object()
+        with self.stage_lock:
+            self.stage_peaks[stage] = get_rss_mb()
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_stages, name='rss_sampler', daemon=True)
+                self.sampler.start()
+        return stage
+
+    def finish_stage(self, stage):
+        """
+        Stops tracking peak RSS of stage
+        :param stage: key from start_stage
+        :return: peak megabytes or None if platform does not report it
+        """
+        rss = get_rss_mb()
+        with self.stage_lock:
+            peak = self.stage_peaks.pop(stage)
+        if rss is None:
+            # without current RSS only peak of whole process run is known
+            return get_peak_rss_mb()
+        return max(rss, peak or 0)
+
+    def sample_stages(self):
+        """
+        Sampler thread: updates peak RSS of running stages every sample_seconds, exits when none is running
+        :return: None
+        """
+        while True:
+            time.sleep(self.sample_seconds)
+            with self.stage_lock:
+                if not self.stage_peaks:
+                    self.sampler = None
+                    return
+                # sampled under lock, so that stage started after sample does not get it
+                rss = get_rss_mb()
+                if rss is None:
+                    continue
+                for stage, peak in self.stage_peaks.items():
+                    if peak is None or rss > peak:
+                        self.stage_peaks[stage] = rss
+
+
+class SpillBuffer:
+
+    def __init__(self, name, budget):
+        """
+        List-like buffer of records that moves its batches to pickle files when memory budget is exceeded.
+        Records are raw api json (nested dicts), so they are pickled rather than written to parquet.
+        Iterating reads spilled batches back one at a time, files are removed by close
+        :param name: name used in spill file names
+        :param budget: MemoryBudget
+        """
+        self.name = name
+        self.budget = budget
+        self.records = []
+        self.files = []
+        self.rows = 0
+
+    def extend(self, records):
+        """
+        Adds records, spills buffered ones if budget is exceeded
+        :param records: iterable of records
+        :return: None
+        """
+        for record in records:
+            self.records.append(record)
+            self.rows += 1
+        if self.budget.is_exceeded():
+            self.spill()
+
+    def spill(self):
+        """
+        Writes buffered records to temporary file and frees them
+        :return: None
+        """
+        if not self.records:
+            return
+        os.makedirs(self.budget.spill_path, exist_ok=True)
+        file_path = os.path.join(self.budget.spill_path, f'{self.name}_{os.getpid()}_{uuid.uuid4().hex}.pkl')
+        with open(file_path, 'wb') as file:
+            pickle.dump(self.records, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.files.append(file_path)
+        run_metrics.add('memory_spill', 'batches')
+        run_metrics.add('memory_spill', 'rows', len(self.records))
+        run_metrics.add('memory_spill', 'bytes', os.path.getsize(file_path))
+        self.records = []
+
+    def __iter__(self):
+        for file_path in self.files:
+            with open(file_path, 'rb') as file:
+                batch = pickle.load(file)
+            yield from batch
+        yield from self.records
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        """
+        Removes spill files
+        :return: None
+        """
+        for file_path in self.files:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        self.files = []
+        self.records = []
+        self.rows = 0
+
+
+memory_budget = MemoryBudget()
@@ -0,0 +1,102 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+
+# ---------------------------------------------------------
+# Run metrics - counters and states collected during a run
+# ---------------------------------------------------------
+
+
+class RunMetrics:
+
+    def __init__(self, path='metrics'):
+        """
+        Metrics are kept in memory as sections of key-values and dumped to json in the end of a run
+        :param path: folder to write metrics files to
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.started_at = datetime.utcnow()
+        self.sections = {}
+        self.collectors = {}
+
+    def reset(self):
+        """
+        Starts new run, collectors stay registered
+        :return: None
+        """
+        with self.lock:
+            self.started_at = datetime.utcnow()
+            self.sections = {}
+
+    def record(self, section, key, value):
+        """
+        Sets value in section
+        :param section: section name, e.g. stage or host
+        :param key: metric name
+        :param value: any json serializable value
+        :return: None
+        """
+        with self.lock:
+            self.sections.setdefault(section, {})[key] = value
+
+    def add(self, section, key, value=1):
+        """
+        Increments counter in section
+        :param section: section name, e.g. stage or host
+        :param key: metric name
+        :param value: increment
+        :return: None
+        """
+        with self.lock:
+            section_dict = self.sections.setdefault(section, {})
+            section_dict[key] = section_dict.get(key, 0) + value
+
+    def add_collector(self, section, collector):
+        """
+        Registers function that returns state of some component (e.g. rate limiters) when metrics are dumped
+        :param section: section name
+        :param collector: function without params returning json serializable dict
+        :return: None
+        """
+        self.collectors[section] = collector
+
+    def to_dict(self):
+        """
+        Collects all metrics to single dict
+        :return: python dict
+        """
+        with self.lock:
+            result = {
+                'started_at': self.started_at.isoformat(),
+                'finished_at': datetime.utcnow().isoformat(),
+                'sections': json.loads(json.dumps(self.sections, default=str))
+            }
+        for section, collector in self.collectors.items():
+            result['sections'][section] = collector()
+        return result
+
+    def run_name(self):
+        """
+        Name of current run, used for files written along with metrics
+        :return: string
+        """
+        return 'run_' + self.started_at.strftime('%Y%m%d_%H%M%S')
+
+    def dump(self):
+        """
+        Writes metrics of current run to metrics/run_YYYYMMDD_HHMMSS.json
+        :return: path to written file
+        """
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        file_path = os.path.join(self.path, self.run_name() + '.json')
+        with open(file_path, 'w') as file:
+            file.write(json.dumps(self.to_dict(), indent=2, default=str))
+        logging.info(f'Run metrics saved to {file_path}')
+        return file_path
+
+
+run_metrics = RunMetrics()
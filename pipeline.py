@@ -0,0 +1,174 @@
+import time
+import queue
+import logging
+import threading
+from metrics import run_metrics
+
+# ---------------------------------------------------------------------------------------------
+# Staged pipeline: fetch, transform and write stages in own threads connected by bounded queues
+# ---------------------------------------------------------------------------------------------
+
+# marks end of stream in stage queues
+DONE = object()
+
+
+class Pipeline:
+
+    # seconds between checks of stop flag while stage is blocked on queue
+    poll_interval = 0.1
+
+    def __init__(self, name, queue_size=4):
+        """
+        Runs producer (iterating fetch generator), transformer and writer concurrently, so that item N+1
+        is fetched while item N is converted and written. Full queue blocks the stage before it - that's backpressure.
+        Writer runs in calling thread since it uses db connections, write lock and stage profiling of caller.
+        Queue depths and time each stage spent blocked go to "pipeline" section of run metrics:
+        "<name>.<stage>_wait_input_seconds" - stage was starved (stage before it is bottleneck),
+        "<name>.<stage>_wait_output_seconds" - stage was blocked by full queue (stage after it is bottleneck)
+        :param name: pipeline name in run metrics, e.g. 'EdusonScetl.user_courses'
+        :param queue_size: max items waiting between stages, 0 runs stages one after another in calling thread
+        """
+        self.name = name
+        self.queue_size = queue_size
+        self.stopped = threading.Event()
+        self.errors = []
+        self.max_depths = {}
+
+    def put(self, stage, stage_queue, item):
+        """
+        Puts item to queue, waits while queue is full unless pipeline is stopped
+        :param stage: name of stage putting item
+        :param stage_queue: queue.Queue
+        :param item: item or DONE
+        :return: True if item was put
+        """
+        started_at = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                stage_queue.put(item, timeout=self.poll_interval)
+                break
+            except queue.Full:
+                continue
+        run_metrics.add('pipeline', f'{self.name}.{stage}_wait_output_seconds',
+                        round(time.monotonic() - started_at, 4))
+        depth = stage_queue.qsize()
+        self.max_depths[stage] = max(depth, self.max_depths.get(stage, 0))
+        return not self.stopped.is_set()
+
+    def get(self, stage, stage_queue):
+        """
+        Takes item from queue, waits while queue is empty unless pipeline is stopped
+        :param stage: name of stage taking item
+        :param stage_queue: queue.Queue
+        :return: item, DONE if stream ended or pipeline is stopped
+        """
+        started_at = time.monotonic()
+        item = DONE
+        while not self.stopped.is_set():
+            try:
+                item = stage_queue.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                continue
+        run_metrics.add('pipeline', f'{self.name}.{stage}_wait_input_seconds',
+                        round(time.monotonic() - started_at, 4))
+        return item
+
+    def start_stage(self, stage, function):
+        """
+        Runs stage function in daemon thread, errors stop the pipeline and are raised by run
+        :param stage: name of stage
+        :param function: function without arguments
+        :return: threading.Thread
+        """
+        def target():
+            try:
+                function()
+            except Exception as e:
+                logging.exception(f'Pipeline {self.name}: {stage} failed')
+                self.errors.append(e)
+                self.stopped.set()
+
+        thread = threading.Thread(target=target, name=f'{self.name}.{stage}', daemon=True)
+        thread.start()
+        return thread
+
+    def produce(self, items, output_queue):
+        """
+        Producer stage: iterates items (e.g. generator making api calls)
+        :param items: iterable
+        :param output_queue: queue.Queue
+        :return: None
+        """
+        try:
+            for item in items:
+                if not self.put('producer', output_queue, item):
+                    return
+        finally:
+            self.put('producer', output_queue, DONE)
+
+    def transform(self, function, input_queue, output_queue):
+        """
+        Transformer stage: applies function to items, None results are dropped
+        :param function: function taking item
+        :param input_queue: queue.Queue
+        :param output_queue: queue.Queue
+        :return: None
+        """
+        try:
+            while True:
+                item = self.get('transformer', input_queue)
+                if item is DONE:
+                    return
+                result = function(item)
+                if result is not None and not self.put('transformer', output_queue, result):
+                    return
+        finally:
+            self.put('transformer', output_queue, DONE)
+
+    def run(self, items, transform=None, write=None):
+        """
+        Runs pipeline until items are exhausted
+        :param items: iterable of fetched items, iterated in producer thread
+        :param transform: function converting item (e.g. json to DataFrame), None skips transformer stage
+        :param write: function writing transformed item, runs in calling thread
+        :return: number of written items
+        """
+        transform = transform or (lambda x: x)
+        write = write or (lambda x: None)
+        written = 0
+        started_at = time.monotonic()
+        if self.queue_size <= 0:
+            for item in items:
+                result = transform(item)
+                if result is not None:
+                    write(result)
+                    written += 1
+            return written
+
+        fetched = queue.Queue(maxsize=self.queue_size)
+        transformed = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            self.start_stage('producer', lambda: self.produce(items, fetched)),
+            self.start_stage('transformer', lambda: self.transform(transform, fetched, transformed))
+        ]
+        try:
+            while True:
+                item = self.get('writer', transformed)
+                if item is DONE:
+                    break
+                write(item)
+                written += 1
+        except Exception:
+            self.stopped.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            for stage, depth in self.max_depths.items():
+                run_metrics.record('pipeline', f'{self.name}.{stage}_max_queue_depth', depth)
+            run_metrics.add('pipeline', f'{self.name}.items', written)
+            run_metrics.add('pipeline', f'{self.name}.seconds', round(time.monotonic() - started_at, 3))
+        if self.errors:
+            raise self.errors[0]
+        return written
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import functools
+import tracemalloc
+from collections import Counter
+from metrics import run_metrics
+
+# --------------------------------------------------------------------------------------------
+# Profiling mode: sampling profile or cProfile stats plus tracemalloc top allocations per stage
+# --------------------------------------------------------------------------------------------
+
+
+class StackSampler(threading.Thread):
+
+    def __init__(self, interval):
+        """
+        Background thread taking stacks of all threads of the process every interval seconds, so that
+        work of thread pools started by stage (and of other stages running concurrently) is seen too.
+        Each stack starts with thread name, so threads are separate subtrees of flamegraph
+        :param interval: seconds between samples
+        """
+        super().__init__(daemon=True, name='stack_sampler')
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def frame_name(frame):
+        """
+        Function name with file and first line, so that same function is one node of flamegraph
+        :param frame: python frame
+        :return: string
+        """
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def run(self):
+        """
+        Samples until stop is called, skips stack samplers themselves
+        :return: None
+        """
+        while not self.stopped.wait(self.interval):
+            threads = {x.ident: x for x in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                thread = threads.get(thread_id)
+                if isinstance(thread, StackSampler):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(thread.name if thread is not None else f'thread {thread_id}')
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        Stops sampling and waits for thread to finish
+        :return: Counter where key is collapsed stack (root;...;leaf) and value is number of samples
+        """
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class StageProfiler:
+
+    def __init__(self):
+        """
+        Profiles pipeline stages (Scetl update_* methods, EmployeeMapper.map_users) when enabled.
+        Settings come from "profiling" in configs or --profile in command line, see configure
+        """
+        self.enabled = False
+        self.mode = 'sampling'
+        self.interval = 0.005
+        self.trace_memory = True
+        self.top_allocations = 10
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stages = {}
+        # tracemalloc is global for process, it runs while any stage traces memory
+        self.traced_stages = 0
+
+    def configure(self, settings=None, force=False):
+        """
+        Applies settings: {"enabled": true, "mode": "sampling" or "cprofile", "interval_ms": 5,
+        "tracemalloc": true, "top_allocations": 10}
+        :param settings: "profiling" dict from configs
+        :param force: True turns profiling on regardless of settings (--profile in command line)
+        :return: None
+        """
+        settings = settings or {}
+        self.enabled = force or bool(settings.get('enabled', False))
+        self.mode = settings.get('mode', 'sampling')
+        self.interval = float(settings.get('interval_ms', 5)) / 1000
+        self.trace_memory = bool(settings.get('tracemalloc', True))
+        self.top_allocations = int(settings.get('top_allocations', 10))
+        if self.enabled:
+            logging.info(f'Profiling is on, mode: {self.mode}')
+
+    def instrument(self, obj, prefix):
+        """
+        Wraps methods of object whose names start with prefix so that each call is profiled as stage.
+        Does nothing if profiling is off
+        :param obj: object to instrument, e.g. scetl instance
+        :param prefix: method name prefix, e.g. 'update_'
+        :return: None
+        """
+        if not self.enabled:
+            return
+        for name in dir(obj):
+            method = getattr(obj, name)
+            if name.startswith(prefix) and callable(method):
+                setattr(obj, name, self.wrap(method, f'{type(obj).__name__}.{name}'))
+
+    def wrap(self, method, stage_name):
+        """
+        Makes function that runs method inside stage
+        :param method: bound method
+        :param stage_name: name of stage in report
+        :return: function
+        """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with self.stage(stage_name):
+                return method(*args, **kwargs)
+        return wrapper
+
+    def get_stage(self, stage_name):
+        """
+        Report entry of stage, created on first call
+        :param stage_name: name of stage
+        :return: dict
+        """
+        with self.lock:
+            return self.stages.setdefault(stage_name, {
+                'calls': 0, 'wall_seconds': 0.0, 'profiled_calls': 0, 'stacks': Counter(),
+                'profile': None, 'allocations': [], 'traced_peak_mb': None
+            })
+
+    def stage(self, stage_name):
+        """
+        Context manager profiling code inside it. Only the outermost stage of a thread is profiled,
+        nested stages (e.g. update_user_courses called from update_user_changes) only count calls and time
+        :param stage_name: name of stage in report
+        :return: context manager
+        """
+        return ProfiledStage(self, stage_name)
+
+    @staticmethod
+    def take_snapshot():
+        """
+        Tracemalloc snapshot without allocations of profiler itself
+        :return: tracemalloc.Snapshot
+        """
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+
+    def start(self, stage_name):
+        """
+        Starts profilers for outermost stage of thread
+        :param stage_name: name of stage
+        :return: dict with started profilers
+        """
+        state = {'started_at': time.monotonic(), 'outermost': not getattr(self.local, 'active', False)}
+        if not state['outermost']:
+            return state
+        self.local.active = True
+        if self.trace_memory:
+            with self.lock:
+                # tracing started outside of profiler is left alone
+                if self.traced_stages or not tracemalloc.is_tracing():
+                    if not self.traced_stages:
+                        tracemalloc.start()
+                    self.traced_stages += 1
+                    state['tracemalloc'] = True
+            if state.get('tracemalloc'):
+                state['snapshot'] = self.take_snapshot()
+        if self.mode == 'cprofile':
+            state['profile'] = cProfile.Profile()
+            state['profile'].enable()
+        else:
+            state['sampler'] = StackSampler(self.interval)
+            state['sampler'].start()
+        return state
+
+    def stop(self, stage_name, state):
+        """
+        Stops profilers and adds results to stage report
+        :param stage_name: name of stage
+        :param state: dict returned by start
+        :return: None
+        """
+        stage = self.get_stage(stage_name)
+        if state['outermost']:
+            if 'profile' in state:
+                state['profile'].disable()
+            stacks = state['sampler'].stop() if 'sampler' in state else Counter()
+            allocations = []
+            traced_peak = None
+            if state.get('tracemalloc'):
+                statistics = self.take_snapshot().compare_to(state['snapshot'], 'lineno')
+                allocations = [
+                    {'line': str(x.traceback), 'size_kb': round(x.size_diff / 1024, 1), 'count': x.count_diff}
+                    for x in statistics[:self.top_allocations]
+                ]
+                traced_peak = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                with self.lock:
+                    self.traced_stages -= 1
+                    if not self.traced_stages:
+                        tracemalloc.stop()
+            self.local.active = False
+        with self.lock:
+            stage['calls'] += 1
+            stage['wall_seconds'] += time.monotonic() - state['started_at']
+            if state['outermost']:
+                stage['profiled_calls'] += 1
+                stage['stacks'].update(stacks)
+                if 'profile' in state:
+                    if stage['profile'] is None:
+                        stage['profile'] = pstats.Stats(state['profile'])
+                    else:
+                        stage['profile'].add(state['profile'])
+                if allocations:
+                    stage['allocations'] = allocations
+                    stage['traced_peak_mb'] = max(traced_peak, stage['traced_peak_mb'] or 0)
+
+    @staticmethod
+    def top_functions(stacks, top=15):
+        """
+        Functions with most samples on top of stack (self time)
+        :param stacks: Counter of collapsed stacks
+        :param top: number of functions
+        :return: list of dicts with function, samples and share
+        """
+        leaves = Counter()
+        for stack, samples in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        total = sum(leaves.values()) or 1
+        return [
+            {'function': name, 'samples': samples, 'share': round(samples / total, 3)}
+            for name, samples in leaves.most_common(top)
+        ]
+
+    def dump(self):
+        """
+        Writes collapsed stacks (or cProfile stats) of every stage and profile_report.json
+        to metrics/<run_name>/ next to run metrics, then clears stages
+        :return: path to folder or None if profiling is off
+        """
+        if not self.enabled or not self.stages:
+            return None
+        path = os.path.join(run_metrics.path, run_metrics.run_name())
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+        report = {}
+        for stage_name, stage in stages.items():
+            report[stage_name] = {
+                'calls': stage['calls'],
+                'profiled_calls': stage['profiled_calls'],
+                'wall_seconds': round(stage['wall_seconds'], 3),
+                'traced_peak_mb': stage['traced_peak_mb'],
+                'top_allocations': stage['allocations']
+            }
+            if stage['stacks']:
+                with open(os.path.join(path, f'{stage_name}.collapsed'), 'w') as file:
+                    for stack, samples in stage['stacks'].most_common():
+                        file.write(f'{stack} {samples}\n')
+                report[stage_name]['samples'] = sum(stage['stacks'].values())
+                report[stage_name]['top_functions'] = self.top_functions(stage['stacks'])
+            if stage['profile'] is not None:
+                stage['profile'].dump_stats(os.path.join(path, f'{stage_name}.prof'))
+                with open(os.path.join(path, f'{stage_name}.txt'), 'w') as file:
+                    stage['profile'].stream = file
+                    stage['profile'].sort_stats('cumulative').print_stats(30)
+        with open(os.path.join(path, 'profile_report.json'), 'w') as file:
+            file.write(json.dumps(report, indent=2, default=str))
+        run_metrics.record('profiling', 'path', path)
+        logging.info(f'Profiles saved to {path}')
+        return path
+
+
+class ProfiledStage:
+
+    def __init__(self, profiler, stage_name):
+        """
+        Context manager returned by StageProfiler.stage
+        :param profiler: StageProfiler
+        :param stage_name: name of stage
+        """
+        self.profiler = profiler
+        self.stage_name = stage_name
+        self.state = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.state = self.profiler.start(self.stage_name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.state is not None:
+            self.profiler.stop(self.stage_name, self.state)
+        return False
+
+
+profiler = StageProfiler()
@@ -0,0 +1,151 @@
+import logging
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import text, bindparam, inspect
+from storage import get_history_store
+
+# -------------------------------------------------------------------------------------------
+# Rollup tables: per entity aggregates of history tables, updated only for keys changed in run
+# -------------------------------------------------------------------------------------------
+
+
+class RollupTable:
+
+    # sqlite has limit on number of variables in one statement
+    keys_per_statement = 500
+
+    def __init__(self, rollup_dict, source_dict, engine, tenant=None):
+        """
+        Rollup defined in system config under "rollups":
+        "candidate_statuses": {"table_name": "assess_first_candidate_statuses", "source": "assessments",
+                               "key_column": "uuid", "method": "count_distinct", "columns": ["name"],
+                               "filter": {"status": "finish"}, "value_column": "finished_assessments"}
+        Methods: "latest" - newest row (by last_update) per key_column + group_by with columns copied,
+        "count" - rows per group, "count_distinct" - distinct values of columns per group.
+        Optional "group_by" - extra grouping columns (e.g. course id), "filter" - column: value conditions
+        :param rollup_dict: rollup dict from config dict
+        :param source_dict: table dict of source table from config dict
+        :param engine: sqlalchemy engine made from create_engine
+        :param tenant: tenant of scetl, rollup then reads and replaces only rows of this tenant
+        """
+        self.engine = engine
+        self.tenant = tenant
+        self.table_name = rollup_dict['table_name']
+        self.source_name = source_dict['table_name']
+        self.store = get_history_store(source_dict)
+        self.key_column = rollup_dict['key_column']
+        self.group_columns = [self.key_column] + rollup_dict.get('group_by', [])
+        self.method = rollup_dict.get('method', 'latest')
+        self.columns = rollup_dict.get('columns', [])
+        self.filter = rollup_dict.get('filter', {})
+        self.value_column = rollup_dict.get('value_column', self.method)
+
+    def get_source_columns(self):
+        """
+        Columns of source table needed to compute rollup
+        :return: list of column names
+        """
+        columns = self.group_columns + self.columns + list(self.filter) + ['last_update']
+        if self.tenant is not None:
+            columns.append('tenant')
+        return list(dict.fromkeys(columns))
+
+    def get_tenant_filter(self, connector):
+        """
+        SQL condition limiting query to rows of tenant
+        :param connector: 'AND' or 'WHERE'
+        :return: string, empty without tenant
+        """
+        if self.tenant is None:
+            return ''
+        return f" {connector} tenant = '{self.tenant}'"
+
+    def read_source(self, keys=None):
+        """
+        Reads rows of source table for keys, parquet stores skip files whose key range does not match
+        :param keys: list of key_column values, None for all rows
+        :return: DataFrame
+        """
+        columns = self.get_source_columns()
+        if self.store is not None:
+            df = self.store.read(columns=columns, keys=keys if self.store.key_column == self.key_column else None)
+            if keys is not None:
+                df = df[df[self.key_column].isin(keys)]
+            if self.tenant is not None:
+                df = df[df['tenant'] == self.tenant]
+            return df
+        if keys is None:
+            return pd.read_sql(f'SELECT {", ".join(columns)} FROM {self.source_name}{self.get_tenant_filter("WHERE")}',
+                               con=self.engine)
+        query = text(f'SELECT {", ".join(columns)} FROM {self.source_name} WHERE {self.key_column} IN :keys'
+                     f'{self.get_tenant_filter("AND")}')
+        query = query.bindparams(bindparam('keys', expanding=True))
+        chunks = [
+            pd.read_sql(query, con=self.engine, params={'keys': keys[i:i + self.keys_per_statement]})
+            for i in range(0, len(keys), self.keys_per_statement)
+        ]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+
+    def compute(self, df):
+        """
+        Aggregates source rows
+        :param df: result of read_source
+        :return: DataFrame of rollup rows
+        """
+        for column, value in self.filter.items():
+            df = df[df[column] == value]
+        if self.method == 'latest':
+            df = df.sort_values('last_update').drop_duplicates(self.group_columns, keep='last')
+            df = df[list(dict.fromkeys(self.group_columns + self.columns + ['last_update']))]
+        elif self.method == 'count_distinct':
+            df = df.drop_duplicates(self.group_columns + self.columns)
+            df = df.groupby(self.group_columns).size().rename(self.value_column).reset_index()
+        elif self.method == 'count':
+            df = df.groupby(self.group_columns).size().rename(self.value_column).reset_index()
+        else:
+            raise ValueError(f'Unknown rollup method {self.method} for {self.table_name}')
+        df = df.copy()
+        if self.tenant is not None:
+            df['tenant'] = self.tenant
+        df['rollup_updated_at'] = datetime.utcnow()
+        return df
+
+    def update(self, keys=None):
+        """
+        Recomputes rollup rows of changed keys and swaps them in one transaction.
+        Whole rollup is built if keys is None or rollup table does not exist yet
+        :param keys: iterable of changed key_column values or None
+        :return: None, writes results to db
+        """
+        exists = inspect(self.engine).has_table(self.table_name)
+        if keys is not None and exists:
+            keys = [x.item() if hasattr(x, 'item') else x for x in set(keys) if not pd.isnull(x)]
+            if not keys:
+                return
+        else:
+            keys = None
+        if keys is None and not inspect(self.engine).has_table(self.source_name) and self.store is None:
+            logging.info(f'Rollup {self.table_name} skipped, {self.source_name} does not exist yet')
+            return
+        df = self.compute(self.read_source(keys))
+        with self.engine.begin() as connection:
+            if keys is None and (self.tenant is None or not exists):
+                df.to_sql(self.table_name, con=connection, index=False, if_exists='replace')
+            elif keys is None:
+                connection.execute(f'DELETE FROM {self.table_name}{self.get_tenant_filter("WHERE")}')
+                df.to_sql(self.table_name, con=connection, index=False, if_exists='append')
+            else:
+                query = text(f'DELETE FROM {self.table_name} WHERE {self.key_column} IN :keys'
+                             f'{self.get_tenant_filter("AND")}').bindparams(bindparam('keys', expanding=True))
+                for i in range(0, len(keys), self.keys_per_statement):
+                    connection.execute(query, keys=keys[i:i + self.keys_per_statement])
+                df.to_sql(self.table_name, con=connection, index=False, if_exists='append')
+        logging.info(f'Rollup {self.table_name} updated: {"all" if keys is None else len(keys)} keys, '
+                     f'{df.shape[0]} rows')
+
+    def read(self):
+        """
+        Reads rollup table
+        :return: DataFrame
+        """
+        return pd.read_sql(f'SELECT * FROM {self.table_name}{self.get_tenant_filter("WHERE")}', con=self.engine)
@@ -0,0 +1,92 @@
+import json
+import logging
+from metrics import run_metrics
+
+# ---------------------------------------------------------------------------------
+# Run scoped cache - every endpoint is fetched and turned to DataFrame once per run
+# ---------------------------------------------------------------------------------
+
+
+class RunCache:
+
+    def __init__(self, name):
+        """
+        Cache of endpoint payloads and DataFrames made from them, lives until clear is called
+        :param name: cache name for metrics, usually scetl class name
+        """
+        self.name = name
+        self.payloads = {}
+        self.frames = {}
+
+    @staticmethod
+    def make_key(endpoint, params):
+        """
+        Makes hashable key from endpoint and its params
+        :param endpoint: endpoint name, e.g. 'users' or 'enrolments'
+        :param params: python dict of call params
+        :return: tuple
+        """
+        return endpoint, json.dumps(params or {}, sort_keys=True, default=str)
+
+    def get_payload(self, endpoint, params, fetch):
+        """
+        Returns cached payload or calls fetch and caches its result
+        :param endpoint: endpoint name
+        :param params: python dict of call params
+        :param fetch: function without params making the call
+        :return: payload
+        """
+        key = self.make_key(endpoint, params)
+        if key in self.payloads:
+            run_metrics.add(f'run_cache.{self.name}', 'payload_hits')
+            return self.payloads[key]
+        run_metrics.add(f'run_cache.{self.name}', 'payload_misses')
+        self.payloads[key] = fetch()
+        return self.payloads[key]
+
+    def get_frame(self, endpoint, params, build):
+        """
+        Returns cached DataFrame made from endpoint payload or builds and caches it.
+        Tables should take projections (df[table_cols]) of it, not change it in place
+        :param endpoint: endpoint name
+        :param params: python dict of call params
+        :param build: function without params returning DataFrame
+        :return: DataFrame
+        """
+        key = self.make_key(endpoint, params)
+        if key in self.frames:
+            run_metrics.add(f'run_cache.{self.name}', 'frame_hits')
+            return self.frames[key]
+        run_metrics.add(f'run_cache.{self.name}', 'frame_misses')
+        self.frames[key] = build()
+        return self.frames[key]
+
+    def invalidate(self, endpoint, params=None):
+        """
+        Removes payload and frame of endpoint call. Without params removes all calls of endpoint
+        :param endpoint: endpoint name
+        :param params: python dict of call params
+        :return: None
+        """
+        if params is not None:
+            key = self.make_key(endpoint, params)
+            self.payloads.pop(key, None)
+            self.frames.pop(key, None)
+            return
+        for cache in [self.payloads, self.frames]:
+            for key in [x for x in cache if x[0] == endpoint]:
+                del cache[key]
+
+    def clear(self):
+        """
+        Drops everything, called in the end of the run
+        :return: None
+        """
+        if self.payloads or self.frames:
+            logging.info(f'Clearing {self.name} run cache: {len(self.payloads)} payloads, {len(self.frames)} frames')
+        for payload in self.payloads.values():
+            # payloads spilled to disk (memory_budget.SpillBuffer) remove their files
+            if hasattr(payload, 'close'):
+                payload.close()
+        self.payloads = {}
+        self.frames = {}
@@ -1,16 +1,46 @@
 import os
 import json
-import requests
+import asyncio
 import logging
+import threading
 import pandas as pd
+import pyarrow as pa
 from datetime import datetime
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, DateTime, String, Float, Text
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, DateTime, String, Float, Text, text, \
+    bindparam, inspect
+from storage import get_history_store
+from fingerprints import FingerprintStore
+from throttle import rate_limiter
+from metrics import run_metrics
+from run_cache import RunCache
+from work_queue import run_coordinator
+from async_fetch import AsyncFetcher
+from json_decode import decode_response, iter_items
+from profiler import profiler
+from rollups import RollupTable
+from memory_budget import memory_budget
+from pipeline import Pipeline
+from arrow_records import records_to_table, create_table, insert_table
 
 # -----------------------------------
 # Scetl stands for Sokols' Costyl ETL
 # -----------------------------------
 
 
+def get_tenant_configs(system_config):
+    """
+    Splits system config to configs of tenants. System config may have "tenants" - list of dicts with "tenant"
+    name and keys that override base config (urls, request_headers, users...), e.g.
+    "tenants": [{"tenant": "uralchem", "request_headers": {...}}, {"tenant": "kirovo", "request_headers": {...}}]
+    :param system_config: system config from configs.json
+    :return: list of system configs, one config without "tenant" if there are no tenants
+    """
+    if not system_config.get('tenants'):
+        return [system_config]
+    base_config = {key: value for key, value in system_config.items() if key != 'tenants'}
+    return [{**base_config, **tenant_config} for tenant_config in system_config['tenants']]
+
+
 class Scetl:
 
     # Data type to create tables if none exist in database
@@ -21,7 +51,8 @@ class Scetl:
         'DATETIME': DateTime,
         'UNIXTIME_MS': DateTime,
         'UNIXTIME_S': DateTime,
-        'TEXT': Text
+        'TEXT': Text,
+        'CATEGORY': String
     }
 
     # Data type to convert pandas data frames
@@ -32,9 +63,18 @@ class Scetl:
         'DATETIME': 'datetime',
         'UNIXTIME_MS': 'unixtime_ms',
         'UNIXTIME_S': 'unixtime_s',
-        'TEXT': 'str'
+        'TEXT': 'str',
+        'CATEGORY': 'category'
     }
 
+    # VARCHAR columns with share of unique values below threshold are converted to categories automatically
+    # can be set in config as "category_threshold", 0 turns detection off
+    category_threshold = 0.5
+    category_min_rows = 50
+
+    # tenants of all systems run in threads and share one database, table writes are serialized
+    write_lock = threading.RLock()
+
     def __init__(self, config, engine):
         """
         Class needs two things - configs as dict and sqlalchemy engine
@@ -44,6 +84,150 @@ class Scetl:
         self.urls = config['urls']
         self.config = config
         self.engine = engine
+        # set for configs from "tenants" list, rows of shared tables are tagged with it, see get_tenant_configs
+        self.tenant = config.get('tenant')
+        self.run_cache = RunCache(type(self).__name__ + (f'.{self.tenant}' if self.tenant else ''))
+        # "fetch_mode": "async" in config makes bulk api calls concurrently on one event loop
+        self.is_async = config.get('fetch_mode', 'sync') == 'async'
+        # "record_format": "arrow" in config builds arrow tables from api records instead of DataFrames
+        self.is_arrow = config.get('record_format', 'pandas') == 'arrow'
+        self.async_fetcher = AsyncFetcher(config.get('rate_limits'), self.get_credential())
+        # keys changed in this run per rollup name, None means rollup should be rebuilt
+        self.changed_keys = {}
+        # each update_* call is a stage of profile when profiling is on
+        profiler.instrument(self, 'update_')
+        memory_budget.track(self, 'update_')
+
+    def get_base_frame(self, endpoint, params, payload):
+        """
+        DataFrame made from endpoint payload with last_update column, built once per run.
+        Tables made from the same call are projections of it
+        :param endpoint: endpoint name
+        :param params: python dict of call params
+        :param payload: list of records from api call
+        :return: DataFrame, should not be changed in place
+        """
+        def build():
+            df = pd.DataFrame(payload)
+            df['last_update'] = datetime.utcnow()
+            return df
+        return self.run_cache.get_frame(endpoint, params, build)
+
+    def iter_base_frames(self, endpoint, params, payload):
+        """
+        Base frame in chunks when memory budget is set ("memory" in configs), so that whole payload
+        never becomes one DataFrame. Without budget yields single cached base frame, see get_base_frame
+        :param endpoint: endpoint name
+        :param params: python dict of call params
+        :param payload: list of records from api call (or SpillBuffer)
+        :return: generator of DataFrames, should not be changed in place
+        """
+        if not memory_budget.enabled:
+            yield self.get_base_frame(endpoint, params, payload)
+            return
+        last_update = datetime.utcnow()
+        for records in memory_budget.iter_chunks(payload):
+            df = pd.DataFrame(records)
+            df['last_update'] = last_update
+            yield df
+
+    def write_table_chunks(self, table, frames, if_exists='append'):
+        """
+        Writes DataFrames one by one with write_table, first one with if_exists, the rest are appended
+        :param table: table dict from config dict (not table_name)
+        :param frames: iterable of DataFrames with proper data types
+        :param if_exists: 'append' or 'replace'
+        :return: number of rows written
+        """
+        rows = 0
+        for df in frames:
+            for df_chunk in memory_budget.iter_frame_chunks(df):
+                self.write_table(table, df_chunk, if_exists if rows == 0 else 'append')
+                rows += df_chunk.shape[0]
+        return rows
+
+    def get_credential(self, credential='default'):
+        """
+        Credential for rate limiter, requests of each tenant get their own token bucket and fair share of host
+        :param credential: token owner or 'default'
+        :return: string
+        """
+        if self.tenant is None:
+            return credential
+        return self.tenant if credential == 'default' else f'{self.tenant}.{credential}'
+
+    def http_request(self, method, url, credential='default', **kwargs):
+        """
+        Makes api call through per host rate limiter ("rate_limits" in system config)
+        :param method: 'get' or 'post'
+        :param url: url to call
+        :param credential: token owner, each one has its own rate limit (assess first users)
+        :param kwargs: params passed to requests.request (headers, params, data)
+        :return: requests.Response
+        """
+        return rate_limiter.request(method, url, self.get_credential(credential), self.config.get('rate_limits'),
+                                    **kwargs)
+
+    def tenant_filter(self, connector='AND'):
+        """
+        SQL condition limiting query to rows of tenant
+        :param connector: 'AND' or 'WHERE'
+        :return: string to append to query, empty if scetl has no tenant
+        """
+        if self.tenant is None:
+            return ''
+        return f" {connector} tenant = '{self.tenant}'"
+
+    def get_fingerprints_table(self):
+        """
+        Fingerprints table of scetl, tenants keep fingerprints separately since entity ids may repeat
+        :return: table name
+        """
+        if self.tenant is None:
+            return self.fingerprints_table
+        return f'{self.fingerprints_table}_{self.tenant}'
+
+    def get_queue_name(self, queue):
+        """
+        Work queue name, tenants get separate queues
+        :param queue: base queue name
+        :return: queue name
+        """
+        return queue if self.tenant is None else f'{queue}_{self.tenant}'
+
+    def fetch_all(self, requests):
+        """
+        Makes many api calls - concurrently with async fetcher in async fetch mode, one by one otherwise
+        :param requests: list of dicts with arguments of http_request (method, url, credential, headers, params)
+        :return: list of python dicts from responses in order of requests
+        """
+        if self.is_async:
+            return self.async_fetcher.fetch_all(requests)
+        return [decode_response(self.http_request(**x)) for x in requests]
+
+    def run_pipeline(self, name, items, transform=None, write=None):
+        """
+        Runs fetch, transform and write stages concurrently with bounded queues between them, see pipeline.py.
+        "pipeline_queue_size" in system config sets queue size (4 by default), 0 runs stages one after another
+        :param name: pipeline name in run metrics
+        :param items: generator making api calls
+        :param transform: function converting fetched item, e.g. to DataFrames
+        :param write: function writing transformed item to db
+        :return: number of written items
+        """
+        name = f'{type(self).__name__}.{name}' + (f'.{self.tenant}' if self.tenant else '')
+        queue_size = int(self.config.get('pipeline_queue_size', 4))
+        return Pipeline(name, queue_size).run(items, transform, write)
+
+    def iter_json_items(self, request, path, meta=None):
+        """
+        Makes streamed api call and yields elements of top level array one at a time, see json_decode.iter_items
+        :param request: dict with arguments of http_request
+        :param path: top level key of array, e.g. 'Items' or 'elements'
+        :param meta: dict to fill with other scalar values of response, e.g. 'paging.total'
+        :return: generator of python dicts
+        """
+        return iter_items(self.http_request(stream=True, **request), path, meta)
 
     def add_missing_columns(self, table, df):
         """
@@ -61,15 +245,26 @@ class Scetl:
                 df[col] = None
         return df
 
+    def is_low_cardinality(self, series):
+        """
+        Checks if column has few repeated values so that it's cheaper to keep it as category
+        :param series: column of DataFrame converted to str
+        :return: Bool, True if column should be category
+        """
+        threshold = float(self.config.get('category_threshold', self.category_threshold))
+        return series.shape[0] >= self.category_min_rows and series.nunique() <= series.shape[0] * threshold
+
     def apply_data_types(self, table, df):
         """
         Transforms pd.DataFrame data types in accordance with schema provided in config-tables
+        Memory used by table with and without categories is added to run metrics
         :param table: table dict from config dict (not table_name)
         :param df: DataFrame to process, usually df made from api call json
         :return: same df with proper data types
         """
         cols = self.config['tables'][table]['columns']
         col_dict = {x['name']: self.pd_data_types[x['type']] for x in cols}
+        type_dict = {x['name']: x['type'] for x in cols}
         df = df.copy()
         for col in df.columns:
             if col_dict[col] == 'datetime':
@@ -79,10 +274,49 @@ class Scetl:
                 df[col] = pd.to_datetime(df[col], unit='ms')
             elif col_dict[col] == 'unixtime_s':
                 df[col] = pd.to_datetime(df[col], unit='s')
+            elif col_dict[col] == 'category':
+                df[col] = df[col].astype(str).astype('category')
             else:
                 df[col] = df[col].astype(col_dict[col])
+                if type_dict[col] == 'VARCHAR' and self.is_low_cardinality(df[col]):
+                    df[col] = df[col].astype('category')
+
+        category_cols = [x for x in df.columns if df[x].dtype.name == 'category']
+        memory = int(df.memory_usage(deep=True).sum())
+        memory_without_categories = memory + sum(
+            int(df[x].astype(object).memory_usage(deep=True) - df[x].memory_usage(deep=True)) for x in category_cols
+        )
+        table_name = self.config['tables'][table]['table_name']
+        run_metrics.add('table_memory_bytes', table_name, memory)
+        run_metrics.add('table_memory_bytes_without_categories', table_name, memory_without_categories)
+        if self.tenant is not None:
+            df['tenant'] = self.tenant
         return df
 
+    def make_frame(self, table, records, constants=None):
+        """
+        Makes table data with proper data types from api records: arrow table built column by column
+        if "record_format" is "arrow" in system config, otherwise DataFrame made by apply_data_types.
+        Columns missing in records are empty, columns not in config are dropped
+        :param table: table dict from config dict (not table_name)
+        :param records: list of dicts, usually from api call json
+        :param constants: dict of column name and value for every row, e.g. last_update
+        :return: pa.Table or DataFrame, both can be passed to write_table
+        """
+        constants = constants or {}
+        if self.is_arrow:
+            if self.tenant is not None:
+                constants = {**constants, 'tenant': self.tenant}
+            threshold = float(self.config.get('category_threshold', self.category_threshold))
+            return records_to_table(records, self.config['tables'][table], constants, threshold,
+                                    self.category_min_rows)
+        table_name, table_cols = self.get_table_params(table)
+        df = pd.DataFrame(records)
+        for column, value in constants.items():
+            df[column] = value
+        df = self.add_missing_columns(table, df)
+        return self.apply_data_types(table, df[table_cols])
+
     def check_tables(self):
         """
         Check if tables provided in configs exist and if not - create them with proper data types (sql_data_types)
@@ -91,11 +325,23 @@ class Scetl:
         metadata = MetaData(self.engine)
         tables = self.config['tables']
         for db_table in tables:
-            if not self.engine.dialect.has_table(self.engine, tables[db_table]['table_name']):
+            if get_history_store(tables[db_table]) is not None:
+                continue
+            table_name = tables[db_table]['table_name']
+            if not inspect(self.engine).has_table(table_name):
                 logging.info(f'No table {db_table}, creating one')
                 columns = [Column(col['name'], self.sql_data_types[col['type']]) for col in tables[db_table]['columns']]
-                Table(tables[db_table]['table_name'], metadata, *columns)
-        metadata.create_all()
+                if self.tenant is not None:
+                    columns.append(Column('tenant', String))
+                Table(table_name, metadata, *columns)
+            elif self.tenant is not None:
+                existing_columns = [x['name'] for x in inspect(self.engine).get_columns(table_name)]
+                if 'tenant' not in existing_columns:
+                    logging.info(f'Adding tenant column to {table_name}')
+                    with self.write_lock, self.engine.begin() as connection:
+                        connection.execute(f'ALTER TABLE {table_name} ADD tenant VARCHAR(255)')
+        with self.write_lock:
+            metadata.create_all()
 
     def get_table_params(self, table):
         """
@@ -108,15 +354,120 @@ class Scetl:
         table_name = table_dict['table_name']
         return table_name, table_cols
 
+    def get_table_store(self, table_name):
+        """
+        Finds parquet store for table if table is configured with "storage": "parquet"
+        :param table_name: table name from database
+        :return: ParquetHistoryStore or None if table is in database
+        """
+        for table in self.config['tables']:
+            if self.config['tables'][table]['table_name'] == table_name:
+                return get_history_store(self.config['tables'][table])
+        return None
+
+    def write_table(self, table, df, if_exists='append', where=None):
+        """
+        Writes df either to database or to parquet store depending on table config
+        :param table: table dict from config dict (not table_name)
+        :param df: DataFrame with proper data types (result of apply_data_types) or arrow table from make_frame
+        :param if_exists: 'append' or 'replace', same as in to_sql
+        :param where: sql condition of rows replaced by df, e.g. "user_id = 1". They are deleted (for this tenant)
+        in the same locked transaction as insert, so other tenants never see table without them
+        :return: None, writes results to db or parquet files
+        """
+        table_name = self.config['tables'][table]['table_name']
+        store = get_history_store(self.config['tables'][table])
+        if store is not None and where is not None:
+            raise ValueError(f'Table {table_name} is in parquet store, rows can not be replaced by condition')
+        if isinstance(df, pa.Table) and store is not None:
+            df = df.to_pandas()
+        if where is not None:
+            delete_filter = f' WHERE {where}{self.tenant_filter()}'
+        elif if_exists == 'replace' and self.tenant is not None:
+            # other tenants' rows of shared table stay
+            delete_filter = self.tenant_filter('WHERE')
+        elif if_exists == 'replace' and isinstance(df, pa.Table):
+            # arrow rows replace rows, table made by check_tables keeps its columns and types
+            delete_filter = ''
+        else:
+            delete_filter = None
+        with self.write_lock:
+            if store is None:
+                with self.engine.begin() as connection:
+                    if delete_filter is not None and self.engine.dialect.has_table(connection, table_name):
+                        connection.execute(f'DELETE FROM {table_name}{delete_filter}')
+                    sql_if_exists = 'append' if delete_filter is not None else if_exists
+                    if isinstance(df, pa.Table):
+                        # rows go to executemany straight from arrow columns
+                        create_table(connection, table_name, df)
+                        insert_table(connection, table_name, df)
+                    else:
+                        df.to_sql(table_name, con=connection, if_exists=sql_if_exists, index=False)
+            elif if_exists == 'replace':
+                if self.tenant is not None:
+                    df_others = store.read()
+                    if 'tenant' in df_others:
+                        df = pd.concat([df_others[df_others['tenant'] != self.tenant], df], ignore_index=True)
+                store.replace(df)
+            else:
+                store.append(df)
+        if isinstance(df, pa.Table):
+            # rollups only need key columns of written rows
+            key_columns = set(x['key_column'] for x in self.config.get('rollups', {}).values())
+            df = pd.DataFrame({x: df.column(x).to_pylist() for x in key_columns if x in df.schema.names})
+        self.mark_changed(table, None if if_exists == 'replace' else df)
+
+    def get_rollup(self, name):
+        """
+        Makes RollupTable from "rollups" in system config
+        :param name: rollup name
+        :return: RollupTable
+        """
+        rollup_dict = self.config['rollups'][name]
+        return RollupTable(rollup_dict, self.config['tables'][rollup_dict['source']], self.engine, self.tenant)
+
+    def mark_changed(self, table, df=None):
+        """
+        Remembers keys written to table, so that rollups made from it are updated for these keys only
+        :param table: table dict from config dict (not table_name)
+        :param df: written rows, None if table was replaced
+        :return: None
+        """
+        for name, rollup_dict in self.config.get('rollups', {}).items():
+            if rollup_dict['source'] != table:
+                continue
+            if df is None or rollup_dict['key_column'] not in df:
+                self.changed_keys[name] = None
+            elif self.changed_keys.get(name, set()) is not None:
+                self.changed_keys.setdefault(name, set()).update(df[rollup_dict['key_column']].tolist())
+
+    def update_rollups(self):
+        """
+        Updates rollups for keys changed during run, rollups that do not exist yet are built from scratch
+        :return: None, writes results to db
+        """
+        for name in self.config.get('rollups', {}):
+            rollup = self.get_rollup(name)
+            keys = self.changed_keys.get(name, set())
+            with self.write_lock:
+                if keys is None or not inspect(self.engine).has_table(rollup.table_name):
+                    rollup.update()
+                elif keys:
+                    rollup.update(keys)
+        self.changed_keys = {}
+
     def get_last_update_ts(self, table_name):
         """
         Several calls require to get date of last update from database to check if data should be added
-        This function returns last updated date from database
+        This function returns last updated date from database (or from parquet manifest without scanning rows)
         :param table_name: table name from database
         :return: max datetime of last_update column for this table
         """
+        store = self.get_table_store(table_name)
+        if store is not None:
+            return store.get_last_update_ts(self.tenant)
         with self.engine.connect() as connection:
-            query = f'SELECT MAX(last_update) FROM {table_name}'
+            query = f'SELECT MAX(last_update) FROM {table_name}{self.tenant_filter("WHERE")}'
             last_update_ts = connection.execute(query).fetchone()[0]
             last_update_ts = pd.to_datetime(last_update_ts, yearfirst=True)
         return last_update_ts
@@ -129,17 +480,34 @@ class Scetl:
 
 class EdusonScetl(Scetl):
 
+    # hashes of user fields from previous run, used to find users whose courses should be refetched
+    fingerprints_table = 'eduson_user_fingerprints'
+
     def get_user_json(self):
         """
         Make an api call to eduson/users endpoint and return python dict from response
+        Call is made once per run, result is kept in run cache
         :return: dict with data from api call
         """
+        def fetch():
+            headers = {
+                self.config['request_headers']['header_name']: self.config['request_headers']['header_value']
+            }
+            url = self.urls['users']['url']
+            return decode_response(self.http_request('get', url, headers=headers))
+        return self.run_cache.get_payload('users', {}, fetch)
+
+    def get_user_courses_request(self, user_id):
+        """
+        Arguments of eduson/user/courses api call, shared by sync and async calls
+        :param user_id: path variable for api call and unique id for user in eduson
+        :return: dict with arguments of http_request
+        """
         headers = {
             self.config['request_headers']['header_name']: self.config['request_headers']['header_value']
         }
-        url = self.urls['users']['url']
-        response = requests.get(url, headers=headers).json()
-        return response
+        url = self.urls['user_courses']['url'].replace('{id}', str(user_id))
+        return {'method': 'get', 'url': url, 'headers': headers}
 
     def get_user_courses_json(self, user_id):
         """
@@ -147,11 +515,7 @@ class EdusonScetl(Scetl):
         :param user_id: path variable for api call and unique id for user in eduson
         :return: dict with data from api call
         """
-        headers = {
-            self.config['request_headers']['header_name']: self.config['request_headers']['header_value']
-        }
-        url = self.urls['user_courses']['url'].replace('{id}', str(user_id))
-        response = requests.get(url, headers=headers).json()
+        response = decode_response(self.http_request(**self.get_user_courses_request(user_id)))
         return response
 
     def update_users(self, user_json):
@@ -162,11 +526,20 @@ class EdusonScetl(Scetl):
         """
         table_name, table_cols = self.get_table_params('users')
 
-        df_initial_users = pd.DataFrame(user_json)
-        df_initial_users['last_update'] = datetime.utcnow()
-        df_initial_users = df_initial_users[table_cols]
+        df_initial_users = self.get_base_frame('users', {}, user_json)[table_cols]
         df_initial_users = self.apply_data_types('users', df_initial_users)
-        df_initial_users.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        self.write_table('users', df_initial_users, if_exists='replace')
+
+    def get_user_courses_frame(self, table, user_id, user_courses_json):
+        """
+        Makes DataFrame of user_courses or user_courses_changes from get_user_courses_json result
+        :param table: 'user_courses' or 'user_courses_changes'
+        :param user_id: user id for Eduson
+        :param user_courses_json: results from get_user_courses_json call
+        :return: DataFrame or arrow table, see make_frame
+        """
+        constants = {'last_update': datetime.utcnow(), 'user_id': user_id}
+        return self.make_frame(table, user_courses_json['courses'], constants)
 
     def update_user_courses_changes(self, user_id, user_courses_json=None):
         """
@@ -175,43 +548,124 @@ class EdusonScetl(Scetl):
         :param user_courses_json: results from get_user_courses_json call
         :return: None, writes results to db
         """
-        table_name, table_cols = self.get_table_params('user_courses_changes')
         if user_courses_json is None:
             user_courses_json = self.get_user_courses_json(user_id)
-        df = pd.DataFrame(user_courses_json['courses'])
-        df['last_update'] = datetime.utcnow()
-        df['user_id'] = user_id
-        df = df[table_cols]
-        df = self.apply_data_types('user_courses_changes', df)
-        df.to_sql(table_name, con=self.engine, if_exists='append', index=False)
+        self.write_table('user_courses_changes',
+                         self.get_user_courses_frame('user_courses_changes', user_id, user_courses_json))
+
+    def transform_user_courses(self, fetched):
+        """
+        Transform stage of user courses update
+        :param fetched: tuple of user id and get_user_courses_json result
+        :return: tuple of user id, user_courses and user_courses_changes DataFrames, None if user has no courses
+        """
+        user_id, response = fetched
+        if not response['courses']:
+            return None
+        return (user_id, self.get_user_courses_frame('user_courses', user_id, response),
+                self.get_user_courses_frame('user_courses_changes', user_id, response))
 
-    def update_user_courses(self, user_id):
+    def write_user_courses(self, transformed):
+        """
+        Write stage of user courses update: removes all previous data for this user courses and writes new data
+        :param transformed: result of transform_user_courses
+        :return: None, writes results to db
+        """
+        user_id, df_user_courses, df_user_courses_changes = transformed
+        self.write_table('user_courses', df_user_courses, where=f'user_id = {user_id}')
+        self.write_table('user_courses_changes', df_user_courses_changes)
+
+    def update_user_courses(self, user_id, response=None):
         """
         Updating user courses data if user had any activity since last update
         Function calls for json, removes all previous data for this user courses and writes json data to db
         :param user_id: user id for Eduson
+        :param response: results from get_user_courses_json call if it was already made (e.g. by queue worker)
         :return: None, writes results to db
         """
-        table_name, table_cols = self.get_table_params('user_courses')
+        if response is None:
+            response = self.get_user_courses_json(user_id)
+        transformed = self.transform_user_courses((user_id, response))
+        if transformed is not None:
+            self.write_user_courses(transformed)
+
+    def iter_user_courses(self, user_ids):
+        """
+        Fetch stage of user courses update: makes user courses calls, in batches of concurrent calls if async
+        :param user_ids: list of user ids
+        :return: generator of tuples of user id and get_user_courses_json result
+        """
+        if not self.is_async:
+            for user_id in user_ids:
+                logging.info(f'Getting data for user {user_id}')
+                yield user_id, self.get_user_courses_json(user_id)
+            return
+        batch_size = int(self.config.get('async_batch_size', 200))
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            logging.info(f'Getting data for users {start + 1}-{start + len(batch)} out of {len(user_ids)}')
+            responses = self.fetch_all([self.get_user_courses_request(x) for x in batch])
+            yield from zip(batch, responses)
+
+    def get_fingerprint_columns(self):
+        """
+        Columns of user_changes that make user's fingerprint.
+        Can be set in config as "fingerprint_columns", by default all but our last_update are used.
+        updated_at of api stays: it is compared with its own value from previous run, not with our clock,
+        and it is the only field of users endpoint that changes when user makes progress on courses
+        :return: list of column names
+        """
+        if 'fingerprint_columns' in self.config:
+            return self.config['fingerprint_columns']
+        table_name, table_cols = self.get_table_params('user_changes')
+        return [x for x in table_cols if x != 'last_update']
 
-        response = self.get_user_courses_json(user_id)
-        if response['courses']:
-            df_user_courses = pd.DataFrame(response['courses'])
-            df_user_courses['last_update'] = datetime.utcnow()
-            df_user_courses['user_id'] = user_id
-            df_user_courses = df_user_courses[table_cols]
-            df_user_courses = self.apply_data_types('user_courses', df_user_courses)
+    def get_course_summaries(self, user_ids=None):
+        """
+        Summary of courses stored for each user - hash of user's rows of user_courses without timestamps.
+        Users endpoint has no course data, so it is summary of courses written on previous runs: users whose
+        stored courses were lost or differ from ones written with their fingerprint are refetched
+        :param user_ids: list of user ids, None for all users
+        :return: dict where key is user id and value is hash
+        """
+        table_name, table_cols = self.get_table_params('user_courses')
+        if not inspect(self.engine).has_table(table_name):
+            return {}
+        if user_ids is None:
+            df = pd.read_sql(f'SELECT * FROM {table_name}{self.tenant_filter("WHERE")}', con=self.engine)
+        elif not len(user_ids):
+            return {}
+        else:
+            user_ids = [x.item() if hasattr(x, 'item') else x for x in user_ids]
+            query = text(f'SELECT * FROM {table_name} WHERE user_id IN :user_ids{self.tenant_filter()}').bindparams(
+                bindparam('user_ids', expanding=True))
+            # sqlite has limit on number of variables in one statement
+            df = pd.concat([pd.read_sql(query, con=self.engine, params={'user_ids': user_ids[i:i + 500]})
+                            for i in range(0, len(user_ids), 500)], ignore_index=True)
+        columns = sorted([x for x in df.columns if x not in ['last_update', 'tenant']])
+        # rows of some users may be read with other dtypes than whole table (e.g. int vs float with NaN)
+        column_types = {x['name']: x['type'] for x in self.config['tables']['user_courses']['columns']}
+        row_hashes = FingerprintStore.hash_frame(df, columns, column_types)
+        return {user_id: FingerprintStore.hash_payload(sorted(x)) for user_id, x in row_hashes.groupby(df['user_id'])}
 
-            with self.engine.connect() as connection:
-                query = f'DELETE FROM eduson_user_courses WHERE user_id = {user_id}'
-                connection.execute(query)
-            df_user_courses.to_sql(table_name, con=self.engine, if_exists='append', index=False)
-            self.update_user_courses_changes(user_id, response)
+    @staticmethod
+    def get_user_fingerprints(user_ids, user_hashes, course_summaries):
+        """
+        Fingerprints of users: hash of user fields and of course summary
+        :param user_ids: iterable of user ids
+        :param user_hashes: iterable of hashes of user fingerprint columns, same order as user_ids
+        :param course_summaries: result of get_course_summaries
+        :return: list of fingerprints
+        """
+        return [FingerprintStore.hash_payload([user_hash, course_summaries.get(user_id)])
+                for user_id, user_hash in zip(user_ids, user_hashes)]
 
     def update_user_changes(self):
         """
         One of the main functions.
         Calls other functions - creating tables, updating user table, updating courses for users that have changes
+        Users are considered changed if hash of their fingerprint columns and stored courses differs
+        from one saved on previous run
         :return: None, writes results to db
         """
         table_name, table_cols = self.get_table_params('user_changes')
@@ -222,21 +676,75 @@ class EdusonScetl(Scetl):
         user_json = self.get_user_json()
         self.update_users(user_json)
 
-        df_new_user_changes = pd.DataFrame(user_json)
-        df_new_user_changes['last_update'] = datetime.utcnow()
-        df_new_user_changes = df_new_user_changes[table_cols]
+        df_new_user_changes = self.get_base_frame('users', {}, user_json)[table_cols]
         df_new_user_changes = self.apply_data_types('user_changes', df_new_user_changes)
 
+        fingerprint_store = FingerprintStore(self.engine, self.get_fingerprints_table(), 'user_id')
+        known_fingerprints = fingerprint_store.load()
+        user_hashes = FingerprintStore.hash_frame(df_new_user_changes, self.get_fingerprint_columns())
+        fingerprints = self.get_user_fingerprints(df_new_user_changes['id'], user_hashes, self.get_course_summaries())
+        is_changed = pd.Series(
+            [known_fingerprints.get(user_id, {}).get('fingerprint') != fingerprint
+             for user_id, fingerprint in zip(df_new_user_changes['id'], fingerprints)],
+            index=df_new_user_changes.index
+        )
+
         if last_update_ts is None:
-            df_new_user_changes.to_sql(table_name, con=self.engine, index=False, if_exists='replace')
+            # first run fetches everyone by both methods
+            is_changed_by_ts = pd.Series(True, index=df_new_user_changes.index)
         else:
             logging.info(f'updating data from {last_update_ts}')
-            df_new_user_changes = df_new_user_changes[df_new_user_changes['updated_at'] > last_update_ts].copy()
-            df_new_user_changes.to_sql(table_name, con=self.engine, index=False, if_exists='append')
-
-        for user_id in df_new_user_changes['id']:
-            logging.info(f'Getting data for user {user_id}')
-            self.update_user_courses(user_id)
+            is_changed_by_ts = df_new_user_changes['updated_at'] > last_update_ts
+        section = f'fingerprints.{self.get_fingerprints_table()}'
+        run_metrics.add(section, 'users', int(df_new_user_changes.shape[0]))
+        run_metrics.add(section, 'changed_by_fingerprint', int(is_changed.sum()))
+        run_metrics.add(section, 'changed_by_updated_at', int(is_changed_by_ts.sum()))
+        run_metrics.add(section, 'calls_avoided', int((is_changed_by_ts & ~is_changed).sum()))
+        run_metrics.add(section, 'changes_updated_at_would_miss', int((is_changed & ~is_changed_by_ts).sum()))
+        logging.info(f'Changed users by fingerprint: {is_changed.sum()}, by updated_at: {is_changed_by_ts.sum()}')
+        if last_update_ts is None:
+            self.write_table_chunks('user_changes', [df_new_user_changes], if_exists='replace')
+        else:
+            self.write_table('user_changes', df_new_user_changes[is_changed].copy())
+
+        df_changed = df_new_user_changes[is_changed]
+        if 'work_queue' in self.config:
+            queue = self.get_queue_name('eduson_user_courses')
+            written = run_coordinator(self, queue, [(x, None) for x in df_changed['id']])
+            is_changed = is_changed & df_new_user_changes['id'].astype(str).isin(written)
+            df_changed = df_new_user_changes[is_changed]
+        else:
+            # user N+1 is fetched while user N is converted and written
+            self.run_pipeline('user_courses', self.iter_user_courses(list(df_changed['id'])),
+                              self.transform_user_courses, self.write_user_courses)
+        # saved fingerprints have summaries of courses just written
+        fingerprints = self.get_user_fingerprints(df_changed['id'], user_hashes[is_changed],
+                                                  self.get_course_summaries(list(df_changed['id'])))
+        with self.write_lock:
+            fingerprint_store.save({
+                user_id: {'fingerprint': fingerprint} for user_id, fingerprint in zip(df_changed['id'], fingerprints)
+            })
+
+    def fetch_work_item(self, queue, item, payload):
+        """
+        Work queue worker side - fetches user courses
+        :param queue: queue name
+        :param item: user id
+        :param payload: not used
+        :return: result of get_user_courses_json
+        """
+        return self.get_user_courses_json(int(item))
+
+    def write_work_results(self, queue, results):
+        """
+        Work queue coordinator side - writes user courses fetched by workers
+        :param queue: queue name
+        :param results: list of (item, payload, result) tuples
+        :return: None, writes results to db
+        """
+        for item, payload, result in results:
+            logging.info(f'Writing data for user {item}')
+            self.update_user_courses(int(item), result)
 
     def update_scetl(self):
         """
@@ -245,6 +753,8 @@ class EdusonScetl(Scetl):
         """
         self.check_tables()
         self.update_user_changes()
+        self.update_rollups()
+        self.run_cache.clear()
 
 
 # ------------
@@ -258,14 +768,23 @@ class CourseraScetl(Scetl):
     access_token = None
     access_token_updated_at = None
 
+    def get_token_path(self):
+        """
+        File with current access token, each tenant has its own
+        :return: configs/coursera_token.json or configs/coursera_token_<tenant>.json
+        """
+        if self.tenant is None:
+            return 'configs/coursera_token.json'
+        return f'configs/coursera_token_{self.tenant}.json'
+
     def check_token_freshness(self):
         """
         Checks if access token needs refreshing
-        Current access token is stored in configs/coursera_token.json
+        Current access token is stored in file from get_token_path
         :return: Bool, True is token is fresh and valid
         """
-        if os.path.exists('configs/coursera_token.json'):
-            with open('configs/coursera_token.json') as token_json:
+        if os.path.exists(self.get_token_path()):
+            with open(self.get_token_path()) as token_json:
                 access_token_dict = json.load(token_json)
             token_last_update_time = datetime.strptime(access_token_dict['date_updated'], '%Y-%m-%d %H:%M')
             token_lifetime = (datetime.utcnow() - token_last_update_time).total_seconds()
@@ -285,14 +804,14 @@ class CourseraScetl(Scetl):
         """
         url = self.urls['get_access_token']['url']
         body = self.urls['get_access_token']['body_params']
-        response = requests.post(url, data=body).json()
+        response = decode_response(self.http_request('post', url, data=body))
 
         new_token_dict = {
             'access_token': response['access_token'],
             'date_updated': datetime.strftime(datetime.utcnow(), '%Y-%m-%d %H:%M')
         }
 
-        with open('configs/coursera_token.json', 'w') as file:
+        with open(self.get_token_path(), 'w') as file:
             file.write(json.dumps(new_token_dict))
 
         self.access_token = new_token_dict['access_token']
@@ -313,18 +832,42 @@ class CourseraScetl(Scetl):
     def get_paged_json(self, url):
         """
         Makes paginated response from any of coursera api calls and returns one long list of contents
+        Each url is called once per run, result is kept in run cache
+        :param url: url of api call
+        :return: list of response's 'elements'
+        """
+        return self.run_cache.get_payload('paged', {'url': url}, lambda: self.fetch_paged_json(url))
+
+    def fetch_paged_json(self, url):
+        """
+        Makes all page calls for get_paged_json
         :param url: url of api call
         :return: list of response's 'elements'
         """
+        if self.is_async:
+            return self.async_fetcher.run(self.fetch_paged_json_async, url)
         headers = self.get_coursera_request_headers()
         org_id = self.config['global_params']['path_variables']['orgId']
         start = int(self.config['global_params']['params']['start'])
         limit = int(self.config['global_params']['params']['limit'])
         url = url.replace('{orgId}', org_id)
+        # spills pages to disk when memory budget is exceeded
+        concat_response = memory_budget.make_buffer('coursera_' + url.rstrip('/').split('/')[-1])
+        # page N+1 is fetched and parsed while page N is added to buffer
+        self.run_pipeline('pages', self.iter_pages(url, headers, start, limit), write=concat_response.extend)
+        return concat_response
+
+    def iter_pages(self, url, headers, start, limit):
+        """
+        Fetch stage of fetch_paged_json, each page gives total number of records
+        :param url: url of api call with orgId
+        :param headers: request headers
+        :param start: first record
+        :param limit: records per page
+        :return: generator of lists of response's 'elements'
+        """
         total_records = 0
         page = 0
-        paged_response = {}
-
         while start <= total_records:
             params = {
                 'start': start,
@@ -332,13 +875,35 @@ class CourseraScetl(Scetl):
             }
             page += 1
             logging.info(f'updating page {page}: calling {url} with params {params}')
-            response = requests.get(url, headers=headers, params=params).json()
+            meta = {}
+            request = {'method': 'get', 'url': url, 'headers': headers, 'params': params}
+            yield list(self.iter_json_items(request, 'elements', meta))
             start += limit
-            total_records = int(response['paging']['total'])
-            paged_response[f'page_{page}'] = response
+            total_records = int(meta['paging.total'])
 
-        concat_response = [item for x in paged_response.keys() for item in paged_response[x]['elements']]
-        return concat_response
+    async def fetch_paged_json_async(self, session, url):
+        """
+        Async version of fetch_paged_json: first page gives total, the rest of pages are called concurrently
+        :param session: aiohttp.ClientSession
+        :param url: url of api call
+        :return: list of response's 'elements'
+        """
+        headers = self.get_coursera_request_headers()
+        org_id = self.config['global_params']['path_variables']['orgId']
+        start = int(self.config['global_params']['params']['start'])
+        limit = int(self.config['global_params']['params']['limit'])
+        url = url.replace('{orgId}', org_id)
+        requests = [{'method': 'get', 'url': url, 'headers': headers, 'params': {'start': start, 'limit': limit}}]
+        logging.info(f'updating page 1: calling {url} with params {requests[0]["params"]}')
+        first_page = await self.async_fetcher.request(session, requests[0])
+        total_records = int(first_page['paging']['total'])
+        requests = [
+            {'method': 'get', 'url': url, 'headers': headers, 'params': {'start': x, 'limit': limit}}
+            for x in range(start + limit, total_records + 1, limit)
+        ]
+        logging.info(f'updating pages 2-{len(requests) + 1} of {url} concurrently')
+        pages = [first_page] + await self.async_fetcher.gather(session, requests)
+        return [item for page in pages for item in page['elements']]
 
     def get_enrolments_json(self):
         """
@@ -373,24 +938,18 @@ class CourseraScetl(Scetl):
         Clean and save results of get_invitations_json to database
         :return: None, writes results to db
         """
-        table_name, table_cols = self.get_table_params('invitations')
         invitations_json = self.get_invitations_json()
-        df = pd.DataFrame(invitations_json)
-        df['last_update'] = datetime.utcnow()
-        df = self.apply_data_types('invitations', df[table_cols])
-        df.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        df = self.make_frame('invitations', list(invitations_json), {'last_update': datetime.utcnow()})
+        self.write_table('invitations', df, if_exists='replace')
 
     def update_memberships(self):
         """
         Clean and save results of get_memberships_json to database
         :return: None, writes results to db
         """
-        table_name, table_cols = self.get_table_params('memberships')
         memberships_json = self.get_memberships_json()
-        df = pd.DataFrame(memberships_json)
-        df['last_update'] = datetime.utcnow()
-        df = self.apply_data_types('memberships', df[table_cols])
-        df.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        df = self.make_frame('memberships', list(memberships_json), {'last_update': datetime.utcnow()})
+        self.write_table('memberships', df, if_exists='replace')
 
     def update_enrolments(self, enrolments_json=None):
         """
@@ -403,10 +962,10 @@ class CourseraScetl(Scetl):
         if enrolments_json is None:
             enrolments_json = self.get_enrolments_json()
 
-        df = pd.DataFrame(enrolments_json)
-        df['last_update'] = datetime.utcnow()
-        df = self.apply_data_types('enrolments', df[table_cols])
-        df.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        for i, df in enumerate(self.iter_base_frames('enrolments', {}, enrolments_json)):
+            df = self.apply_data_types('enrolments', df[table_cols])
+            self.write_table('enrolments', df, if_exists='replace' if i == 0 else 'append')
+        self.mark_changed('enrolments')
 
     def update_contents(self):
         """
@@ -415,7 +974,6 @@ class CourseraScetl(Scetl):
         :return: None, writes results to db
         """
         contents_json = self.get_contents_json()
-        df = pd.DataFrame(contents_json)
 
         def extract_metadata(metadata_dict):
             if metadata_dict['typeName'] == 'courseMetadata':
@@ -423,23 +981,28 @@ class CourseraScetl(Scetl):
             else:
                 return [x['contentId'] for x in metadata_dict['definition']['courseIds']]
 
-        # getting relationship between specializations and courses
-        table_name, table_cols = self.get_table_params('specialization_courses')
-        logging.info(f'Updating {table_name}')
-        df_sc = df[df['contentType'] == 'Specialization'][['contentId', 'extraMetadata']].copy()
-        df_sc['courseId'] = df_sc['extraMetadata'].apply(lambda x: extract_metadata(x))
-        df_sc = df_sc.explode('courseId')
-        df_sc = df_sc[['courseId', 'contentId']]
-        df_sc = self.apply_data_types('specialization_courses', df_sc)
-        df_sc.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
-
-        df.loc[df['contentType'] == 'Course',
-               'estimatedLearningTime'] = df['extraMetadata'].apply(lambda x: extract_metadata(x))
-
-        table_name, table_cols = self.get_table_params('contents')
-        df_con = df[table_cols].copy()
-        df_con = self.apply_data_types('contents', df_con)
-        df_con.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        # contents are processed in chunks if memory budget is set, first chunk replaces tables
+        for i, records in enumerate(memory_budget.iter_chunks(contents_json)):
+            if_exists = 'replace' if i == 0 else 'append'
+            df = pd.DataFrame(records)
+
+            # getting relationship between specializations and courses
+            table_name, table_cols = self.get_table_params('specialization_courses')
+            logging.info(f'Updating {table_name}')
+            df_sc = df[df['contentType'] == 'Specialization'][['contentId', 'extraMetadata']].copy()
+            df_sc['courseId'] = df_sc['extraMetadata'].apply(lambda x: extract_metadata(x))
+            df_sc = df_sc.explode('courseId')
+            df_sc = df_sc[['courseId', 'contentId']]
+            df_sc = self.apply_data_types('specialization_courses', df_sc)
+            self.write_table('specialization_courses', df_sc, if_exists=if_exists)
+
+            df.loc[df['contentType'] == 'Course',
+                   'estimatedLearningTime'] = df['extraMetadata'].apply(lambda x: extract_metadata(x))
+
+            table_name, table_cols = self.get_table_params('contents')
+            df_con = df[table_cols].copy()
+            df_con = self.apply_data_types('contents', df_con)
+            self.write_table('contents', df_con, if_exists=if_exists)
 
     def update_user_changes(self):
         """
@@ -454,30 +1017,33 @@ class CourseraScetl(Scetl):
 
         # get list of existing content
         with self.engine.connect() as connection:
-            query = 'SELECT contentId FROM coursera_contents'
+            query = f'SELECT contentId FROM coursera_contents{self.tenant_filter("WHERE")}'
             existing_content_ids = [x[0] for x in connection.execute(query).fetchall()]
 
         enrolments_json = self.get_enrolments_json()
         self.update_enrolments(enrolments_json)
 
-        # check if any changes
-        df = pd.DataFrame(enrolments_json)
-        df['last_update'] = datetime.utcnow()
-        df = df[table_cols].copy()
-        df = self.apply_data_types('enrolments_changes', df[table_cols])
+        # check if any changes, chunk by chunk if memory budget is set
+        has_new_contents = False
+        rows = 0
+        for df in self.iter_base_frames('enrolments', {}, enrolments_json):
+            df = self.apply_data_types('enrolments_changes', df[table_cols])
+            has_new_contents = has_new_contents or not df['contentId'].isin(existing_content_ids).all()
+            if last_update_ts is None:
+                self.write_table('enrolments_changes', df, if_exists='replace' if rows == 0 else 'append')
+            else:
+                df = df[df['lastActivityAt'] > last_update_ts].copy()
+                self.write_table('enrolments_changes', df)
+            rows += df.shape[0]
+        if last_update_ts is None:
+            logging.info(f'No changes found, wrote {rows} rows of initial data')
+        else:
+            logging.info(f'Added {rows} record with updates from {last_update_ts}')
 
         # if new contents in enrolments - update all content lists
-        if not all(x in existing_content_ids for x in df['contentId']):
+        if has_new_contents:
             self.update_contents()
 
-        if last_update_ts is None:
-            logging.info(f'No changes found, writing initial data')
-            df.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
-        else:
-            df = df[df['lastActivityAt'] > last_update_ts].copy()
-            logging.info(f'Adding {df.shape[0]} record with updates from {last_update_ts}')
-            df.to_sql(table_name, con=self.engine, index=False, if_exists='append')
-
     def update_scetl(self):
         """
         Check if tables exist and start data update routines
@@ -487,6 +1053,8 @@ class CourseraScetl(Scetl):
         self.update_memberships()
         self.update_invitations()
         self.update_user_changes()
+        self.update_rollups()
+        self.run_cache.clear()
 
 
 # -----------------
@@ -500,15 +1068,42 @@ class AssessFirstScetl(Scetl):
     # each user has his own token and his candidates are only accessible with his token
     # so all methods have user as parameter, so that api call can get api token for this user
 
+    # payload hash of candidate from candidates list and finished assessments count from previous runs
+    fingerprints_table = 'assess_first_candidate_fingerprints'
+
+    # rollup with finished assessments per candidate, used instead of aggregating assessments if configured
+    statuses_rollup = 'candidate_statuses'
+
+    def __init__(self, config, engine):
+        """
+        Same as Scetl, plus status index of candidates
+        :param config: configs as python dict parsed from json
+        :param engine: sqlalchemy engine made from create_engine
+        """
+        super().__init__(config, engine)
+        # uuid: number of finished assessments, loaded once per run in update_candidates
+        self.candidate_statuses = {}
+
     def get_current_candidates_statuses(self):
         """
         Get finished assessments per candidate. So we won't call results for finished candidates
+        Read from "candidate_statuses" rollup if it is in config, otherwise aggregated from assessments table
         :return: python dict where key is uuid and value is number of finished assessments
         """
+        if self.statuses_rollup in self.config.get('rollups', {}):
+            rollup = self.get_rollup(self.statuses_rollup)
+            with self.write_lock:
+                if not inspect(self.engine).has_table(rollup.table_name):
+                    rollup.update()
+            if inspect(self.engine).has_table(rollup.table_name):
+                with self.engine.connect() as connection:
+                    query = f'SELECT {rollup.key_column}, {rollup.value_column} FROM {rollup.table_name}' \
+                            f'{self.tenant_filter("WHERE")}'
+                    return {x[0]: x[1] for x in connection.execute(query).fetchall()}
         with self.engine.connect() as connection:
-            query = '''
+            query = f'''
                 SELECT uuid, COUNT(*) AS finished_assessments 
-                FROM (SELECT DISTINCT uuid, name, status FROM assess_first_assessments)
+                FROM (SELECT DISTINCT uuid, name, status FROM assess_first_assessments{self.tenant_filter("WHERE")})
                 WHERE status = 'finish' GROUP BY uuid        
             '''
             current_candidates_statuses = {x[0]: x[1] for x in connection.execute(query).fetchall()}
@@ -528,7 +1123,8 @@ class AssessFirstScetl(Scetl):
         if page is not None:
             params['page'] = page
         logging.info(f'Updating candidate page {page}: calling {url} with params {params}')
-        response = requests.get(url, headers={header_name: token}, params=params).json()
+        response = decode_response(
+            self.http_request('get', url, user, headers={header_name: token}, params=params))
         return response
 
     def get_paginated_candidates_json(self, user):
@@ -553,16 +1149,40 @@ class AssessFirstScetl(Scetl):
     def get_results_json(self, user, uuid):
         """
         Get results of candidate/results call as python dict
+        Result is kept in run cache until candidate is written (see write_candidates)
         :param user: user to get his token for request headers
         :param uuid: candidate uuid - need as path variable to api call
         :return: python dict - result of the call
         """
+        def fetch():
+            return decode_response(self.http_request(**self.get_results_request(user, uuid)))
+        return self.run_cache.get_payload('results', {'user': user, 'uuid': uuid}, fetch)
+
+    def get_results_request(self, user, uuid):
+        """
+        Arguments of candidate/results api call, shared by sync and async calls
+        :param user: user to get his token for request headers
+        :param uuid: candidate uuid - need as path variable to api call
+        :return: dict with arguments of http_request
+        """
         token = self.config['users'][user]['token']
         header_name = self.config['request_headers']['header_name']
         url = self.urls['candidate_results']['url'].replace('{uuid}', uuid)
         params = self.urls['candidate_results']['params']
-        response = requests.get(url, headers={header_name: token}, params=params).json()
-        return response
+        return {'method': 'get', 'url': url, 'credential': user, 'headers': {header_name: token}, 'params': params}
+
+    def get_synthesis_request(self, user, candidate_token):
+        """
+        Arguments of candidate/synthesis api call, shared by sync and async calls
+        :param user: user to get his token for request headers
+        :param candidate_token: candidate token (gotten from results call) - need as path variable to api call
+        :return: dict with arguments of http_request
+        """
+        token = self.config['users'][user]['token']
+        header_name = self.config['request_headers']['header_name']
+        url = self.urls['candidate_synthesis']['url'].replace('{token}', candidate_token)
+        params = self.urls['candidate_synthesis']['params']
+        return {'method': 'get', 'url': url, 'credential': user, 'headers': {header_name: token}, 'params': params}
 
     def get_synthesis_json(self, user, uuid, candidate_token=None):
         """
@@ -574,63 +1194,80 @@ class AssessFirstScetl(Scetl):
         """
         if candidate_token is None:
             candidate_token = self.get_results_json(user, uuid)['token']
-        token = self.config['users'][user]['token']
-        header_name = self.config['request_headers']['header_name']
-        url = self.urls['candidate_synthesis']['url'].replace('{token}', candidate_token)
-        params = self.urls['candidate_synthesis']['params']
-        response = requests.get(url, headers={header_name: token}, params=params).json()
+        response = decode_response(self.http_request(**self.get_synthesis_request(user, candidate_token)))
         return response
 
     @staticmethod
-    def parse_synthesis_json(synthesis_json):
+    def flatten_synthesis_jsons(synthesis_jsons):
         """
         Synthesis call results are quite a unstructured mess.
-        This static methods parses results to a more agreable format
-        :param synthesis_json: results of get_synthesis_json
-        :return: list of records from synthesis call
-        """
-        results_list = []
-        for block in synthesis_json:
-            if synthesis_json[block] is not None:
-                for param in synthesis_json[block]:
-                    if type(synthesis_json[block][param]) is list:
-                        for list_item in synthesis_json[block][param]:
-                            record = {
-                                'block': block,
-                                'item': param,
-                                'value': list_item,
-                                'additional_value': None}
-                            results_list.append(record)
-                    elif type(synthesis_json[block][param]) is str:
-                        record = {
-                            'block': block,
-                            'item': param,
-                            'value': synthesis_json[block][param],
-                            'additional_value': None
-                        }
-                        results_list.append(record)
+        This static method flattens results of many candidates straight to column lists
+        :param synthesis_jsons: dict where key is candidate uuid and value is result of get_synthesis_json
+        :return: dict of column lists - uuid, block, item, value, additional_value
+        """
+        uuids, blocks, items, values, additional_values = [], [], [], [], []
+        for uuid, synthesis_json in synthesis_jsons.items():
+            for block, block_json in synthesis_json.items():
+                if block_json is None:
+                    continue
+                for param, param_value in block_json.items():
+                    if type(param_value) is list:
+                        rows = len(param_value)
+                        values.extend(param_value)
+                        additional_values.extend([None] * rows)
+                    elif type(param_value) is str:
+                        rows = 1
+                        values.append(param_value)
+                        additional_values.append(None)
                     elif param in ['bad_squares', 'good_squares']:
-                        for square in synthesis_json[block][param].keys():
-                            record = {
-                                'block': block,
-                                'item': param,
-                                'value': synthesis_json[block][param][square]['label'],
-                                'additional_value': square
-                            }
-                            results_list.append(record)
+                        rows = len(param_value)
+                        values.extend([x['label'] for x in param_value.values()])
+                        additional_values.extend(param_value.keys())
                     elif param in ['privileged', 'decision', 'learning']:
-                        record = {
-                            'block': block,
-                            'item': param,
-                            'value': synthesis_json[block][param]['value'],
-                            'additional_value': synthesis_json[block][param]['description']
-                        }
-                        results_list.append(record)
+                        rows = 1
+                        values.append(param_value['value'])
+                        additional_values.append(param_value['description'])
                     else:
-                        record = {'block': block, 'item': param, 'value': None, 'additional_value': None}
-                        results_list.append(record)
+                        rows = 1
+                        values.append(None)
+                        additional_values.append(None)
+                    uuids.extend([uuid] * rows)
+                    blocks.extend([block] * rows)
+                    items.extend([param] * rows)
+        return {'uuid': uuids, 'block': blocks, 'item': items, 'value': values, 'additional_value': additional_values}
 
-        return results_list
+    @staticmethod
+    def parse_synthesis_json(synthesis_json):
+        """
+        Parses results of single synthesis call to a more agreable format
+        :param synthesis_json: results of get_synthesis_json
+        :return: list of records from synthesis call
+        """
+        columns = AssessFirstScetl.flatten_synthesis_jsons({None: synthesis_json})
+        del columns['uuid']
+        return [dict(zip(columns.keys(), x)) for x in zip(*columns.values())]
+
+    def write_synthesis_batch(self, synthesis_jsons):
+        """
+        Replaces synthesises of batch of candidates in database with single delete and single insert
+        :param synthesis_jsons: dict where key is candidate uuid and value is result of get_synthesis_json
+        :return: None, writes results to db
+        """
+        if not synthesis_jsons:
+            return
+        logging.info(f'Writing synthesises for {len(synthesis_jsons)} candidates')
+        table_name, table_cols = self.get_table_params('synthesises')
+        df = pd.DataFrame(self.flatten_synthesis_jsons(synthesis_jsons))
+        df['last_update'] = datetime.utcnow()
+        df = self.apply_data_types('synthesises', df[table_cols])
+        query = text(f'DELETE FROM {table_name} WHERE uuid IN :uuids{self.tenant_filter()}').bindparams(
+            bindparam('uuids', expanding=True))
+        uuids = list(synthesis_jsons.keys())
+        with self.write_lock, self.engine.begin() as connection:
+            # sqlite has limit on number of variables in one statement
+            for i in range(0, len(uuids), 500):
+                connection.execute(query, uuids=uuids[i:i + 500])
+            df.to_sql(table_name, con=connection, if_exists='append', index=False)
 
     def update_candidate_result(self, user, uuid, results_json=None):
         """
@@ -643,27 +1280,20 @@ class AssessFirstScetl(Scetl):
         if results_json is None:
             results_json = self.get_results_json(user, uuid)
         logging.info(f'Updating results for user {user}, candidate {uuid}')
-        with self.engine.connect() as connection:
-            query = f"DELETE FROM assess_first_assessments WHERE uuid = '{uuid}'"
-            connection.execute(query)
-
         table_name, table_cols = self.get_table_params('assessments')
         df_assessments = pd.DataFrame(results_json['assessments'])
         df_assessments['last_update'] = datetime.utcnow()
         df_assessments['uuid'] = uuid
         df_assessments = self.apply_data_types('assessments', df_assessments[table_cols])
-        df_assessments.to_sql(table_name, con=self.engine, if_exists='append', index=False)
+        self.write_table('assessments', df_assessments, where=f"uuid = '{uuid}'")
 
         if 'finish' in list(df_assessments['status']):
-            with self.engine.connect() as connection:
-                query = f"DELETE FROM assess_first_results WHERE uuid = '{uuid}'"
-                connection.execute(query)
             table_name, table_cols = self.get_table_params('results')
             df_results = pd.DataFrame(results_json['results'])
             df_results['last_update'] = datetime.utcnow()
             df_results['uuid'] = uuid
             df_results = self.apply_data_types('results', df_results[table_cols])
-            df_results.to_sql(table_name, con=self.engine, if_exists='append', index=False)
+            self.write_table('results', df_results, where=f"uuid = '{uuid}'")
 
     def update_candidate_synthesis(self, user, uuid, results_json=None):
         """
@@ -679,68 +1309,220 @@ class AssessFirstScetl(Scetl):
             candidate_token = results_json['token']
         logging.info(f'Updating synthesis for user {user}, candidate {uuid}')
         synthesis_json = self.get_synthesis_json(user, uuid, candidate_token)
-        results_list = self.parse_synthesis_json(synthesis_json)
-
-        with self.engine.connect() as connection:
-            query = f"DELETE FROM assess_first_synthesises WHERE uuid = '{uuid}'"
-            connection.execute(query)
+        self.write_synthesis_batch({uuid: synthesis_json})
 
-        table_name, table_cols = self.get_table_params('synthesises')
-        df = pd.DataFrame(results_list)
-        df['last_update'] = datetime.utcnow()
-        df['uuid'] = uuid
-        df = self.apply_data_types('synthesises', df[table_cols])
-        df.to_sql(table_name, con=self.engine, if_exists='append', index=False)
+    def is_finished_candidate(self, uuid):
+        """
+        Looks up candidate in status index loaded in update_candidates
+        :param uuid: candidate uuid
+        :return: Bool, True if candidate has all 3 assessments finished
+        """
+        return self.candidate_statuses.get(uuid, 0) >= 3
 
     def update_candidates(self):
         """
-        Main method. Gets list of candidates from db with finished assessments.
+        Main method. Loads candidate status index (finished assessments per candidate) once per run.
         Then goes to cycle through all users, for each of them get list of candidates and if they have below
-        3 finished assessments - makes results call. If candidate has new finished assessments -
-        it makes result and synthesis calls, updating data in db
+        3 finished assessments and are changed (see is_changed_candidate) - makes results call.
+        If candidate has new finished assessments - it makes result and synthesis calls, updating data in db
         :return: None, writes results to db
         """
         users = self.config['users']
+        self.candidate_statuses = self.get_current_candidates_statuses()
+        known_fingerprints = FingerprintStore(
+            self.engine, self.get_fingerprints_table(), 'uuid', extra_columns=['assessments']
+        ).load()
+        queue_items = []
         for user in users:
-            current_candidates_statuses = self.get_current_candidates_statuses()
-            finished_candidates = [
-                x for x in current_candidates_statuses.keys() if current_candidates_statuses[x] >= 3
-            ]
             logging.info(f'updating candidates for {user}')
             candidates = self.get_paginated_candidates_json(user)
+            candidates_hashes = {x['uuid']: FingerprintStore.hash_payload(x) for x in candidates}
+            candidates_with_state = {x['uuid'] for x in candidates if self.has_assessment_state(x)}
 
             table_name, table_cols = self.get_table_params('candidates')
-            with self.engine.connect() as connection:
-                query = f"DELETE FROM assess_first_candidates WHERE owner = '{user}'"
-                connection.execute(query)
             df_candidates = pd.DataFrame(candidates)
             df_candidates['last_update'] = datetime.utcnow()
             df_candidates['owner'] = user
             df_candidates = self.apply_data_types('candidates', df_candidates[table_cols])
-            df_candidates.to_sql(table_name, con=self.engine, if_exists='append', index=False)
+            self.write_table('candidates', df_candidates, where=f"owner = '{user}'")
 
-            not_finished_candidates = [x for x in df_candidates['uuid'] if x not in finished_candidates]
-            logging.info(f'Found {len(not_finished_candidates)} not finished candidates. '
+            not_finished_candidates = [x for x in df_candidates['uuid'] if not self.is_finished_candidate(x)]
+            candidates_to_update = [
+                x for x in not_finished_candidates
+                if self.is_changed_candidate(x, known_fingerprints, candidates_hashes, candidates_with_state)
+            ]
+            logging.info(f'Found {len(not_finished_candidates)} not finished candidates, '
+                         f'{len(not_finished_candidates) - len(candidates_to_update)} of them unchanged. '
                          f'Total candidates: {df_candidates.shape[0]}')
-            current_candidate = 0
-
-            for uuid in not_finished_candidates:
-                current_candidate += 1
-                logging.info(f'Updating candidate {current_candidate} out of {len(not_finished_candidates)}')
-                results_json = self.get_results_json(user, uuid)
-                finished_assessments = len(
-                    [x['name'] for x in results_json['assessments'] if x['status'] == 'finish']
-                )
-                try:
-                    current_known_assessments = current_candidates_statuses[uuid]
-                except KeyError:
-                    current_known_assessments = 0
-                logging.info(f'Updating user {user}, candidate {uuid}. '
-                             f'Known assessments: {current_known_assessments}. '
-                             f'Discovered assessments: {finished_assessments}')
-                if finished_assessments > current_known_assessments:
-                    self.update_candidate_result(user, uuid, results_json)
-                    self.update_candidate_synthesis(user, uuid, results_json)
+            batch_size = int(self.config.get('synthesis_batch_size', 200))
+            if 'work_queue' in self.config:
+                queue_items += [
+                    (x, {'user': user, 'known': self.candidate_statuses.get(x, 0), 'fingerprint': candidates_hashes[x]})
+                    for x in candidates_to_update
+                ]
+                continue
+
+            # batch N+1 is fetched while batch N is written
+            self.run_pipeline('candidates', self.iter_candidate_batches(user, candidates_to_update, batch_size),
+                              write=lambda x: self.write_candidates(user, x, candidates_hashes))
+        if queue_items:
+            run_coordinator(self, self.get_queue_name('assess_first_candidates'), queue_items)
+
+    def has_assessment_state(self, candidate):
+        """
+        Checks if candidate's payload in candidates list carries assessment state, i.e. changes when
+        candidate finishes assessment. Fields with state are set in config as "candidate_state_fields",
+        e.g. ["assessments", "status"]. Without them payload hash says nothing about assessments
+        :param candidate: candidate dict from candidates list
+        :return: Bool
+        """
+        return any(candidate.get(x) is not None for x in self.config.get('candidate_state_fields', []))
+
+    def is_changed_candidate(self, uuid, known_fingerprints, candidates_hashes, candidates_with_state):
+        """
+        Candidate needs results call if its payload in candidates list has no assessment state (new finished
+        assessment can't be seen without results call), if payload changed since last run or if more finished
+        assessments were found on last run than there are in database (new assessment was added but not written)
+        :param uuid: candidate uuid
+        :param known_fingerprints: result of FingerprintStore.load
+        :param candidates_hashes: dict where key is uuid and value is hash of candidate's payload in candidates list
+        :param candidates_with_state: set of uuids whose payload has assessment state, see has_assessment_state
+        :return: Bool
+        """
+        if uuid not in candidates_with_state:
+            return True
+        known = known_fingerprints.get(uuid, {})
+        if known.get('fingerprint') != candidates_hashes.get(uuid):
+            return True
+        return (known.get('assessments') or 0) > self.candidate_statuses.get(uuid, 0)
+
+    def iter_candidate_batches(self, user, uuids, batch_size):
+        """
+        Fetch stage of candidates update, batch is fetched concurrently if async
+        :param user: user candidates belong to
+        :param uuids: list of candidate uuids
+        :param batch_size: candidates per batch
+        :return: generator of dicts where key is uuid and value is result of fetch_candidate
+        """
+        for start in range(0, len(uuids), batch_size):
+            batch = uuids[start:start + batch_size]
+            if self.is_async:
+                logging.info(f'Updating candidates {start + 1}-{start + len(batch)} out of {len(uuids)}')
+                yield self.async_fetcher.run(self.fetch_candidates_async, user, batch)
+                continue
+            fetched_candidates = {}
+            for i, uuid in enumerate(batch):
+                logging.info(f'Updating candidate {start + i + 1} out of {len(uuids)}')
+                fetched_candidates[uuid] = self.fetch_candidate(user, uuid, self.candidate_statuses.get(uuid, 0))
+            yield fetched_candidates
+
+    def fetch_candidate(self, user, uuid, known_assessments):
+        """
+        Makes results call and, if candidate has new finished assessments, synthesis call
+        :param user: user to get his token for request headers
+        :param uuid: candidate uuid
+        :param known_assessments: number of finished assessments known from db
+        :return: dict with results, synthesis (None if no new finished assessments) and finished_assessments
+        """
+        results_json = self.get_results_json(user, uuid)
+        finished_assessments = len(
+            set([x['name'] for x in results_json['assessments'] if x['status'] == 'finish'])
+        )
+        logging.info(f'Updating user {user}, candidate {uuid}. '
+                     f'Known assessments: {known_assessments}. '
+                     f'Discovered assessments: {finished_assessments}')
+        synthesis_json = None
+        if finished_assessments > known_assessments:
+            logging.info(f'Getting synthesis for user {user}, candidate {uuid}')
+            synthesis_json = self.get_synthesis_json(user, uuid, results_json['token'])
+        return {'results': results_json, 'synthesis': synthesis_json, 'finished_assessments': finished_assessments}
+
+    async def fetch_candidate_async(self, session, user, uuid, known_assessments):
+        """
+        Async version of fetch_candidate
+        :param session: aiohttp.ClientSession
+        :param user: user to get his token for request headers
+        :param uuid: candidate uuid
+        :param known_assessments: number of finished assessments known from db
+        :return: dict with results, synthesis (None if no new finished assessments) and finished_assessments
+        """
+        results_json = await self.async_fetcher.request(session, self.get_results_request(user, uuid))
+        finished_assessments = len(
+            set([x['name'] for x in results_json['assessments'] if x['status'] == 'finish'])
+        )
+        synthesis_json = None
+        if finished_assessments > known_assessments:
+            logging.info(f'Getting synthesis for user {user}, candidate {uuid}')
+            synthesis_json = await self.async_fetcher.request(
+                session, self.get_synthesis_request(user, results_json['token']))
+        return {'results': results_json, 'synthesis': synthesis_json, 'finished_assessments': finished_assessments}
+
+    async def fetch_candidates_async(self, session, user, uuids):
+        """
+        Fetches batch of candidates concurrently
+        :param session: aiohttp.ClientSession
+        :param user: user candidates belong to
+        :param uuids: list of candidate uuids
+        :return: dict where key is uuid and value is result of fetch_candidate_async
+        """
+        fetched = await asyncio.gather(*[
+            self.fetch_candidate_async(session, user, x, self.candidate_statuses.get(x, 0)) for x in uuids
+        ])
+        return dict(zip(uuids, fetched))
+
+    def write_candidates(self, user, fetched_candidates, candidates_hashes):
+        """
+        Writes results and synthesises of batch of candidates, updates status index and fingerprints
+        :param user: user candidates belong to
+        :param fetched_candidates: dict where key is uuid and value is result of fetch_candidate
+        :param candidates_hashes: dict where key is uuid and value is hash of candidate's payload in candidates list
+        :return: None, writes results to db
+        """
+        synthesis_batch = {}
+        new_fingerprints = {}
+        for uuid, candidate in fetched_candidates.items():
+            if candidate['synthesis'] is not None:
+                self.update_candidate_result(user, uuid, candidate['results'])
+                synthesis_batch[uuid] = candidate['synthesis']
+                self.candidate_statuses[uuid] = candidate['finished_assessments']
+            new_fingerprints[uuid] = {
+                'fingerprint': candidates_hashes[uuid],
+                'assessments': candidate['finished_assessments']
+            }
+        self.write_synthesis_batch(synthesis_batch)
+        for uuid in fetched_candidates:
+            self.run_cache.invalidate('results', {'user': user, 'uuid': uuid})
+        with self.write_lock:
+            FingerprintStore(self.engine, self.get_fingerprints_table(), 'uuid', extra_columns=['assessments']).save(
+                new_fingerprints)
+
+    def fetch_work_item(self, queue, item, payload):
+        """
+        Work queue worker side - fetches candidate results and synthesis
+        :param queue: queue name
+        :param item: candidate uuid
+        :param payload: dict with user, known assessments and candidate fingerprint
+        :return: result of fetch_candidate
+        """
+        result = self.fetch_candidate(payload['user'], item, payload['known'])
+        self.run_cache.invalidate('results', {'user': payload['user'], 'uuid': item})
+        return result
+
+    def write_work_results(self, queue, results):
+        """
+        Work queue coordinator side - writes candidates fetched by workers
+        :param queue: queue name
+        :param results: list of (item, payload, result) tuples
+        :return: None, writes results to db
+        """
+        users = set([x[1]['user'] for x in results])
+        for user in users:
+            user_results = [x for x in results if x[1]['user'] == user]
+            self.write_candidates(
+                user,
+                {x[0]: x[2] for x in user_results},
+                {x[0]: x[1]['fingerprint'] for x in user_results}
+            )
 
     def update_scetl(self):
         """
@@ -749,6 +1531,8 @@ class AssessFirstScetl(Scetl):
         """
         self.check_tables()
         self.update_candidates()
+        self.update_rollups()
+        self.run_cache.clear()
 
 
 # -------------
@@ -766,12 +1550,19 @@ class SkillazScetl(Scetl):
         :param url: api endpoint to call
         :return: results of api call as python dict
         """
+        response = decode_response(self.http_request(**self.get_skillaz_request(url)))
+        return response
+
+    def get_skillaz_request(self, url):
+        """
+        Arguments of skillaz api call, shared by sync and async calls
+        :param url: api endpoint to call
+        :return: dict with arguments of http_request
+        """
         headers = {
             self.config['request_headers']['header_name']: self.config['request_headers']['header_value']
         }
-        url = self.urls[url]['url']
-        response = requests.get(url, headers=headers).json()
-        return response
+        return {'method': 'get', 'url': self.urls[url]['url'], 'headers': headers}
 
     @staticmethod
     def parse_skillaz_response(response_json, json_type):
@@ -781,9 +1572,19 @@ class SkillazScetl(Scetl):
         :param json_type: name of the call (candidates, requests or offers)
         :return: python list of records for a call
         """
+        return SkillazScetl.parse_skillaz_items(response_json['Items'], json_type)
+
+    @staticmethod
+    def parse_skillaz_items(items, json_type):
+        """
+        Parses items of candidates, requests, offers api calls to cleaner format one by one
+        :param items: iterable of response's 'Items', e.g. from iter_json_items
+        :param json_type: name of the call (candidates, requests or offers)
+        :return: python list of records for a call
+        """
         main_data = []
         workflow_data = []
-        for item in response_json['Items']:
+        for item in items:
             main_data_row = item['Data']
             workflow = item['Workflow']['States']
             for wf in workflow:
@@ -842,7 +1643,7 @@ class SkillazScetl(Scetl):
             logging.info(f'New columns in vacancies response: {new_columns}')
         df = self.add_missing_columns('vacancies', df)
         df = self.apply_data_types('vacancies', df[table_cols])
-        df.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        self.write_table('vacancies', df, if_exists='replace')
 
     def update_skillaz(self):
         """
@@ -850,24 +1651,29 @@ class SkillazScetl(Scetl):
         for each call there is a data table and workflow table
         :return: None, writes results to db
         """
-        for json_type in ['candidates', 'offers', 'requests']:
-            response = self.get_skillaz_json(json_type)
-            data_json, workflow_json = self.parse_skillaz_response(response, json_type)
-            jsons_dict = {
-                json_type: data_json,
-                json_type + '_workflow': workflow_json
-            }
-            for table in jsons_dict:
-                logging.info(f'Updating table {table}')
-                df = pd.DataFrame(jsons_dict[table])
-                df['last_update'] = datetime.utcnow()
-                table_name, table_cols = self.get_table_params(table)
-                new_columns = [x for x in df.columns if x not in table_cols]
-                if new_columns:
-                    logging.info(f'New columns in {table} response: {new_columns}')
-                df = self.add_missing_columns(table, df)
-                df = self.apply_data_types(table, df[table_cols])
-                df.to_sql(table_name, con=self.engine, if_exists='replace', index=False)
+        json_types = ['candidates', 'offers', 'requests']
+        if self.is_async:
+            responses = self.fetch_all([self.get_skillaz_request(x) for x in json_types])
+            items = [x['Items'] for x in responses]
+        else:
+            # items are parsed while response is streamed
+            items = (self.iter_json_items(self.get_skillaz_request(x), 'Items') for x in json_types)
+        for json_type, json_items in zip(json_types, items):
+            # items are parsed and written in chunks if memory budget is set, first chunk replaces tables
+            for i, items_chunk in enumerate(memory_budget.iter_chunks(json_items)):
+                data_json, workflow_json = self.parse_skillaz_items(items_chunk, json_type)
+                jsons_dict = {
+                    json_type: data_json,
+                    json_type + '_workflow': workflow_json
+                }
+                for table in jsons_dict:
+                    logging.info(f'Updating table {table}')
+                    table_name, table_cols = self.get_table_params(table)
+                    new_columns = set(x for record in jsons_dict[table] for x in record) - set(table_cols)
+                    if new_columns:
+                        logging.info(f'New columns in {table} response: {sorted(new_columns)}')
+                    df = self.make_frame(table, jsons_dict[table], {'last_update': datetime.utcnow()})
+                    self.write_table(table, df, if_exists='replace' if i == 0 else 'append')
 
     def update_scetl(self):
         """
@@ -877,3 +1683,5 @@ class SkillazScetl(Scetl):
         self.check_tables()
         self.update_vacancies()
         self.update_skillaz()
+        self.update_rollups()
+        self.run_cache.clear()
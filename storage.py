@@ -0,0 +1,247 @@
+import os
+import json
+import uuid
+import threading
+import logging
+import pandas as pd
+import pyarrow.parquet as pq
+
+# -------------------------------------------------------------------
+# Parquet storage for append-only history tables (*_changes tables)
+# -------------------------------------------------------------------
+
+
+class ParquetHistoryStore:
+
+    # manifest keeps per-file stats so that most questions can be answered without reading rows
+    manifest_name = '_manifest.json'
+    # one lock per table folder: stores are made per write and tenants append to the same manifest from threads
+    manifest_locks = {}
+    manifest_locks_guard = threading.Lock()
+
+    def __init__(self, table_name, key_column=None, path='parquet_files', compression='snappy'):
+        """
+        Store for one table. Data is written to {path}/{table_name}/last_update_date=YYYY-MM-DD/*.parquet
+        :param table_name: table name as in configs
+        :param key_column: column to use for predicate pushdown on entity (user_id, id, userId)
+        :param path: root folder for parquet files
+        :param compression: parquet compression codec
+        """
+        self.table_name = table_name
+        self.key_column = key_column
+        self.compression = compression
+        self.table_path = os.path.join(path, table_name)
+        self.manifest_path = os.path.join(self.table_path, self.manifest_name)
+        with self.manifest_locks_guard:
+            self.manifest_lock = self.manifest_locks.setdefault(os.path.abspath(self.table_path), threading.RLock())
+
+    def read_manifest(self):
+        """
+        Reads list of written files with their stats
+        :return: list of dicts, one per parquet file
+        """
+        if not os.path.isfile(self.manifest_path):
+            return []
+        with open(self.manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def write_manifest(self, manifest):
+        """
+        Rewrites manifest file. Writes to temp file first so that crashed run won't leave broken manifest
+        :param manifest: list of dicts, one per parquet file
+        :return: None, writes file
+        """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            manifest_file.write(json.dumps(manifest))
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def stat_value(value):
+        """
+        Makes min/max values json serializable
+        :param value: any scalar from pandas
+        :return: string or number
+        """
+        if pd.isnull(value):
+            return None
+        if isinstance(value, pd.Timestamp):
+            return value.isoformat()
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
+
+    def append(self, df):
+        """
+        Appends df to the store, one new file per last_update date
+        :param df: DataFrame with proper data types (result of apply_data_types), must have last_update column
+        :return: None, writes files
+        """
+        if df.shape[0] == 0:
+            return
+        with self.manifest_lock:
+            manifest = self.read_manifest()
+            for day, df_day in df.groupby(df['last_update'].dt.strftime('%Y-%m-%d')):
+                partition = f'last_update_date={day}'
+                partition_path = os.path.join(self.table_path, partition)
+                if not os.path.exists(partition_path):
+                    os.makedirs(partition_path)
+                file_name = f'part-{uuid.uuid4().hex}.parquet'
+                df_day.to_parquet(os.path.join(partition_path, file_name), compression=self.compression, index=False)
+                file_stats = {
+                    'file': os.path.join(partition, file_name),
+                    'partition': day,
+                    'rows': int(df_day.shape[0]),
+                    'min_last_update': self.stat_value(df_day['last_update'].min()),
+                    'max_last_update': self.stat_value(df_day['last_update'].max()),
+                }
+                if 'tenant' in df_day:
+                    max_by_tenant = df_day.groupby('tenant')['last_update'].max()
+                    file_stats['max_last_update_by_tenant'] = {
+                        str(tenant): self.stat_value(value) for tenant, value in max_by_tenant.items()
+                    }
+                else:
+                    file_stats['max_last_update_by_tenant'] = {}
+                if self.key_column is not None:
+                    file_stats['min_key'] = self.stat_value(df_day[self.key_column].min())
+                    file_stats['max_key'] = self.stat_value(df_day[self.key_column].max())
+                manifest.append(file_stats)
+            self.write_manifest(manifest)
+        logging.info(f'Appended {df.shape[0]} rows to parquet store {self.table_name}')
+
+    def replace(self, df):
+        """
+        Drops all files of the store and writes df instead. Used for initial loads
+        :param df: DataFrame with proper data types
+        :return: None, writes files
+        """
+        with self.manifest_lock:
+            for file_stats in self.read_manifest():
+                file_path = os.path.join(self.table_path, file_stats['file'])
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+            if not os.path.exists(self.table_path):
+                os.makedirs(self.table_path)
+            self.write_manifest([])
+            self.append(df)
+
+    def get_last_update_ts(self, tenant=None):
+        """
+        Max last_update of the store taken from manifest. With tenant per-tenant stats of files are used,
+        only files written before they were kept in manifest are scanned (last_update of tenant rows only)
+        :param tenant: tenant name, None for max of all rows
+        :return: max datetime of last_update or None if store is empty
+        """
+        max_values = []
+        for file_stats in self.read_manifest():
+            if tenant is None:
+                max_values.append(file_stats['max_last_update'])
+            elif 'max_last_update_by_tenant' in file_stats:
+                max_values.append(file_stats['max_last_update_by_tenant'].get(tenant))
+            else:
+                file_path = os.path.join(self.table_path, file_stats['file'])
+                if 'tenant' not in pq.read_schema(file_path).names:
+                    continue
+                df = pq.read_table(file_path, columns=['last_update'],
+                                   filters=[('tenant', '==', tenant)]).to_pandas()
+                max_values.append(self.stat_value(df['last_update'].max()))
+        max_values = [pd.to_datetime(x) for x in max_values if x is not None]
+        if not max_values:
+            return None
+        return max(max_values)
+
+    def select_files(self, last_update_from=None, last_update_to=None, keys=None):
+        """
+        Partition and file pruning - keeps only files which stats may contain requested rows
+        :param last_update_from: lower bound for last_update (exclusive)
+        :param last_update_to: upper bound for last_update (inclusive)
+        :param keys: list of key_column values
+        :return: list of file paths
+        """
+        files = []
+        if keys is not None:
+            keys = list(keys)
+        for file_stats in self.read_manifest():
+            if last_update_from is not None and \
+                    pd.to_datetime(file_stats['max_last_update']) <= pd.to_datetime(last_update_from):
+                continue
+            if last_update_to is not None and \
+                    pd.to_datetime(file_stats['min_last_update']) > pd.to_datetime(last_update_to):
+                continue
+            if keys is not None and file_stats.get('min_key') is not None:
+                if not any(file_stats['min_key'] <= key <= file_stats['max_key'] for key in keys):
+                    continue
+            files.append(os.path.join(self.table_path, file_stats['file']))
+        return files
+
+    def get_filters(self, last_update_from=None, last_update_to=None, keys=None):
+        """
+        Predicates on last_update and key_column in pyarrow filters format, applied while parquet row groups are read
+        :param last_update_from: lower bound for last_update (exclusive)
+        :param last_update_to: upper bound for last_update (inclusive)
+        :param keys: list of key_column values
+        :return: list of tuples or None if there are no predicates
+        """
+        filters = []
+        if last_update_from is not None:
+            filters.append(('last_update', '>', pd.to_datetime(last_update_from)))
+        if last_update_to is not None:
+            filters.append(('last_update', '<=', pd.to_datetime(last_update_to)))
+        if keys is not None:
+            filters.append((self.key_column, 'in', list(keys)))
+        return filters or None
+
+    def iter_chunks(self, columns=None, last_update_from=None, last_update_to=None, keys=None):
+        """
+        Reads store file by file, only requested columns are read and predicates on last_update and key_column
+        are pushed down to parquet reader, so row groups out of them are skipped by their statistics
+        :param columns: list of columns to read, None for all
+        :param last_update_from: lower bound for last_update (exclusive)
+        :param last_update_to: upper bound for last_update (inclusive)
+        :param keys: list of key_column values
+        :return: generator of DataFrames
+        """
+        filters = self.get_filters(last_update_from, last_update_to, keys)
+        for file_path in self.select_files(last_update_from, last_update_to, keys):
+            df = pq.read_table(file_path, columns=columns, filters=filters).to_pandas()
+            if df.shape[0] > 0:
+                yield df
+
+    def read(self, columns=None, last_update_from=None, last_update_to=None, keys=None):
+        """
+        Same as iter_chunks but returns single DataFrame
+        :return: DataFrame, empty one if nothing found
+        """
+        chunks = list(self.iter_chunks(columns, last_update_from, last_update_to, keys))
+        if not chunks:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(chunks, ignore_index=True)
+
+
+def get_history_store(table_dict):
+    """
+    Makes ParquetHistoryStore for table if table is configured to be stored in parquet
+    :param table_dict: table dict from config dict
+    :return: ParquetHistoryStore or None if table is stored in database
+    """
+    if table_dict.get('storage') != 'parquet':
+        return None
+    return ParquetHistoryStore(
+        table_dict['table_name'],
+        key_column=table_dict.get('key_column'),
+        path=table_dict.get('storage_path', 'parquet_files'),
+        compression=table_dict.get('compression', 'snappy')
+    )
+
+
+def read_table(table_dict, engine):
+    """
+    Reads whole table from wherever it is stored
+    :param table_dict: table dict from config dict
+    :param engine: sqlalchemy engine
+    :return: DataFrame
+    """
+    store = get_history_store(table_dict)
+    if store is not None:
+        return store.read()
+    return pd.read_sql_table(table_dict['table_name'], con=engine)
@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import time
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    Fake api: /slow answers after 2 seconds, other paths answer right away
+    """
+
+    def do_GET(self):
+        if self.path.startswith('/slow'):
+            time.sleep(2)
+        body = json.dumps({'ok': True, 'path': self.path}).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_url():
+    """
+    Runs fake api on free local port
+    :return: base url
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,63 @@
+import pandas as pd
+import pyarrow as pa
+from datetime import datetime
+from sqlalchemy import create_engine
+from arrow_records import records_to_table, rows_to_table, create_table, insert_table
+
+table_dict = {
+    'table_name': 'coursera_enrolments',
+    'columns': [
+        {'name': 'user_id', 'type': 'INT'},
+        {'name': 'course', 'type': 'VARCHAR'},
+        {'name': 'state', 'type': 'CATEGORY'},
+        {'name': 'grade', 'type': 'NUMERIC'},
+        {'name': 'enrolled_at', 'type': 'UNIXTIME_MS'},
+        {'name': 'completed_at', 'type': 'DATETIME'},
+        {'name': 'last_update', 'type': 'DATETIME'}
+    ]
+}
+records = [
+    {'user_id': 1, 'course': 'python', 'state': 'active', 'grade': 0.5, 'enrolled_at': 1704067200000,
+     'completed_at': None, 'unknown': 'dropped'},
+    {'user_id': '2', 'course': 101, 'state': 'done', 'grade': '1', 'enrolled_at': None,
+     'completed_at': '2024-01-02T10:00:00+03:00'},
+    {'user_id': 3.0, 'state': 'active'}
+]
+last_update = datetime(2024, 1, 3, 12, 0)
+
+
+def test_records_get_config_types():
+    table = records_to_table(records, table_dict, {'last_update': last_update, 'tenant': 'kirovo'})
+
+    assert table.schema.names == [x['name'] for x in table_dict['columns']] + ['tenant']
+    assert table.column('user_id').type == pa.int64() and table.column('user_id').to_pylist() == [1, 2, 3]
+    assert table.column('course').to_pylist() == ['python', '101', None]
+    assert pa.types.is_dictionary(table.column('state').type)
+    assert table.column('grade').to_pylist() == [0.5, 1.0, None]
+    assert table.column('enrolled_at').to_pylist() == [datetime(2024, 1, 1), None, None]
+    assert table.column('completed_at').to_pylist() == [None, datetime(2024, 1, 2, 10), None]
+    assert table.column('tenant').to_pylist() == ['kirovo'] * 3
+
+
+def test_inserted_rows_read_back_as_written(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "local.sqlite"}')
+    table = records_to_table(records, table_dict, {'last_update': last_update})
+    with engine.begin() as connection:
+        create_table(connection, 'coursera_enrolments', table)
+        assert insert_table(connection, 'coursera_enrolments', table, batch_rows=2) == 3
+
+    df = pd.read_sql('SELECT * FROM coursera_enrolments ORDER BY user_id', con=engine,
+                     parse_dates=['enrolled_at', 'completed_at', 'last_update'])
+    assert df['course'].tolist()[:2] == ['python', '101'] and df['course'].isnull().tolist() == [False, False, True]
+    assert df['state'].tolist() == ['active', 'done', 'active']
+    assert df['last_update'].tolist() == [pd.Timestamp(last_update)] * 3
+    assert df['enrolled_at'][0] == pd.Timestamp('2024-01-01')
+
+    # rows read back from database make the same arrow table
+    with engine.connect() as connection:
+        result = connection.execute('SELECT * FROM coursera_enrolments ORDER BY user_id')
+        names = list(result.keys())
+        read_back = rows_to_table([tuple(x) for x in result.fetchall()], names, table_dict)
+    assert read_back.column('completed_at').to_pylist() == table.column('completed_at').to_pylist()
+    assert read_back.column('grade').to_pylist() == table.column('grade').to_pylist()
+    assert read_back.column('state').to_pylist() == table.column('state').to_pylist()
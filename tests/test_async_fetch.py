@@ -0,0 +1,43 @@
+import asyncio
+import pytest
+import requests
+from urllib.parse import urlparse
+from async_fetch import AsyncFetcher
+from throttle import rate_limiter
+
+# one slot per host, so a leaked slot blocks every later request
+settings = {'min_concurrency': 1, 'max_concurrency': 1, 'requests_per_second': 100}
+
+
+def test_timed_out_request_releases_slot(api_url):
+    fetcher = AsyncFetcher(settings)
+
+    async def fetch(session):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(fetcher.request(session, {'url': f'{api_url}/slow'}), 0.2)
+        return await asyncio.wait_for(fetcher.request(session, {'url': f'{api_url}/fast'}), 5)
+
+    assert fetcher.run(fetch)['ok']
+    assert rate_limiter.get_controller(urlparse(api_url).netloc).in_flight == 0
+
+
+def test_cancelled_request_releases_slot(api_url):
+    fetcher = AsyncFetcher(settings)
+
+    async def fetch(session):
+        task = asyncio.ensure_future(fetcher.request(session, {'url': f'{api_url}/slow'}))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await asyncio.wait_for(fetcher.request(session, {'url': f'{api_url}/fast'}), 5)
+
+    assert fetcher.run(fetch)['ok']
+    assert rate_limiter.get_controller(urlparse(api_url).netloc).in_flight == 0
+
+
+def test_sync_timeout_releases_slot(api_url):
+    with pytest.raises(requests.Timeout):
+        rate_limiter.request('get', f'{api_url}/slow', settings=settings, timeout=0.2)
+    assert rate_limiter.get_controller(urlparse(api_url).netloc).in_flight == 0
+    assert rate_limiter.request('get', f'{api_url}/fast', settings=settings, timeout=5).status_code == 200
@@ -0,0 +1,49 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+from sqlalchemy import create_engine, inspect
+from bulk_loader import BulkLoader
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "target.sqlite"}')
+
+
+def load(engine, chunks, schema=None, append=False):
+    loader = BulkLoader(engine, 'eduson users', [['user_id']], schema)
+    loader.begin(append)
+    for chunk in chunks:
+        loader.write(chunk)
+    loader.finish()
+
+
+@pytest.mark.parametrize('schema', [None, 'main'])
+def test_swap_replaces_target(engine, schema):
+    load(engine, [pd.DataFrame({'user_id': [1, 2], 'name': ['a', 'b']})], schema)
+    load(engine, [pd.DataFrame({'user_id': [3], 'name': ['c']}), pd.DataFrame({'user_id': [4], 'name': ['d']})],
+         schema)
+
+    assert sorted(inspect(engine).get_table_names()) == ['eduson users']
+    assert [x['column_names'] for x in inspect(engine).get_indexes('eduson users')] == [['user_id']]
+    df = pd.read_sql('SELECT * FROM "eduson users" ORDER BY user_id', con=engine)
+    assert df.to_dict('list') == {'user_id': [3, 4], 'name': ['c', 'd']}
+
+
+def test_swap_of_arrow_chunks(engine):
+    load(engine, [pa.table({'user_id': [1, 2], 'name': ['a', 'b']})], 'main')
+    load(engine, [pa.table({'user_id': [5], 'name': ['e']})], 'main', append=True)
+
+    df = pd.read_sql('SELECT * FROM "eduson users" ORDER BY user_id', con=engine)
+    assert df.to_dict('list') == {'user_id': [1, 2, 5], 'name': ['a', 'b', 'e']}
+
+
+def test_abort_keeps_target(engine):
+    load(engine, [pd.DataFrame({'user_id': [1], 'name': ['a']})])
+    loader = BulkLoader(engine, 'eduson users')
+    loader.begin()
+    loader.write(pd.DataFrame({'user_id': [2], 'name': ['b']}))
+    loader.abort()
+
+    assert inspect(engine).get_table_names() == ['eduson users']
+    assert pd.read_sql('SELECT * FROM "eduson users"', con=engine).to_dict('list') == {'user_id': [1], 'name': ['a']}
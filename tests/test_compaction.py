@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from compaction import HistoryCompactor
+
+table_dict = {
+    'table_name': 'user_courses_changes',
+    'columns': [
+        {'name': 'user_id', 'type': 'INT'},
+        {'name': 'progress', 'type': 'NUMERIC'},
+        {'name': 'score', 'type': 'INT'},
+        {'name': 'last_update', 'type': 'DATETIME'}
+    ],
+    'compaction': {'entity_columns': ['user_id']}
+}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "history.sqlite"}')
+
+
+def add_snapshots(engine, rows, last_update):
+    df = pd.DataFrame(rows)
+    df['last_update'] = pd.Timestamp(last_update)
+    df.to_sql(table_dict['table_name'], con=engine, if_exists='append', index=False)
+    HistoryCompactor(table_dict, engine).compact()
+
+
+def read_intervals(engine):
+    df = pd.read_sql('SELECT * FROM user_courses_changes_intervals ORDER BY user_id, valid_from', con=engine,
+                     parse_dates=['valid_from', 'valid_to'])
+    return [(x.user_id, str(x.valid_from), None if pd.isnull(x.valid_to) else str(x.valid_to)) for x in df.itertuples()]
+
+
+def test_identical_snapshots_extend_and_changes_close_interval(engine):
+    add_snapshots(engine, [{'user_id': 1, 'progress': 0.5, 'score': 1}, {'user_id': 2, 'progress': 0.1, 'score': 2}],
+                  '2024-01-01')
+    add_snapshots(engine, [{'user_id': 1, 'progress': 0.5, 'score': 1}, {'user_id': 2, 'progress': 0.7, 'score': 2}],
+                  '2024-01-02')
+    add_snapshots(engine, [{'user_id': 1, 'progress': 0.5, 'score': 1}], '2024-01-03')
+
+    assert read_intervals(engine) == [
+        (1, '2024-01-01 00:00:00', None),
+        (2, '2024-01-01 00:00:00', '2024-01-02 00:00:00'),
+        (2, '2024-01-02 00:00:00', None)
+    ]
+    as_of = HistoryCompactor(table_dict, engine).as_of(pd.Timestamp('2024-01-01 12:00'))
+    assert as_of.sort_values('user_id')['progress'].tolist() == [0.5, 0.1]
+
+
+def test_same_values_with_other_dtypes_keep_one_interval(engine):
+    # first run reads score as int, second one as float because of NaN of other user
+    add_snapshots(engine, [{'user_id': 1, 'progress': 1, 'score': 1}, {'user_id': 2, 'progress': 1, 'score': 2}],
+                  '2024-01-01')
+    add_snapshots(engine, [{'user_id': 1, 'progress': 1.0, 'score': 1}, {'user_id': 2, 'progress': None, 'score': None}],
+                  '2024-01-02')
+
+    assert read_intervals(engine) == [
+        (1, '2024-01-01 00:00:00', None),
+        (2, '2024-01-01 00:00:00', '2024-01-02 00:00:00'),
+        (2, '2024-01-02 00:00:00', None)
+    ]
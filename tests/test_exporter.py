@@ -0,0 +1,90 @@
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from exporter import TableExporter, CsvSink, ParquetSink
+
+table_dict = {
+    'table_name': 'user_courses_changes',
+    'append_only': True,
+    'columns': [{'name': 'user_id', 'type': 'INT'}, {'name': 'progress', 'type': 'NUMERIC'},
+                {'name': 'last_update', 'type': 'DATETIME'}]
+}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "local.sqlite"}')
+
+
+def add_rows(engine, rows, last_update):
+    df = pd.DataFrame(rows)
+    df['last_update'] = pd.Timestamp(last_update)
+    df.to_sql(table_dict['table_name'], con=engine, if_exists='append', index=False)
+
+
+def test_sinks_get_only_rows_after_watermark(engine, tmp_path):
+    sinks = [CsvSink(str(tmp_path / 'csv')), ParquetSink(str(tmp_path / 'parquet'))]
+    exporter = TableExporter(engine, sinks)
+    add_rows(engine, [{'user_id': 1, 'progress': 0.1}, {'user_id': 2, 'progress': 0.2}], '2024-01-01')
+    exporter.export_table(table_dict)
+    csv_size = os.path.getsize(tmp_path / 'csv' / 'user_courses_changes.csv')
+    add_rows(engine, [{'user_id': 1, 'progress': 0.5}], '2024-01-02')
+    exporter.export_table(table_dict)
+    # nothing new - sinks are skipped
+    exporter.export_table(table_dict)
+
+    df_csv = pd.read_csv(tmp_path / 'csv' / 'user_courses_changes.csv')
+    assert df_csv[['user_id', 'progress']].values.tolist() == [[1, 0.1], [2, 0.2], [1, 0.5]]
+    with open(tmp_path / 'csv' / 'user_courses_changes.csv') as file:
+        file.seek(csv_size)
+        assert file.read().startswith('1,0.5,')
+    parquet_files = sorted(os.listdir(tmp_path / 'parquet' / 'user_courses_changes'))
+    assert len(parquet_files) == 2
+    df_parquet = pd.read_parquet(tmp_path / 'parquet' / 'user_courses_changes')
+    assert sorted(df_parquet['progress']) == [0.1, 0.2, 0.5]
+    watermarks = exporter.get_watermarks('user_courses_changes')
+    assert set(watermarks.values()) == {pd.Timestamp('2024-01-02')}
+    assert not os.path.exists(tmp_path / 'csv' / 'user_courses_changes.csv.offset')
+
+
+def test_csv_append_follows_header_and_rewrites_on_new_columns(tmp_path):
+    sink = CsvSink(str(tmp_path))
+    file_path = tmp_path / 'users.csv'
+    sink.begin('users', False)
+    sink.write(pd.DataFrame({'id': [1], 'email': ['a@corp.ru']}))
+    sink.finish()
+
+    sink.begin('users', True)
+    sink.write(pd.DataFrame({'email': ['b@corp.ru'], 'id': [2]}))
+    sink.finish()
+    assert pd.read_csv(file_path).to_dict('list') == {'id': [1, 2], 'email': ['a@corp.ru', 'b@corp.ru']}
+
+    sink.begin('users', True)
+    sink.write(pd.DataFrame({'tenant': ['kirovo'], 'id': [3], 'email': ['c@corp.ru']}))
+    sink.finish()
+    df = pd.read_csv(file_path)
+    assert list(df.columns) == ['id', 'email', 'tenant']
+    assert df['id'].tolist() == [1, 2, 3]
+    assert df['tenant'].isnull().tolist() == [True, True, False]
+
+
+def test_csv_append_is_cut_back_after_abort_and_crash(tmp_path):
+    sink = CsvSink(str(tmp_path))
+    file_path = tmp_path / 'users.csv'
+    sink.begin('users', False)
+    sink.write(pd.DataFrame({'id': [1], 'email': ['a@corp.ru']}))
+    sink.finish()
+    content = file_path.read_bytes()
+
+    sink.begin('users', True)
+    sink.write(pd.DataFrame({'id': [2], 'email': ['b@corp.ru']}))
+    sink.abort()
+    assert file_path.read_bytes() == content
+
+    # process died in the middle of append
+    sink.begin('users', True)
+    sink.write(pd.DataFrame({'id': [3], 'email': ['c@corp.ru']}))
+    sink.file.close()
+    CsvSink(str(tmp_path)).begin('users', True)
+    assert file_path.read_bytes() == content
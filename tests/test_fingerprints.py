@@ -0,0 +1,121 @@
+import copy
+import pytest
+from sqlalchemy import create_engine
+from metrics import run_metrics
+from scetl import EdusonScetl, AssessFirstScetl
+from fingerprints import FingerprintStore
+
+config = {
+    'urls': {'users': {'url': 'http://eduson/users'}, 'user_courses': {'url': 'http://eduson/users/{id}/courses'}},
+    'request_headers': {'header_name': 'X-Token', 'header_value': 'token'},
+    'pipeline_queue_size': 0,
+    'tables': {
+        'users': {
+            'table_name': 'eduson_users',
+            'columns': [{'name': 'id', 'type': 'INT'}, {'name': 'email', 'type': 'VARCHAR'},
+                        {'name': 'last_update', 'type': 'DATETIME'}]
+        },
+        'user_changes': {
+            'table_name': 'eduson_user_changes',
+            'columns': [{'name': 'id', 'type': 'INT'}, {'name': 'email', 'type': 'VARCHAR'},
+                        {'name': 'updated_at', 'type': 'DATETIME'}, {'name': 'last_update', 'type': 'DATETIME'}]
+        },
+        'user_courses': {
+            'table_name': 'eduson_user_courses',
+            'columns': [{'name': 'user_id', 'type': 'INT'}, {'name': 'course_id', 'type': 'INT'},
+                        {'name': 'progress', 'type': 'NUMERIC'}, {'name': 'last_update', 'type': 'DATETIME'}]
+        },
+        'user_courses_changes': {
+            'table_name': 'eduson_user_courses_changes',
+            'columns': [{'name': 'user_id', 'type': 'INT'}, {'name': 'course_id', 'type': 'INT'},
+                        {'name': 'progress', 'type': 'NUMERIC'}, {'name': 'last_update', 'type': 'DATETIME'}]
+        }
+    }
+}
+
+
+class FakeEdusonScetl(EdusonScetl):
+    """
+    Eduson scetl answering from dicts instead of api, remembers users whose courses were fetched
+    """
+
+    def __init__(self, engine, users, courses):
+        super().__init__(copy.deepcopy(config), engine)
+        self.users = users
+        self.courses = courses
+        self.fetched = []
+
+    def get_user_json(self):
+        return self.users
+
+    def get_user_courses_json(self, user_id):
+        self.fetched.append(user_id)
+        return {'courses': self.courses[user_id]}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "eduson.sqlite"}')
+
+
+def run(engine, users, courses):
+    run_metrics.reset()
+    scetl = FakeEdusonScetl(engine, users, courses)
+    scetl.check_tables()
+    scetl.update_user_changes()
+    return sorted(scetl.fetched), run_metrics.to_dict()['sections']['fingerprints.eduson_user_fingerprints']
+
+
+def test_only_changed_users_are_refetched(engine):
+    users = [{'id': 1, 'email': 'a@corp.ru', 'updated_at': '2024-01-01 10:00:00'},
+             {'id': 2, 'email': 'b@corp.ru', 'updated_at': '2024-01-01 10:00:00'},
+             {'id': 3, 'email': 'c@corp.ru', 'updated_at': '2024-01-01 10:00:00'}]
+    courses = {1: [{'course_id': 10, 'progress': 0.5}], 2: [{'course_id': 10, 'progress': None}],
+               3: [{'course_id': 11, 'progress': 1}]}
+
+    fetched, metrics = run(engine, users, courses)
+    assert fetched == [1, 2, 3]
+    assert metrics['changed_by_fingerprint'] == 3 and metrics['calls_avoided'] == 0
+
+    fetched, metrics = run(engine, users, courses)
+    assert fetched == []
+    assert metrics['changed_by_fingerprint'] == 0
+
+    # progress on courses only moves updated_at of users endpoint
+    users[0] = {**users[0], 'updated_at': '2024-01-02 10:00:00'}
+    fetched, metrics = run(engine, users, {**courses, 1: [{'course_id': 10, 'progress': 0.8}]})
+    assert fetched == [1]
+    assert metrics['changed_by_fingerprint'] == 1
+
+    fetched, metrics = run(engine, users, courses)
+    assert fetched == []
+
+
+def test_user_with_lost_courses_is_refetched(engine):
+    users = [{'id': 1, 'email': 'a@corp.ru', 'updated_at': '2024-01-01 10:00:00'},
+             {'id': 2, 'email': 'b@corp.ru', 'updated_at': '2024-01-01 10:00:00'}]
+    courses = {1: [{'course_id': 10, 'progress': 0.5}], 2: [{'course_id': 11, 'progress': 0.2}]}
+    run(engine, users, courses)
+    with engine.begin() as connection:
+        connection.execute('DELETE FROM eduson_user_courses WHERE user_id = 2')
+
+    fetched, metrics = run(engine, users, courses)
+    assert fetched == [2]
+    assert metrics['changes_updated_at_would_miss'] == 1
+
+
+def test_candidates_without_assessment_state_are_not_skipped():
+    scetl = AssessFirstScetl({'urls': {}, 'tables': {}, 'candidate_state_fields': ['assessments']}, None)
+    other = AssessFirstScetl({'urls': {}, 'tables': {}}, None)
+    candidates = [{'uuid': 'a', 'assessments': [{'name': 'talent', 'status': 'finish'}]}, {'uuid': 'b'}]
+    hashes = {x['uuid']: FingerprintStore.hash_payload(x) for x in candidates}
+    with_state = {x['uuid'] for x in candidates if scetl.has_assessment_state(x)}
+    known = {x: {'fingerprint': hashes[x], 'assessments': 1} for x in hashes}
+    scetl.candidate_statuses['a'] = 1
+
+    assert with_state == {'a'}
+    assert not scetl.is_changed_candidate('a', known, hashes, with_state)
+    assert scetl.is_changed_candidate('b', known, hashes, with_state)
+    assert not any(other.has_assessment_state(x) for x in candidates)
+    # status index belongs to instance, tenants do not share it
+    assert other.candidate_statuses == {}
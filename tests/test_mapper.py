@@ -0,0 +1,64 @@
+import multiprocessing
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from mapper import EmployeeMapper
+
+
+def make_hr_df(rows):
+    """
+    HR table of the same shape as get_hr_df result
+    :param rows: number of employees
+    :return: DataFrame
+    """
+    last_names = ['ivanov', 'petrov', 'sidorov', 'smirnov', 'kuznetsov', 'popov', 'vasiliev', 'sokolov']
+    first_names = ['ivan', 'petr', 'anna', 'olga', 'sergey', 'maria']
+    df = pd.DataFrame({
+        'employee_uid': [f'uid{i}' for i in range(rows)],
+        'last_name': [last_names[i % len(last_names)] + str(i // 48) for i in range(rows)],
+        'first_name': [first_names[i % len(first_names)] for i in range(rows)],
+        'email': [f'user{i}@corp.ru' for i in range(rows)],
+        'login': [f'login{i % (rows // 2)}' for i in range(rows)],
+        'exit_date': [pd.Timestamp('2100-12-31') if i % 3 else pd.Timestamp('2020-01-01') for i in range(rows)],
+        'main_workplace': [i % 2 == 0 for i in range(rows)]
+    })
+    df['last_first_name'] = df['last_name'] + ' ' + df['first_name']
+    df['employee_name'] = df['last_first_name']
+    return df
+
+
+def make_cloud_df(df_hr):
+    """
+    Cloud users hitting every mapping step: email, login, exact and misspelled names, not mapped
+    :param df_hr: result of make_hr_df
+    :return: DataFrame of the same shape as get_cloud_users_df result
+    """
+    rows = []
+    for i, hr_row in enumerate(df_hr.itertuples()):
+        kind = i % 5
+        rows.append({
+            'hr_system': 'eduson',
+            'email': f'cloud{i}@mail.ru',
+            'email_clean': hr_row.email if kind == 0 else f'cloud{i}@mail.ru',
+            'login': hr_row.login if kind == 1 else f'cloud{i}',
+            'full_name': hr_row.employee_name if kind == 2 else '',
+            'last_first_name_ru': hr_row.last_name + 'a ' + hr_row.first_name if kind == 3 else
+            (f'nobody{i} none' if kind == 4 else '')
+        })
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork start method')
+def test_parallel_mapping_matches_serial():
+    mapper = EmployeeMapper(create_engine('sqlite://'))
+    df_hr = make_hr_df(240)
+    lookup = {x: df_hr.groupby(x).indices for x in mapper.lookup_columns}
+    lookup['fuzzy'] = mapper.build_fuzzy_index(df_hr)
+    df = make_cloud_df(df_hr)
+
+    serial = mapper.identify_users(df, df_hr, lookup, processes=1)
+    parallel = mapper.identify_users(df, df_hr, lookup, processes=3)
+
+    assert parallel == serial
+    assert set(x['mapping_source'] for x in serial) >= {'email', 'login', 'employee_name',
+                                                         'fuzzy_last_first_name', 'not_mapped'}
@@ -0,0 +1,71 @@
+import os
+import threading
+import pandas as pd
+import pytest
+from metrics import run_metrics
+from memory_budget import MemoryBudget, get_rss_mb
+
+
+@pytest.fixture
+def budget(tmp_path):
+    budget = MemoryBudget()
+    budget.configure({'budget_mb': 1, 'chunk_rows': 3, 'spill_path': str(tmp_path / 'spill'), 'sample_seconds': 0.01})
+    return budget
+
+
+def test_chunks_are_bounded_only_with_budget(budget):
+    assert [len(x) for x in budget.iter_chunks(range(7))] == [3, 3, 1]
+    assert [x.shape[0] for x in budget.iter_frame_chunks(pd.DataFrame({'a': range(7)}))] == [3, 3, 1]
+    assert list(budget.iter_chunks([])) == [[]]
+    budget.configure({})
+    assert [len(x) for x in budget.iter_chunks(range(7))] == [7]
+    assert budget.make_buffer('pages') == []
+
+
+@pytest.mark.skipif(get_rss_mb() is None, reason='needs /proc/self/status')
+def test_spill_buffer_keeps_records_in_order(budget):
+    buffer = budget.make_buffer('pages')
+    buffer.extend([{'id': 1}, {'id': 2}])
+    buffer.extend([{'id': 3}])
+
+    assert len(buffer.files) == 2 and buffer.records == []
+    buffer.records.append({'id': 4})
+    buffer.rows += 1
+    assert [x['id'] for x in buffer] == [1, 2, 3, 4]
+    assert len(buffer) == 4
+    files = list(buffer.files)
+    buffer.close()
+    assert not any(os.path.exists(x) for x in files)
+
+
+@pytest.mark.skipif(get_rss_mb() is None, reason='needs /proc/self/status')
+def test_stage_peak_is_not_reset_by_concurrent_stage(budget):
+    run_metrics.reset()
+    started = threading.Event()
+    release = threading.Event()
+
+    class Stages:
+        def update_big(self):
+            data = bytearray(100 * 1024 * 1024)
+            data[::4096] = b'1' * len(data[::4096])
+            threading.Event().wait(0.1)
+            del data
+            started.set()
+            release.wait(5)
+
+        def update_small(self):
+            pass
+
+    stages = Stages()
+    budget.track(stages, 'update_')
+    thread = threading.Thread(target=stages.update_big)
+    thread.start()
+    # small stage starts after big one freed its memory but before big one finished
+    started.wait(5)
+    stages.update_small()
+    release.set()
+    thread.join()
+
+    peaks = run_metrics.to_dict()['sections']['peak_rss_mb']
+    assert peaks['Stages.update_big'] > peaks['Stages.update_small'] + 50
+    assert budget.stage_peaks == {}
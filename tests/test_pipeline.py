@@ -0,0 +1,52 @@
+import threading
+import pytest
+from pipeline import Pipeline
+
+
+class StageError(Exception):
+    pass
+
+
+def fail_on(value, stage):
+    def function(item):
+        if item == value:
+            raise StageError(stage)
+        return item
+    return function
+
+
+def items(count, fail_at=None):
+    for i in range(count):
+        if i == fail_at:
+            raise StageError('producer')
+        yield i
+
+
+@pytest.mark.parametrize('queue_size', [0, 2])
+def test_items_are_transformed_and_written_in_order(queue_size):
+    written = []
+    count = Pipeline('test', queue_size).run(items(20), lambda x: None if x % 5 == 0 else x * 10, written.append)
+
+    assert count == 16
+    assert written == [x * 10 for x in range(20) if x % 5]
+
+
+@pytest.mark.parametrize('queue_size', [0, 2])
+@pytest.mark.parametrize('stage', ['producer', 'transformer', 'writer'])
+def test_error_of_stage_is_raised_and_stops_pipeline(queue_size, stage):
+    written = []
+    source = items(100, fail_at=7 if stage == 'producer' else None)
+    transform = fail_on(7, 'transformer') if stage == 'transformer' else None
+    write = fail_on(7, 'writer') if stage == 'writer' else None
+
+    with pytest.raises(StageError, match=stage):
+        Pipeline('test', queue_size).run(source, transform, lambda x: written.append((write or (lambda y: y))(x)))
+
+    # items still in queues are dropped once pipeline is stopped
+    assert written == list(range(len(written)))
+    if stage == 'writer' or queue_size == 0:
+        assert len(written) == 7
+    else:
+        assert len(written) <= 7
+    # stage threads are joined before error is raised
+    assert not [x for x in threading.enumerate() if x.name.startswith('test.')]
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from rollups import RollupTable
+
+rollup_dict = {'table_name': 'assess_first_candidate_statuses', 'source': 'assessments', 'key_column': 'uuid',
+               'method': 'count_distinct', 'columns': ['name'], 'filter': {'status': 'finish'},
+               'value_column': 'finished_assessments'}
+source_dict = {'table_name': 'assess_first_assessments',
+               'columns': [{'name': 'uuid', 'type': 'VARCHAR'}, {'name': 'name', 'type': 'VARCHAR'},
+                           {'name': 'status', 'type': 'VARCHAR'}, {'name': 'last_update', 'type': 'DATETIME'}]}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "local.sqlite"}')
+
+
+def add_assessments(engine, rows, tenant=None):
+    df = pd.DataFrame(rows, columns=['uuid', 'name', 'status'])
+    df['last_update'] = pd.Timestamp('2024-01-01')
+    if tenant is not None:
+        df['tenant'] = tenant
+    df.to_sql(source_dict['table_name'], con=engine, if_exists='append', index=False)
+
+
+def read_statuses(rollup):
+    df = rollup.read()
+    return dict(zip(df['uuid'], df['finished_assessments']))
+
+
+def test_only_changed_keys_are_recomputed(engine):
+    add_assessments(engine, [('a', 'talent', 'finish'), ('a', 'talent', 'finish'), ('a', 'drive', 'start'),
+                             ('b', 'talent', 'finish'), ('b', 'drive', 'finish')])
+    rollup = RollupTable(rollup_dict, source_dict, engine)
+    rollup.update(['a'])
+    assert read_statuses(rollup) == {'a': 1, 'b': 2}
+
+    add_assessments(engine, [('a', 'drive', 'finish'), ('c', 'talent', 'finish')])
+    with engine.begin() as connection:
+        connection.execute("DELETE FROM assess_first_assessments WHERE uuid = 'b'")
+    rollup.update(['a', 'c'])
+    # b is not among changed keys, its row stays as it was
+    assert read_statuses(rollup) == {'a': 2, 'b': 2, 'c': 1}
+
+    rollup.update(['b'])
+    assert read_statuses(rollup) == {'a': 2, 'c': 1}
+    rollup.update([])
+    assert read_statuses(rollup) == {'a': 2, 'c': 1}
+
+
+def test_tenant_rollup_keeps_rows_of_other_tenants(engine):
+    add_assessments(engine, [('a', 'talent', 'finish')], tenant='uralchem')
+    add_assessments(engine, [('a', 'talent', 'finish'), ('a', 'drive', 'finish')], tenant='kirovo')
+    uralchem = RollupTable(rollup_dict, source_dict, engine, 'uralchem')
+    kirovo = RollupTable(rollup_dict, source_dict, engine, 'kirovo')
+    uralchem.update()
+    kirovo.update()
+
+    add_assessments(engine, [('a', 'drive', 'finish')], tenant='uralchem')
+    uralchem.update(['a'])
+    assert read_statuses(uralchem) == {'a': 2}
+    assert read_statuses(kirovo) == {'a': 2}
+    assert RollupTable(rollup_dict, source_dict, engine).read().shape[0] == 2
@@ -0,0 +1,56 @@
+import pandas as pd
+from storage import ParquetHistoryStore
+
+
+def make_rows(user_ids, tenant, last_update):
+    return pd.DataFrame({
+        'user_id': user_ids,
+        'progress': [x / 10 for x in user_ids],
+        'tenant': tenant,
+        'last_update': pd.to_datetime(last_update)
+    })
+
+
+def test_append_and_read_with_predicates(tmp_path):
+    store = ParquetHistoryStore('user_courses_changes', key_column='user_id', path=str(tmp_path))
+    store.append(make_rows([1, 2], 'uralchem', ['2024-01-01 10:00', '2024-01-02 10:00']))
+    store.append(make_rows([3, 4], 'kirovo', ['2024-01-02 12:00', '2024-01-03 10:00']))
+
+    manifest = store.read_manifest()
+    assert sorted(x['partition'] for x in manifest) == ['2024-01-01', '2024-01-02', '2024-01-02', '2024-01-03']
+    assert sum(x['rows'] for x in manifest) == 4
+    assert store.read().shape == (4, 4)
+    df = store.read(columns=['progress'], last_update_from='2024-01-01 10:00', last_update_to='2024-01-02 12:00')
+    assert list(df.columns) == ['progress'] and sorted(df['progress']) == [0.2, 0.3]
+    assert store.read(columns=['user_id'], keys=[4, 5])['user_id'].tolist() == [4]
+    # files whose key range can't hold keys are skipped
+    assert len(store.select_files(keys=[1])) == 1
+    assert store.read(columns=['user_id'], keys=[9]).empty
+
+
+def test_last_update_per_tenant_from_manifest(tmp_path):
+    store = ParquetHistoryStore('user_courses_changes', key_column='user_id', path=str(tmp_path))
+    assert store.get_last_update_ts() is None
+    store.append(make_rows([1, 2], 'uralchem', ['2024-01-01 10:00', '2024-01-03 10:00']))
+    store.append(make_rows([3], 'kirovo', ['2024-01-02 10:00']))
+
+    assert store.get_last_update_ts() == pd.Timestamp('2024-01-03 10:00')
+    assert store.get_last_update_ts('uralchem') == pd.Timestamp('2024-01-03 10:00')
+    assert store.get_last_update_ts('kirovo') == pd.Timestamp('2024-01-02 10:00')
+    assert store.get_last_update_ts('other') is None
+
+    # manifest written before per tenant stats - files are scanned for tenant rows
+    manifest = store.read_manifest()
+    for file_stats in manifest:
+        del file_stats['max_last_update_by_tenant']
+    store.write_manifest(manifest)
+    assert store.get_last_update_ts('kirovo') == pd.Timestamp('2024-01-02 10:00')
+
+
+def test_replace_drops_old_files(tmp_path):
+    store = ParquetHistoryStore('user_courses_changes', key_column='user_id', path=str(tmp_path))
+    store.append(make_rows([1, 2], 'uralchem', ['2024-01-01 10:00', '2024-01-02 10:00']))
+    store.replace(make_rows([3], 'uralchem', ['2024-01-05 10:00']))
+
+    assert store.read()['user_id'].tolist() == [3]
+    assert len(store.read_manifest()) == 1
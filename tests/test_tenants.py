@@ -0,0 +1,75 @@
+import threading
+import pandas as pd
+import pytest
+from datetime import datetime
+from sqlalchemy import create_engine
+from scetl import Scetl, get_tenant_configs
+
+system_config = {
+    'urls': {},
+    'tables': {
+        'users': {
+            'table_name': 'eduson_users',
+            'columns': [{'name': 'id', 'type': 'INT'}, {'name': 'email', 'type': 'VARCHAR'},
+                        {'name': 'last_update', 'type': 'DATETIME'}]
+        }
+    },
+    'tenants': [{'tenant': 'uralchem'}, {'tenant': 'kirovo'}]
+}
+users_per_tenant = 50
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "local.sqlite"}', connect_args={'timeout': 60})
+
+
+def make_users(scetl, run):
+    df = pd.DataFrame({'id': range(users_per_tenant),
+                       'email': [f'{scetl.tenant}{i}_{run}@corp.ru' for i in range(users_per_tenant)]})
+    df['last_update'] = datetime.utcnow()
+    return scetl.apply_data_types('users', df)
+
+
+def test_concurrent_tenants_never_expose_partly_replaced_rows(engine):
+    scetls = [Scetl(x, engine) for x in get_tenant_configs(system_config)]
+    scetls[0].check_tables()
+    scetls[1].check_tables()
+    stopped = threading.Event()
+    seen_counts = set()
+    errors = []
+
+    def update(scetl):
+        try:
+            for run in range(15):
+                scetl.write_table('users', make_users(scetl, run), if_exists='replace')
+                df = make_users(scetl, run).head(1)
+                scetl.write_table('users', df, where='id = 0')
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        seen_tenants = set()
+        while not stopped.is_set():
+            df = pd.read_sql('SELECT tenant, COUNT(*) AS users FROM eduson_users GROUP BY tenant', con=engine)
+            counts = dict(zip(df['tenant'], df['users']))
+            # tenant once written never disappears, even for a moment
+            seen_counts.update(counts.get(x, 0) for x in seen_tenants | set(counts))
+            seen_tenants.update(counts)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    threads = [threading.Thread(target=update, args=(x,)) for x in scetls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stopped.set()
+    reader.join()
+
+    assert errors == []
+    assert seen_counts <= {users_per_tenant}
+    df = pd.read_sql('SELECT * FROM eduson_users', con=engine)
+    assert df.groupby('tenant').size().to_dict() == {'kirovo': users_per_tenant, 'uralchem': users_per_tenant}
+    assert set(df['email'].str.extract(r'_(\d+)@')[0]) == {'14'}
+    assert (df['email'].str.extract(r'^([a-z]+)')[0] == df['tenant']).all()
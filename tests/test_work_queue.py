@@ -0,0 +1,64 @@
+import time
+import pytest
+from sqlalchemy import create_engine
+from work_queue import WorkQueue
+
+
+@pytest.fixture
+def work_queue(tmp_path):
+    return WorkQueue(create_engine(f'sqlite:///{tmp_path / "queue.sqlite"}'), lease_seconds=300, max_attempts=2)
+
+
+def test_item_is_leased_by_one_worker(work_queue):
+    work_queue.enqueue('users', [(1, {'user': 'a'}), (2, None)])
+    first = work_queue.lease('users', 'worker1', batch_size=1)
+    second = work_queue.lease('users', 'worker2', batch_size=5)
+
+    assert [x[1:] for x in first] == [('1', {'user': 'a'})]
+    assert [x[1] for x in second] == ['2']
+    assert work_queue.lease('users', 'worker3') == []
+    # only lease owner completes item
+    work_queue.complete(first[0][0], 'worker2', {'courses': []})
+    assert work_queue.take_results('users') == []
+    work_queue.complete(first[0][0], 'worker1', {'courses': []})
+    assert [x[1:] for x in work_queue.take_results('users')] == [('1', {'user': 'a'}, {'courses': []})]
+
+
+def test_expired_lease_is_retried_until_attempts_run_out(work_queue):
+    work_queue.lease_seconds = -1
+    work_queue.enqueue('users', [(1, None)])
+    first = work_queue.lease('users', 'dead_worker')
+    time.sleep(0.01)
+    retried = work_queue.lease('users', 'worker2')
+
+    assert [x[0] for x in retried] == [first[0][0]]
+    # late complete of dead worker is dropped
+    work_queue.complete(first[0][0], 'dead_worker', 'late')
+    assert work_queue.take_results('users') == []
+    work_queue.fail(retried[0][0], 'worker2', 'timeout')
+    assert work_queue.progress('users') == {'failed': 1}
+    assert work_queue.is_drained('users')
+
+
+def test_failed_item_goes_back_to_queue(work_queue):
+    work_queue.enqueue('users', [(1, None)])
+    item_id = work_queue.lease('users', 'worker1')[0][0]
+    work_queue.fail(item_id, 'worker1', 'http 500')
+    assert work_queue.progress('users') == {'pending': 1}
+
+    work_queue.complete(work_queue.lease('users', 'worker1')[0][0], 'worker1', 'ok')
+    work_queue.mark_written([item_id])
+    assert work_queue.progress('users') == {'written': 1}
+    assert work_queue.is_drained('users')
+
+
+def test_enqueue_clears_previous_run_of_queue_only(work_queue):
+    work_queue.enqueue('users', [(1, None), (2, None)])
+    work_queue.enqueue('candidates', [('uuid1', None)])
+    item_id = work_queue.lease('users', 'worker1')[0][0]
+    work_queue.complete(item_id, 'worker1', 'old result')
+
+    work_queue.enqueue('users', [(2, None), (3, None)])
+    assert work_queue.progress('users') == {'pending': 2}
+    assert work_queue.progress('candidates') == {'pending': 1}
+    assert sorted(x[1] for x in work_queue.lease('users', 'worker1', batch_size=5)) == ['2', '3']
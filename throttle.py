@@ -0,0 +1,348 @@
+import time
+import logging
+import threading
+import requests
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from collections import Counter
+from metrics import run_metrics
+
+# ----------------------------------------------------------------------------
+# Per host rate limiting: token bucket per credential + AIMD concurrency limit
+# ----------------------------------------------------------------------------
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        """
+        Classic token bucket
+        :param rate: tokens added per second
+        :param burst: max tokens in bucket
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Adds tokens for time passed since last refill. Should be called under lock
+        :return: None
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self):
+        """
+        Takes token if there is one
+        :return: 0 if token taken, else seconds to wait before next try
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until token is taken
+        :return: seconds waited
+        """
+        waited = 0
+        wait_time = self.wait_time()
+        while wait_time > 0:
+            time.sleep(wait_time)
+            waited += wait_time
+            wait_time = self.wait_time()
+        return waited
+
+    def drain(self):
+        """
+        Empties bucket, used when server asks to slow down
+        :return: None
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0)
+
+
+class HostController:
+
+    # status codes that mean we are being throttled
+    throttle_status_codes = [429, 503]
+
+    # seconds between checks for free concurrency slot in try_acquire
+    poll_interval = 0.05
+
+    def __init__(self, host, settings=None):
+        """
+        Controls requests to one host. Settings (all optional) come from "rate_limits" in system config:
+        requests_per_second and burst - token bucket per credential,
+        min_concurrency, max_concurrency - bounds for concurrent requests,
+        target_latency - seconds, slower responses are treated as congestion
+        :param host: host name
+        :param settings: dict with rate limits settings
+        """
+        settings = settings or {}
+        self.host = host
+        self.rate = float(settings.get('requests_per_second', 5))
+        self.burst = float(settings.get('burst', self.rate * 2))
+        self.min_concurrency = int(settings.get('min_concurrency', 1))
+        self.max_concurrency = int(settings.get('max_concurrency', 8))
+        self.target_latency = float(settings.get('target_latency', 2.0))
+        self.limit = float(self.min_concurrency)
+        self.in_flight = 0
+        # in flight and waiting requests per credential, for fair share of concurrency between tenants
+        self.credential_in_flight = Counter()
+        self.credential_waiting = Counter()
+        self.blocked_until = 0
+        self.buckets = {}
+        self.condition = threading.Condition()
+        self.stats = {'requests': 0, 'throttled': 0, 'slow': 0, 'errors': 0, 'latency_total': 0.0,
+                      'bucket_wait_total': 0.0, 'retry_after_total': 0.0}
+
+    def get_bucket(self, credential):
+        """
+        Token bucket for credential, created on first use
+        :param credential: token owner (e.g. assess first user) or 'default'
+        :return: TokenBucket
+        """
+        with self.condition:
+            if credential not in self.buckets:
+                self.buckets[credential] = TokenBucket(self.rate, self.burst)
+            return self.buckets[credential]
+
+    def has_fair_slot(self, credential):
+        """
+        Checks if credential can take concurrency slot. When other credentials wait, each one gets
+        at most its share of the limit, so one busy tenant does not take all slots. Should be called under lock
+        :param credential: token owner
+        :return: Bool
+        """
+        if self.in_flight >= int(self.limit):
+            return False
+        active = set(x for x in self.credential_in_flight if self.credential_in_flight[x] > 0)
+        active |= set(x for x in self.credential_waiting if self.credential_waiting[x] > 0)
+        active.add(credential)
+        if len(active) == 1:
+            return True
+        fair_share = max(1, int(self.limit) // len(active))
+        return self.credential_in_flight[credential] < fair_share
+
+    def add_waiting(self, credential, delta):
+        """
+        Counts asyncio callers polling try_acquire as waiting, so that fair share takes them into account
+        :param credential: token owner
+        :param delta: 1 when caller starts waiting, -1 when it stops
+        :return: None
+        """
+        with self.condition:
+            self.credential_waiting[credential] += delta
+
+    def take_slot(self, credential):
+        """
+        Marks slot as taken by credential. Should be called under lock
+        :param credential: token owner
+        :return: None
+        """
+        self.in_flight += 1
+        self.credential_in_flight[credential] += 1
+
+    def acquire(self, credential='default'):
+        """
+        Blocks until request is allowed: server's Retry-After passed, fair concurrency slot is free and token is taken
+        :param credential: token owner
+        :return: None
+        """
+        with self.condition:
+            self.credential_waiting[credential] += 1
+            while True:
+                blocked_for = self.blocked_until - time.monotonic()
+                if blocked_for > 0:
+                    self.condition.wait(blocked_for)
+                elif not self.has_fair_slot(credential):
+                    self.condition.wait()
+                else:
+                    break
+            self.credential_waiting[credential] -= 1
+            self.take_slot(credential)
+        waited = self.get_bucket(credential).acquire()
+        with self.condition:
+            self.stats['bucket_wait_total'] += waited
+
+    def try_acquire(self, credential='default'):
+        """
+        Non blocking version of acquire for asyncio callers
+        :param credential: token owner
+        :return: 0 if request is allowed (slot and token taken), else seconds to wait before next try
+        """
+        with self.condition:
+            blocked_for = self.blocked_until - time.monotonic()
+            if blocked_for > 0:
+                return blocked_for
+            if not self.has_fair_slot(credential):
+                return self.poll_interval
+            wait_time = self.get_bucket(credential).wait_time()
+            if wait_time > 0:
+                self.stats['bucket_wait_total'] += wait_time
+                return wait_time
+            self.take_slot(credential)
+            return 0
+
+    def release(self, latency, status_code=None, retry_after=None, credential='default'):
+        """
+        Frees concurrency slot taken by acquire and adjusts limit, see observe
+        :param latency: seconds request took
+        :param status_code: response status or None if request failed
+        :param retry_after: seconds from Retry-After header
+        :param credential: token owner
+        :return: None
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.credential_in_flight[credential] -= 1
+        self.observe(latency, status_code, retry_after, credential)
+
+    def observe(self, latency, status_code=None, retry_after=None, credential='default'):
+        """
+        Adjusts limit by response: additive increase on fast responses,
+        multiplicative decrease on throttling or slow responses
+        :param latency: seconds request took
+        :param status_code: response status or None if request failed
+        :param retry_after: seconds from Retry-After header
+        :param credential: token owner
+        :return: None
+        """
+        with self.condition:
+            self.stats['requests'] += 1
+            self.stats['latency_total'] += latency
+            if status_code in self.throttle_status_codes:
+                self.stats['throttled'] += 1
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                if retry_after:
+                    self.stats['retry_after_total'] += retry_after
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            elif status_code is None:
+                self.stats['errors'] += 1
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            elif latency > self.target_latency:
+                self.stats['slow'] += 1
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / max(self.limit, 1))
+            self.condition.notify_all()
+        if status_code in self.throttle_status_codes:
+            self.get_bucket(credential).drain()
+
+    def blocked_for(self):
+        """
+        Seconds left until Retry-After of the host passes
+        :return: float, 0 if not blocked
+        """
+        with self.condition:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def snapshot(self):
+        """
+        Current state of controller for run metrics
+        :return: python dict
+        """
+        with self.condition:
+            state = dict(self.stats)
+            state['concurrency_limit'] = round(self.limit, 2)
+            state['in_flight'] = self.in_flight
+            state['credentials'] = len(self.buckets)
+            state['in_flight_by_credential'] = {x: y for x, y in self.credential_in_flight.items() if y > 0}
+            state['avg_latency'] = round(self.stats['latency_total'] / self.stats['requests'], 3) \
+                if self.stats['requests'] else None
+        return state
+
+
+class RateLimiter:
+
+    def __init__(self):
+        """
+        Registry of host controllers, one per host for all scetl instances
+        """
+        self.controllers = {}
+        self.lock = threading.Lock()
+
+    def get_controller(self, host, settings=None):
+        """
+        Controller for host, created with settings on first use
+        :param host: host name
+        :param settings: "rate_limits" dict from system config
+        :return: HostController
+        """
+        with self.lock:
+            if host not in self.controllers:
+                self.controllers[host] = HostController(host, settings)
+            return self.controllers[host]
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Retry-After can be seconds or http date
+        :param value: header value
+        :return: seconds to wait or None
+        """
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+    def request(self, method, url, credential='default', settings=None, **kwargs):
+        """
+        Makes request through host controller, retries throttled requests
+        :param method: 'get' or 'post'
+        :param url: url to call
+        :param credential: token owner, each credential has own token bucket
+        :param settings: "rate_limits" dict from system config, "max_retries" is also taken from there
+        :param kwargs: params passed to requests.request
+        :return: requests.Response
+        """
+        settings = settings or {}
+        controller = self.get_controller(urlparse(url).netloc, settings)
+        max_retries = int(settings.get('max_retries', 5))
+        attempt = 0
+        while True:
+            attempt += 1
+            controller.acquire(credential)
+            started_at = time.monotonic()
+            response = None
+            retry_after = None
+            try:
+                response = requests.request(method, url, **kwargs)
+                retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
+            finally:
+                status_code = None if response is None else response.status_code
+                controller.release(time.monotonic() - started_at, status_code, retry_after, credential)
+            if response.status_code not in controller.throttle_status_codes or attempt > max_retries:
+                return response
+            logging.info(f'{controller.host} throttled request (status {response.status_code}), '
+                         f'retry {attempt} of {max_retries}')
+
+    def snapshot(self):
+        """
+        States of all host controllers for run metrics
+        :return: python dict where key is host
+        """
+        with self.lock:
+            controllers = dict(self.controllers)
+        return {host: controllers[host].snapshot() for host in controllers}
+
+
+rate_limiter = RateLimiter()
+run_metrics.add_collector('rate_limits', rate_limiter.snapshot)
@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import multiprocessing
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, text, bindparam
+
+# --------------------------------------------------------------------------------------
+# Durable work queue in sqlite: coordinator enqueues entities, workers (processes, hosts)
+# lease and fetch them, coordinator is the only one writing results to main database
+# --------------------------------------------------------------------------------------
+
+
+class WorkQueue:
+
+    table_name = 'scetl_work_queue'
+    view_name = 'v_scetl_work_queue_progress'
+
+    def __init__(self, engine, lease_seconds=300, max_attempts=5):
+        """
+        Queue is a table in its own database, so that workers on other hosts can share it
+        :param engine: sqlalchemy engine for queue database
+        :param lease_seconds: lease time, items of workers that died are returned to queue after it
+        :param max_attempts: items failed that many times are marked as failed
+        """
+        self.engine = engine
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.create()
+
+    @classmethod
+    def from_config(cls, queue_config):
+        """
+        Makes queue from "work_queue" dict in system config
+        :param queue_config: dict with url, lease_seconds, max_attempts
+        :return: WorkQueue
+        """
+        engine = create_engine(queue_config.get('url', f'sqlite:///{os.getcwd()}/queue.sqlite'),
+                               connect_args={'timeout': 60})
+        return cls(engine, int(queue_config.get('lease_seconds', 300)), int(queue_config.get('max_attempts', 5)))
+
+    @staticmethod
+    def now(seconds=0):
+        """
+        Current utc time as sortable string
+        :param seconds: seconds to add
+        :return: string
+        """
+        return (datetime.utcnow() + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    def create(self):
+        """
+        Creates queue table and progress view if they don't exist
+        :return: None, writes to queue db
+        """
+        with self.engine.begin() as connection:
+            connection.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue VARCHAR(100),
+                    item VARCHAR(100),
+                    payload TEXT,
+                    status VARCHAR(20),
+                    attempts INTEGER DEFAULT 0,
+                    lease_owner VARCHAR(100),
+                    lease_expires_at VARCHAR(30),
+                    result TEXT,
+                    error TEXT,
+                    last_update VARCHAR(30)
+                )
+            ''')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{self.table_name} ON {self.table_name} (queue, status)')
+            connection.execute(f'''
+                CREATE VIEW IF NOT EXISTS {self.view_name} AS
+                SELECT queue, status, COUNT(*) AS items, SUM(attempts) AS attempts, MAX(last_update) AS last_update
+                FROM {self.table_name} GROUP BY queue, status
+            ''')
+
+    def enqueue(self, queue, items):
+        """
+        Adds items to queue. All items of previous run of this queue are removed first: its pending items would
+        be fetched twice and its done results written over fresh ones. Items it did not write are still changed,
+        so they are in items again. Late completes of its leased items find no row and are dropped
+        :param queue: queue name, e.g. eduson_user_courses
+        :param items: list of (item, payload) tuples, payload is any json serializable object
+        :return: None, writes to queue db
+        """
+        rows = [
+            {'queue': queue, 'item': str(item), 'payload': json.dumps(payload, default=str), 'status': 'pending',
+             'attempts': 0, 'last_update': self.now()}
+            for item, payload in items
+        ]
+        with self.engine.begin() as connection:
+            connection.execute(text(f'DELETE FROM {self.table_name} WHERE queue = :queue'), queue=queue)
+            if rows:
+                connection.execute(text(f'''
+                    INSERT INTO {self.table_name} (queue, item, payload, status, attempts, last_update)
+                    VALUES (:queue, :item, :payload, :status, :attempts, :last_update)
+                '''), rows)
+        logging.info(f'Enqueued {len(rows)} items to {queue}')
+
+    def lease(self, queue, worker_id, batch_size=1):
+        """
+        Leases pending items or items with expired lease
+        :param queue: queue name
+        :param worker_id: unique worker name
+        :param batch_size: max items to lease
+        :return: list of (id, item, payload)
+        """
+        leased = []
+        with self.engine.begin() as connection:
+            available = f'''
+                queue = :queue AND attempts < :max_attempts
+                AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < :now))
+            '''
+            params = {'queue': queue, 'max_attempts': self.max_attempts, 'now': self.now()}
+            rows = connection.execute(text(f'''
+                SELECT id, item, payload FROM {self.table_name} WHERE {available} ORDER BY id LIMIT :limit
+            '''), limit=batch_size, **params).fetchall()
+            for row in rows:
+                # update checks condition again so that item is taken by one worker only
+                result = connection.execute(text(f'''
+                    UPDATE {self.table_name}
+                    SET status = 'leased', lease_owner = :worker_id, lease_expires_at = :expires,
+                        attempts = attempts + 1, last_update = :now
+                    WHERE id = :id AND {available}
+                '''), worker_id=worker_id, expires=self.now(self.lease_seconds), id=row[0], **params)
+                if result.rowcount == 1:
+                    leased.append((row[0], row[1], json.loads(row[2])))
+        return leased
+
+    def complete(self, item_id, worker_id, result):
+        """
+        Saves result of leased item
+        :param item_id: id from lease
+        :param worker_id: worker that leased item
+        :param result: json serializable result
+        :return: None, writes to queue db
+        """
+        with self.engine.begin() as connection:
+            connection.execute(text(f'''
+                UPDATE {self.table_name} SET status = 'done', result = :result, error = NULL, last_update = :now
+                WHERE id = :id AND lease_owner = :worker_id AND status = 'leased'
+            '''), result=json.dumps(result, default=str), now=self.now(), id=item_id, worker_id=worker_id)
+
+    def fail(self, item_id, worker_id, error):
+        """
+        Returns item to queue or marks it failed if attempts are exhausted
+        :param item_id: id from lease
+        :param worker_id: worker that leased item
+        :param error: error text
+        :return: None, writes to queue db
+        """
+        with self.engine.begin() as connection:
+            connection.execute(text(f'''
+                UPDATE {self.table_name}
+                SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'pending' END,
+                    error = :error, lease_owner = NULL, last_update = :now
+                WHERE id = :id AND lease_owner = :worker_id AND status = 'leased'
+            '''), max_attempts=self.max_attempts, error=error, now=self.now(), id=item_id, worker_id=worker_id)
+
+    def take_results(self, queue, limit=200):
+        """
+        Gets done items for writer
+        :param queue: queue name
+        :param limit: max items
+        :return: list of (id, item, payload, result)
+        """
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(f'''
+                SELECT id, item, payload, result FROM {self.table_name}
+                WHERE queue = :queue AND status = 'done' ORDER BY id LIMIT :limit
+            '''), queue=queue, limit=limit).fetchall()
+        return [(x[0], x[1], json.loads(x[2]), json.loads(x[3])) for x in rows]
+
+    def mark_written(self, item_ids):
+        """
+        Marks items as written by coordinator
+        :param item_ids: list of ids
+        :return: None, writes to queue db
+        """
+        if not item_ids:
+            return
+        query = text(f"UPDATE {self.table_name} SET status = 'written', result = NULL, last_update = :now "
+                     f"WHERE id IN :ids").bindparams(bindparam('ids', expanding=True))
+        with self.engine.begin() as connection:
+            connection.execute(query, now=self.now(), ids=item_ids)
+
+    def expire_exhausted(self, queue):
+        """
+        Items with expired lease and no attempts left can't be leased anymore - mark them failed
+        :param queue: queue name
+        :return: None, writes to queue db
+        """
+        with self.engine.begin() as connection:
+            connection.execute(text(f'''
+                UPDATE {self.table_name} SET status = 'failed', error = 'lease expired', last_update = :now
+                WHERE queue = :queue AND status = 'leased' AND lease_expires_at < :now AND attempts >= :max_attempts
+            '''), queue=queue, now=self.now(), max_attempts=self.max_attempts)
+
+    def progress(self, queue):
+        """
+        Number of items per status
+        :param queue: queue name
+        :return: python dict where key is status and value is number of items
+        """
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(f'SELECT status, items FROM {self.view_name} WHERE queue = :queue'),
+                                      queue=queue).fetchall()
+        return {x[0]: x[1] for x in rows}
+
+    def is_drained(self, queue):
+        """
+        Checks if there is nothing left to lease or write
+        :param queue: queue name
+        :return: Bool
+        """
+        self.expire_exhausted(queue)
+        progress = self.progress(queue)
+        return not any(progress.get(x) for x in ['pending', 'leased', 'done'])
+
+
+def run_worker(scetl, queue, work_queue, worker_id=None, batch_size=10, idle_timeout=30):
+    """
+    Worker loop: lease items, fetch and transform them with scetl.fetch_work_item, return results to queue
+    :param scetl: Scetl instance implementing fetch_work_item(queue, item, payload)
+    :param queue: queue name
+    :param work_queue: WorkQueue
+    :param worker_id: unique worker name, host and pid by default
+    :param batch_size: items leased at once
+    :param idle_timeout: seconds to wait for new items when queue is drained
+    :return: None
+    """
+    if worker_id is None:
+        worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    logging.info(f'Worker {worker_id} started for {queue}')
+    idle_since = None
+    while True:
+        items = work_queue.lease(queue, worker_id, batch_size)
+        if not items:
+            if work_queue.is_drained(queue):
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since > idle_timeout:
+                    break
+            time.sleep(1)
+            continue
+        idle_since = None
+        for item_id, item, payload in items:
+            try:
+                work_queue.complete(item_id, worker_id, scetl.fetch_work_item(queue, item, payload))
+            except Exception as e:
+                logging.exception(f'Worker {worker_id} failed on {queue} item {item}')
+                work_queue.fail(item_id, worker_id, repr(e))
+    logging.info(f'Worker {worker_id} finished')
+
+
+def start_worker(scetl_class, config, db_url, queue):
+    """
+    Entry point for worker processes
+    :param scetl_class: Scetl subclass
+    :param config: system config
+    :param db_url: main database url (workers only read from it)
+    :param queue: queue name
+    :return: None
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    scetl = scetl_class(config, create_engine(db_url))
+    work_queue = WorkQueue.from_config(config['work_queue'])
+    run_worker(scetl, queue, work_queue, batch_size=int(config['work_queue'].get('batch_size', 10)),
+               idle_timeout=int(config['work_queue'].get('idle_timeout', 30)))
+
+
+def run_coordinator(scetl, queue, items):
+    """
+    Enqueues items, starts local workers ("workers" in "work_queue" config, can be 0 if workers run on other hosts)
+    and writes results with scetl.write_work_results(queue, results) until queue is drained
+    :param scetl: Scetl instance
+    :param queue: queue name
+    :param items: list of (item, payload) tuples
+    :return: list of written items
+    """
+    queue_config = scetl.config['work_queue']
+    work_queue = WorkQueue.from_config(queue_config)
+    work_queue.enqueue(queue, items)
+    processes = []
+    for i in range(int(queue_config.get('workers', 4))):
+        process = multiprocessing.Process(
+            target=start_worker, args=(type(scetl), scetl.config, str(scetl.engine.url), queue)
+        )
+        process.start()
+        processes.append(process)
+
+    written = []
+    last_progress_at = time.monotonic()
+    while True:
+        results = work_queue.take_results(queue)
+        if results:
+            scetl.write_work_results(queue, [x[1:] for x in results])
+            work_queue.mark_written([x[0] for x in results])
+            written += [x[1] for x in results]
+        elif work_queue.is_drained(queue):
+            break
+        else:
+            time.sleep(1)
+        if time.monotonic() - last_progress_at > 30:
+            logging.info(f'Queue {queue} progress: {work_queue.progress(queue)}')
+            last_progress_at = time.monotonic()
+
+    for process in processes:
+        process.join()
+    progress = work_queue.progress(queue)
+    logging.info(f'Queue {queue} finished: {progress}')
+    if progress.get('failed'):
+        logging.warning(f'{progress["failed"]} items of {queue} failed, see {work_queue.table_name}')
+    return written
+
+
+if __name__ == '__main__':
+    # worker for other hosts: python work_queue.py eduson eduson_user_courses sqlite:///path/to/db.sqlite
+    # workers of tenant take tenant name as 4th argument: ... eduson_user_courses_uralchem sqlite:///... uralchem
+    from scetl import EdusonScetl, AssessFirstScetl, get_tenant_configs
+    scetl_classes = {'eduson': EdusonScetl, 'assess_first': AssessFirstScetl}
+    with open('configs/configs.json') as json_file:
+        configs = json.load(json_file)
+    system, queue_name, main_db_url = sys.argv[1:4]
+    tenant = sys.argv[4] if len(sys.argv) > 4 else None
+    config = [x for x in get_tenant_configs(configs[system]) if x.get('tenant') == tenant][0]
+    start_worker(scetl_classes[system], config, main_db_url, queue_name)